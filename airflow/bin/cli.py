@@ -2,14 +2,14 @@
 
 import airflow
 from airflow.configuration import conf
-from airflow.executors import DEFAULT_EXECUTOR
+from airflow.executors import DEFAULT_EXECUTOR, LocalExecutor
 from airflow import settings
 from airflow import utils
 from airflow import jobs
 from airflow.models import DagBag, TaskInstance, DagPickle
 
 import dateutil.parser
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import os
 import subprocess
@@ -34,6 +34,65 @@ def log_to_stdout():
     log.addHandler(ch)
 
 
+def duration(seconds):
+    return str(timedelta(seconds=int(seconds)))
+
+
+def print_estimate(estimate, max_path=20):
+    print("Task instances to run: {} ({} already succeeded)".format(
+        estimate['task_instances'], estimate['succeeded']))
+    if estimate['blocked']:
+        print(
+            "Task instances that won't run, their dependencies outside of "
+            "the backfill aren't met: {}".format(estimate['blocked']))
+    print("Work: {}, estimated run time: {} with {}".format(
+        duration(estimate['work_seconds']),
+        duration(estimate['estimated_seconds']),
+        "a parallelism of {}".format(estimate['parallelism'])
+        if estimate['parallelism'] else "an unlimited parallelism"))
+    for pool, usage in sorted(estimate['pools'].items()):
+        print("Pool {}: {} slots, {} task instances, {} of work".format(
+            pool, usage['slots'], usage['task_instances'],
+            duration(usage['seconds'])))
+    if estimate['tasks_without_history']:
+        print("Tasks without history: " + ", ".join(
+            estimate['tasks_without_history']))
+    path = estimate['critical_path']
+    print("Critical path: {} over {} task instances".format(
+        duration(estimate['critical_path_seconds']), len(path)))
+    if len(path) > max_path:
+        skipped = len(path) - max_path
+        path = (
+            path[:max_path // 2] +
+            [(None, skipped)] +
+            path[-(max_path // 2):])
+    for key, seconds in path:
+        if key:
+            print("    {} {} {}".format(
+                key[2].isoformat(), key[1], duration(seconds)))
+        else:
+            print("    ... {} more".format(seconds))
+
+
+def resumed_date_range(job_id, dag_id):
+    """
+    Returns the start and end dates of the backfill that started the plan
+    a backfill job runs, for resuming it
+    """
+    BJ = jobs.BackfillJob
+    session = settings.Session()
+    job = session.query(BJ).filter(
+        BJ.id == job_id, BJ.dag_id == dag_id).first()
+    if job and job.bf_plan_id and job.bf_plan_id != job.id:
+        job = session.query(BJ).filter(BJ.id == job.bf_plan_id).first()
+    session.close()
+    if not job or not job.bf_start_date or not job.bf_end_date:
+        raise Exception(
+            "The date range of backfill job {} of {} isn't known, pass it "
+            "with -s and -e".format(job_id, dag_id))
+    return job.bf_start_date, job.bf_end_date
+
+
 def backfill(args):
     logging.basicConfig(level=logging.INFO, format=settings.SIMPLE_LOG_FORMAT)
     dagbag = DagBag(args.subdir)
@@ -46,6 +105,10 @@ def backfill(args):
     if args.end_date:
         args.end_date = dateutil.parser.parse(args.end_date)
 
+    if args.resume and not args.start_date and not args.end_date:
+        args.start_date, args.end_date = resumed_date_range(
+            args.resume, args.dag_id)
+
     # If only one date is passed, using same as start and end
     args.end_date = args.end_date or args.start_date
     args.start_date = args.start_date or args.end_date
@@ -54,16 +117,59 @@ def backfill(args):
         dag = dag.sub_dag(
             task_regex=args.task_regex,
             include_upstream=not args.ignore_dependencies)
+    if args.plan:
+        job = jobs.BackfillJob(
+            dag,
+            start_date=args.start_date,
+            end_date=args.end_date,
+            include_adhoc=args.include_adhoc,
+            max_running=args.max_running,
+            executor=LocalExecutor() if args.local else DEFAULT_EXECUTOR)
+        print_estimate(job.estimate())
+        return
+    if args.shards and args.shards > 1:
+        if any(task.depends_on_past for task in dag.tasks):
+            logging.warning(
+                "Some tasks depend on the past, the date range can't be "
+                "split, running a single backfill")
+        else:
+            job = jobs.ShardedBackfillJob(
+                dag,
+                start_date=args.start_date,
+                end_date=args.end_date,
+                shards=args.shards,
+                subdir=args.subdir,
+                task_regex=args.task_regex,
+                ignore_dependencies=args.ignore_dependencies,
+                mark_success=args.mark_success,
+                include_adhoc=args.include_adhoc,
+                local=args.local,
+                max_running=args.max_running)
+            job.run()
+            return
     dag.run(
         start_date=args.start_date,
         end_date=args.end_date,
         mark_success=args.mark_success,
         include_adhoc=args.include_adhoc,
-        local=args.local)
+        local=args.local,
+        max_running=args.max_running,
+        resume_job_id=args.resume,
+        progress_file=args.progress_file)
 
 
-def run(args):
+def process_subdir(subdir):
+    if subdir:
+        subdir = subdir.replace("DAGS_FOLDER", conf.get("core", "DAGS_FOLDER"))
+        subdir = os.path.expanduser(subdir)
+    return subdir
+
 
+def run(args, dag=None):
+    """
+    Runs a task instance. ``dag`` spares parsing the DAG file again when
+    the caller has it at hand already.
+    """
     utils.pessimistic_connection_handling()
     # Setting up logging
     log = os.path.expanduser(conf.get('core', 'BASE_LOG_FOLDER'))
@@ -73,16 +179,14 @@ def run(args):
     args.execution_date = dateutil.parser.parse(args.execution_date)
     iso = args.execution_date.isoformat()
     filename = "{directory}/{iso}".format(**locals())
-    subdir = None
-    if args.subdir:
-        subdir = args.subdir.replace(
-            "DAGS_FOLDER", conf.get("core", "DAGS_FOLDER"))
-        subdir = os.path.expanduser(subdir)
+    subdir = process_subdir(args.subdir)
     logging.basicConfig(
         filename=filename,
         level=logging.INFO,
         format=settings.LOG_FORMAT)
-    if not args.pickle:
+    if dag:
+        task = dag.get_task(task_id=args.task_id)
+    elif not args.pickle:
         dagbag = DagBag(subdir)
         if args.dag_id not in dagbag.dags:
             msg = 'DAG [{0}] could not be found'.format(args.dag_id)
@@ -149,6 +253,63 @@ def run(args):
         executor.end()
 
 
+def run_batch(args):
+    """
+    Runs task instances of a DAG in the current process, each logging to
+    its own log file, and exits with an error if any of them failed
+    """
+    from multiprocessing.pool import ThreadPool
+    import thread
+    from airflow.executors.thread_executor import (
+        ThreadLogHandler, task_log_handler)
+    utils.pessimistic_connection_handling()
+    logging.basicConfig(level=logging.INFO, format=settings.LOG_FORMAT)
+    dagbag = DagBag(process_subdir(args.subdir))
+    if args.dag_id not in dagbag.dags:
+        msg = 'DAG [{0}] could not be found'.format(args.dag_id)
+        logging.error(msg)
+        raise Exception(msg)
+    dag = dagbag.dags[args.dag_id]
+    tis = []
+    for task_instance in args.task_instances:
+        task_id, execution_date = task_instance.rsplit('@', 1)
+        tis.append(TaskInstance(
+            dag.get_task(task_id), dateutil.parser.parse(execution_date)))
+
+    log_handler = ThreadLogHandler()
+    logging.root.addHandler(log_handler)
+
+    def run_task_instance(ti):
+        handler = task_log_handler(ti)
+        log_handler.handlers[thread.get_ident()] = handler
+        try:
+            ti.run(
+                mark_success=args.mark_success,
+                force=args.force,
+                ignore_dependencies=args.ignore_dependencies)
+        except Exception as e:
+            logging.error("{} failed: {}".format(ti, repr(e)))
+        finally:
+            del log_handler.handlers[thread.get_ident()]
+            handler.close()
+        ti.refresh_from_db()
+        return ti.state
+
+    concurrency = args.concurrency or conf.getint(
+        'core', 'BATCH_CONCURRENCY')
+    if concurrency > 1:
+        pool = ThreadPool(concurrency)
+        states = pool.map(run_task_instance, tis)
+        pool.close()
+    else:
+        states = map(run_task_instance, tis)
+    logging.root.removeHandler(log_handler)
+    for ti, state in zip(tis, states):
+        print("{} {}".format(ti, state))
+    if utils.State.FAILED in states or utils.State.UP_FOR_RETRY in states:
+        sys.exit(1)
+
+
 def task_state(args):
     """
     Returns the state of a TaskInstance at the command line.
@@ -246,8 +407,26 @@ def webserver(args):
 def scheduler(args):
     print(settings.HEADER)
     log_to_stdout()
-    job = jobs.SchedulerJob(args.dag_id, args.subdir)
-    job.run()
+    kwargs = {}
+    if args.event_driven:
+        kwargs['event_driven'] = True
+    if args.dag_processors:
+        kwargs['dag_processors'] = args.dag_processors
+    if args.profile:
+        kwargs['num_runs'] = args.profile
+    job = jobs.SchedulerJob(args.dag_id, args.subdir, **kwargs)
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.runcall(job.run)
+        with open(args.profile_output, 'w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats()
+        print("Profile of {} scheduler runs written to {}".format(
+            args.profile, args.profile_output))
+    else:
+        job.run()
 
 
 def serve_logs(args):
@@ -278,18 +457,36 @@ def worker(args):
         env=env,
     )
 
-    # Celery worker
-    from airflow.executors.celery_executor import app as celery_app
-    from celery.bin import worker
-
-    worker = worker.worker(app=celery_app)
-    options = {
-        'optimization': 'fair',
-        'O': 'fair',
-        'queues': args.queues,
-    }
-    worker.run(**options)
+    agent = None
+    if conf.getboolean('scheduler', 'heartbeat_agent'):
+        agent = jobs.HeartbeatAgent()
+        agent.start()
+
+    if conf.get('core', 'EXECUTOR') == 'DatabaseExecutor':
+        from airflow.executors.database_executor import DatabaseWorker
+        logging.basicConfig(
+            level=logging.INFO, format=settings.SIMPLE_LOG_FORMAT)
+        DatabaseWorker(queues=args.queues.split(',')).run()
+    else:
+        # Celery worker
+        from airflow.executors.celery_executor import app as celery_app
+        from celery.bin import worker
+
+        worker = worker.worker(app=celery_app)
+        options = {
+            'optimization': 'fair',
+            'O': 'fair',
+            'queues': args.queues,
+        }
+        worker.run(**options)
     sp.kill()
+    if agent:
+        agent.stop()
+
+
+def heartbeat_agent(args):
+    logging.basicConfig(level=logging.INFO, format=settings.SIMPLE_LOG_FORMAT)
+    jobs.HeartbeatAgent().run()
 
 
 def initdb(args):
@@ -328,7 +525,10 @@ def get_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(help='sub-command help')
 
-    ht = "Run subsections of a DAG for a specified date range"
+    ht = (
+        "Run subsections of a DAG for a specified date range, with up to "
+        "the DAG's max_active_runs (max_active_runs_per_dag by default) "
+        "schedules in flight at once")
     parser_backfill = subparsers.add_parser('backfill', help=ht)
     parser_backfill.add_argument("dag_id", help="The id of the dag to run")
     parser_backfill.add_argument(
@@ -356,6 +556,34 @@ def get_parser():
     parser_backfill.add_argument(
         "-sd", "--subdir", help=subdir_help,
         default=DAGS_FOLDER)
+    parser_backfill.add_argument(
+        "-n", "--shards", type=int,
+        help=(
+            "Split the date range in this many chunks backfilled by as many "
+            "processes in parallel, for DAGs that don't depend on the past"))
+    parser_backfill.add_argument(
+        "-mr", "--max_running", type=int,
+        help=(
+            "Maximum number of task instances of the DAG running at once, "
+            "across all the shards, within the DAG's max_active_runs "
+            "schedules in flight"))
+    parser_backfill.add_argument(
+        "-r", "--resume", type=int, metavar="JOB_ID",
+        help=(
+            "Resume the backfill job with this id where it stopped, "
+            "skipping the task instances it got done. Pass the same "
+            "arguments as the interrupted backfill, the date range "
+            "defaults to the one it was started with"))
+    parser_backfill.add_argument(
+        "-pf", "--progress_file",
+        help=(
+            "Keep this file updated with the progress of the backfill, "
+            "its throughput and an ETA, as JSON"))
+    parser_backfill.add_argument(
+        "-p", "--plan", action="store_true",
+        help=(
+            "Print the number of task instances to run, an estimate of "
+            "the run time and the critical path without running anything"))
     parser_backfill.set_defaults(func=backfill)
 
     ht = "Clear a set of task instance, as if they never ran"
@@ -423,6 +651,34 @@ def get_parser():
         "-j", "--job_id", help=argparse.SUPPRESS)
     parser_run.set_defaults(func=run)
 
+    ht = (
+        "Run task instances of a DAG in a single process, used internally "
+        "by the executors to run short task instances in batches")
+    parser_batch = subparsers.add_parser('run_batch', help=ht)
+    parser_batch.add_argument("dag_id", help="The id of the dag to run")
+    parser_batch.add_argument(
+        "task_instances", nargs="+", metavar="TASK_ID@EXECUTION_DATE",
+        help="The task instances to run")
+    parser_batch.add_argument(
+        "-sd", "--subdir", help=subdir_help,
+        default=DAGS_FOLDER)
+    parser_batch.add_argument(
+        "-m", "--mark_success", help=mark_success_help, action="store_true")
+    parser_batch.add_argument(
+        "-f", "--force",
+        help="Force a run regardless or previous success",
+        action="store_true")
+    parser_batch.add_argument(
+        "-i", "--ignore_dependencies",
+        help="Ignore upstream and depends_on_past dependencies",
+        action="store_true")
+    parser_batch.add_argument(
+        "-c", "--concurrency", type=int,
+        help=(
+            "How many of the task instances run at once, in threads, "
+            "batch_concurrency from the config by default"))
+    parser_batch.set_defaults(func=run_batch)
+
     ht = (
         "Test a task instance. This will run a task without checking for "
         "dependencies or recording it's state in the database."
@@ -471,6 +727,23 @@ def get_parser():
     parser_scheduler.add_argument(
         "-sd", "--subdir", help=subdir_help,
         default=DAGS_FOLDER)
+    parser_scheduler.add_argument(
+        "-ed", "--event_driven",
+        help=(
+            "React to task instance completions as they happen instead of "
+            "waiting for the next heartbeat"),
+        action="store_true")
+    parser_scheduler.add_argument(
+        "-n", "--dag_processors", type=int,
+        help="Number of processes to shard the DAG evaluation across")
+    parser_scheduler.add_argument(
+        "-p", "--profile", type=int,
+        help=(
+            "Run the scheduler loop this many times under cProfile and "
+            "write the report sorted by cumulative time"))
+    parser_scheduler.add_argument(
+        "-po", "--profile_output", default="scheduler_profile.txt",
+        help="Where to write the report of --profile")
     parser_scheduler.set_defaults(func=scheduler)
 
     ht = "Initialize the metadata database"
@@ -504,6 +777,12 @@ def get_parser():
         default=conf.get('celery', 'DEFAULT_QUEUE'))
     parser_worker.set_defaults(func=worker)
 
+    ht = (
+        "Heartbeat all the task instances running on this host at once, "
+        "see heartbeat_agent in the [scheduler] section of the config")
+    parser_agent = subparsers.add_parser('heartbeat_agent', help=ht)
+    parser_agent.set_defaults(func=heartbeat_agent)
+
     ht = "Serve logs generate by worker"
     parser_logs = subparsers.add_parser('serve_logs', help=ht)
     parser_logs.set_defaults(func=serve_logs)
@@ -8,6 +8,15 @@ defaults = {
         'unit_test_mode': False,
         'parallelism': 32,
         'load_examples': True,
+        'max_active_runs_per_dag': 16,
+        'fork_server': False,
+        'queue_slots': '',
+        'threads': 256,
+        'thread_queues': '',
+        'batch_size': 1,
+        'batch_concurrency': 1,
+        'host_cpus': '',
+        'host_memory_mb': '',
     },
     'webserver': {
         'base_url': 'http://localhost:8080',
@@ -21,12 +30,22 @@ defaults = {
         'statsd_host': 'localhost',
         'statsd_port': 8125,
         'statsd_prefix': 'airflow',
+        'executor_metrics_port': '',
         'job_heartbeat_sec': 5,
         'scheduler_heartbeat_sec': 60,
+        'event_driven': False,
+        'dag_processors': 1,
+        'dag_processing_timeout': 300,
+        'heartbeat_agent': False,
         'authenticate': False,
     },
     'celery': {
         'default_queue': 'default',
+        'celery_events': False,
+    },
+    'database_executor': {
+        'worker_concurrency': 16,
+        'poll_interval': 1,
     },
 }
 
@@ -43,7 +62,8 @@ dags_folder = {AIRFLOW_HOME}/dags
 base_log_folder = {AIRFLOW_HOME}/logs
 
 # The executor class that airflow should use. Choices include
-# SequentialExecutor, LocalExecutor, CeleryExecutor
+# SequentialExecutor, LocalExecutor, CeleryExecutor, ThreadExecutor,
+# DatabaseExecutor
 executor = SequentialExecutor
 
 # The SqlAlchemy connection string to the metadata database.
@@ -56,6 +76,52 @@ sql_alchemy_conn = sqlite:///{AIRFLOW_HOME}/airflow.db
 # on this airflow installation
 parallelism = 32
 
+# How many task instances of a queue can run at once at most, as a comma
+# separated list of queue:slots pairs (for instance default:16,hive:4).
+# Task instances are handed to the executor in turn from each queue, so
+# that a flood on one queue doesn't hold back the others. Queues left out
+# are only limited by the parallelism
+queue_slots =
+
+# The maximum number of execution dates the scheduler keeps in flight for
+# a DAG, which is also how many schedules it catches up on in a single
+# pass when a DAG is behind. Backfills also only start that many schedules
+# at a time, the next ones as those complete. Can be overridden with the
+# DAG's max_active_runs parameter
+max_active_runs_per_dag = 16
+
+# Whether the LocalExecutor, the Celery workers and the task instances
+# fork the processes running task instances out of a process that has
+# airflow imported and the DAG files parsed already, instead of starting
+# new `airflow run` processes. Saves the interpreter startup and the
+# parsing of the DAG file on every task instance
+fork_server = False
+
+# How many threads the ThreadExecutor runs task instances in, and which
+# queues (comma separated) it runs in threads on top of the task instances
+# of the operators flagged with run_in_thread, sensors for instance.
+# These task instances don't count against the parallelism
+threads = 256
+thread_queues =
+
+# How many task instances of the same DAG and queue the executors hand over
+# together as a single "airflow run_batch" command, which runs them one
+# after the other in a single process instead of going through an
+# "airflow run" process chain for each. Pays off for DAGs of many short
+# tasks. Task instances run in a batch don't get a job, and so can't be
+# killed externally. 1 disables batching
+batch_size = 1
+
+# How many task instances of a batch run at once, in threads, read by
+# airflow run_batch on the host running the batch
+batch_concurrency = 1
+
+# The CPU cores and the memory in MB the LocalExecutor hands out to the
+# task instances whose operator declares the cpus or memory_mb it needs.
+# Detected from the host when left empty
+host_cpus =
+host_memory_mb =
+
 # Whether to load the examples that ship with Airflow. It's good to
 # get started, but you probably want to set this to False in a production
 # environment
@@ -120,6 +186,25 @@ flower_port = 8383
 # Default queue that tasks get assigned to and that worker listen on.
 default_queue = default
 
+# Whether the workers send task events that the executor listens to, to
+# learn about the tasks completing as they do instead of asking the result
+# backend about the states of all the tasks in flight on every heartbeat
+celery_events = False
+
+[database_executor]
+# This section only applies if you are using the DatabaseExecutor in
+# [core] section above. The workers started with "airflow worker" claim
+# the commands to run off a table of the metadata database, with SELECT
+# ... FOR UPDATE SKIP LOCKED on Postgres and MySQL 8. The workers listen
+# to the queues passed with -q, default_queue of [celery] by default
+
+# How many commands a worker runs at once
+worker_concurrency = 16
+
+# How often, in seconds, idle workers look for commands to run and the
+# executor for the commands that are done
+poll_interval = 1
+
 [scheduler]
 # Task instances listen for external kill signal (when you clear tasks
 # from the CLI or the UI), this defines the frequency at which they should
@@ -131,11 +216,40 @@ job_heartbeat_sec = 5
 # how often the scheduler should run (in seconds).
 scheduler_heartbeat_sec = 5
 
+# Whether the scheduler should react to task instances completing and to
+# schedules and retries coming due as they happen, as opposed to waiting
+# for its next heartbeat to notice them
+event_driven = False
+
+# The number of processes the scheduler shards the DAGs across when
+# evaluating them. With 1, the DAGs are evaluated one at a time in the
+# scheduler's own process
+dag_processors = 1
+
+# How long (in seconds) a DAG can take to be evaluated before the
+# scheduler gives up on it for the current run
+dag_processing_timeout = 300
+
+# Whether the task instances running on a host leave their heartbeats to a
+# heartbeat agent, which updates them all in a single query per
+# job_heartbeat_sec instead of one per task instance. The agent runs in
+# the LocalExecutor and in Celery workers, or on its own with
+# `airflow heartbeat_agent`. Task instances heartbeat on their own while
+# no agent is running
+heartbeat_agent = False
+
 # Statsd (https://github.com/etsy/statsd) integration settings
 # statsd_on =  False
 # statsd_host =  localhost
 # statsd_port =  8125
 # statsd_prefix = airflow
+
+# The port on which the processes running an executor, the scheduler and
+# backfills, serve how long task instances wait in the executor's queue,
+# how long they run and the open slots over time, as Prometheus text on
+# /metrics and as JSON on /metrics.json. The same figures go to statsd,
+# under executor.<executor>. Left empty, nothing is served
+executor_metrics_port =
 """
 
 TEST_CONFIG = """\
@@ -3,7 +3,9 @@ import logging
 from airflow.configuration import conf
 from airflow.executors.local_executor import LocalExecutor
 from airflow.executors.celery_executor import CeleryExecutor
+from airflow.executors.database_executor import DatabaseExecutor
 from airflow.executors.sequential_executor import SequentialExecutor
+from airflow.executors.thread_executor import ThreadExecutor
 
 _EXECUTOR = conf.get('core', 'EXECUTOR')
 
@@ -13,6 +15,10 @@ elif _EXECUTOR == 'CeleryExecutor':
     DEFAULT_EXECUTOR = CeleryExecutor()
 elif _EXECUTOR == 'SequentialExecutor':
     DEFAULT_EXECUTOR = SequentialExecutor()
+elif _EXECUTOR == 'ThreadExecutor':
+    DEFAULT_EXECUTOR = ThreadExecutor()
+elif _EXECUTOR == 'DatabaseExecutor':
+    DEFAULT_EXECUTOR = DatabaseExecutor()
 else:
     raise Exception("Executor {0} not supported.".format(_EXECUTOR))
 
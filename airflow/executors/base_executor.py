@@ -1,26 +1,82 @@
+from collections import defaultdict
+import heapq
+import itertools
 import logging
 
+from airflow import utils
 from airflow.utils import State
 from airflow.configuration import conf
+from airflow.executors import metrics
 
 PARALLELISM = conf.getint('core', 'PARALLELISM')
+BATCH_SIZE = conf.getint('core', 'BATCH_SIZE')
+
+
+def parse_queue_slots(value):
+    """
+    Parses the ``queue_slots`` setting, a comma separated list of
+    ``queue:slots`` pairs, into a dictionary
+
+    >>> sorted(parse_queue_slots('default:16, hive:4').items())
+    [('default', 16), ('hive', 4)]
+    """
+    slots = {}
+    for pair in value.split(','):
+        if pair.strip():
+            queue, n = pair.rsplit(':', 1)
+            slots[queue.strip()] = int(n)
+    return slots
+
+QUEUE_SLOTS = parse_queue_slots(conf.get('core', 'QUEUE_SLOTS'))
 
 
 class BaseExecutor(object):
 
-    def __init__(self, parallelism=PARALLELISM):
+    def __init__(
+            self, parallelism=PARALLELISM, queue_slots=None,
+            batch_size=BATCH_SIZE):
         """
         Class to derive in order to interface with executor-type systems
         like Celery, Mesos, Yarn and the likes.
 
+        The commands queued wait in a lane per queue, highest priority and
+        first queued first. Lanes take turns handing their commands over
+        as slots open, so that a flood of commands on one queue doesn't
+        hold back the others.
+
         :param parallelism: how many jobs should run at one time. Set to
             ``0`` for infinity
         :type parallelism: int
+        :param queue_slots: how many jobs of each queue should run at one
+            time at most, the ``queue_slots`` setting by default, counting
+            each of the task instances of a batch. Queues left out are
+            only limited by the parallelism
+        :type queue_slots: dict
+        :param batch_size: how many of the task instances of a DAG and
+            queue handed over in a heartbeat go together in a single
+            ``airflow run_batch`` command at most. Set to ``1`` to run
+            each in its own ``airflow run`` command
+        :type batch_size: int
         """
         self.parallelism = parallelism
+        self.queue_slots = (
+            QUEUE_SLOTS if queue_slots is None else queue_slots)
         self.queued_tasks = {}
         self.running = {}
         self.event_buffer = {}
+        # Heaps of (-priority, sequence, key) for each queue
+        self.lanes = defaultdict(list)
+        self.sequence = itertools.count()
+        self.next_lane = 0
+        self.running_queues = {}
+        self.running_by_queue = defaultdict(int)
+        self.batch_size = batch_size
+        # Batching details of the task instances queued, keyed by task
+        # instance key, and the keys of the batches, keyed by the key of
+        # their first task instance
+        self.batchable = {}
+        self.batches = {}
+        self.metrics = metrics.ExecutorMetrics(self.__class__.__name__)
 
     def start(self):  # pragma: no cover
         """
@@ -33,6 +89,9 @@ class BaseExecutor(object):
         if key not in self.queued_tasks and key not in self.running:
             logging.info("Adding to queue: " + command)
             self.queued_tasks[key] = (command, priority, queue)
+            self.metrics.queued(key, queue)
+            heapq.heappush(
+                self.lanes[queue], (-priority, next(self.sequence), key))
 
     def queue_task_instance(
             self, task_instance, mark_success=False, pickle_id=None,
@@ -43,6 +102,12 @@ class BaseExecutor(object):
             force=force,
             ignore_dependencies=ignore_dependencies,
             pickle_id=pickle_id)
+        dag = task_instance.task.dag
+        if self.batch_size > 1 and not pickle_id and dag and \
+                dag.full_filepath:
+            self.batchable[task_instance.key] = (
+                task_instance,
+                (mark_success, ignore_dependencies, force))
         self.queue_command(
             task_instance.key,
             command,
@@ -62,28 +127,197 @@ class BaseExecutor(object):
         self.sync()
 
         # Triggering new jobs
-        if not self.parallelism:
-            open_slots = len(self.queued_tasks)
-        else:
-            open_slots = self.parallelism - len(self.running)
+        open_slots = self.open_slots()
 
         logging.debug("{} running task instances".format(len(self.running)))
         logging.debug("{} in queue".format(len(self.queued_tasks)))
         logging.debug("{} open slots".format(open_slots))
 
-        sorted_queue = sorted(
-            [(k, v) for k, v in self.queued_tasks.items()],
-            key=lambda x: x[1][1],
-            reverse=True)
-        for i in range(min((open_slots, len(self.queued_tasks)))):
-            key, (command, priority, queue) = sorted_queue.pop(0)
+        launched = []
+        for key in self.pop_queued(open_slots):
+            command, priority, queue = self.queued_tasks.pop(key)
             self.running[key] = command
-            del self.queued_tasks[key]
+            self.running_queues[key] = queue
+            self.running_by_queue[queue] += 1
+            self.metrics.launched(key)
+            launched.append((key, command, queue))
+        for key, command, queue in self.batch(launched):
             self.execute_async(key, command=command, queue=queue)
 
+        queued = defaultdict(int)
+        for command, priority, queue in self.queued_tasks.values():
+            queued[queue] += 1
+        metrics.serve()
+        self.metrics.sample(
+            self.open_slots(), queued, self.running_by_queue,
+            self.queue_slots)
+
+    def batch(self, launched):
+        """
+        Groups the (key, command, queue) tuples of the task instances
+        launched that share their DAG, queue and flags into batches of up
+        to ``batch_size``, topped up with the task instances of the same
+        kind still queued, highest priority first. Returns the tuples to
+        execute, those of the batches being keyed by the key of their
+        first task instance.
+        """
+        groups = defaultdict(list)
+        commands = []
+        for key, command, queue in launched:
+            batchable = self.batchable.pop(key, None)
+            if batchable:
+                ti, flags = batchable
+                groups[(ti.dag_id, queue, flags)].append((key, command, ti))
+            else:
+                commands.append((key, command, queue))
+        if not groups:
+            return commands
+        queued = defaultdict(list)
+        for key, (ti, flags) in self.batchable.items():
+            command, priority, queue = self.queued_tasks[key]
+            group = (ti.dag_id, queue, flags)
+            if group in groups:
+                queued[group].append(
+                    ((-priority, ti.execution_date, ti.task_id), key))
+        for group, members in groups.items():
+            dag_id, queue, flags = group
+            extra = [key for _, key in sorted(queued[group])]
+            slots = self.queue_slots.get(queue)
+            for chunk in utils.chunks(members, self.batch_size):
+                while len(chunk) < self.batch_size and extra:
+                    # Batched task instances take the slot of their batch
+                    # but count against the slots of their queue
+                    if slots is not None and \
+                            self.running_by_queue[queue] >= slots:
+                        break
+                    key = extra.pop(0)
+                    if not self.reserve(key):
+                        continue
+                    command = self.queued_tasks.pop(key)[0]
+                    ti = self.batchable.pop(key)[0]
+                    self.running[key] = command
+                    self.running_queues[key] = queue
+                    self.running_by_queue[queue] += 1
+                    self.metrics.launched(key)
+                    chunk.append((key, command, ti))
+                key = chunk[0][0]
+                if len(chunk) == 1:
+                    commands.append((key, chunk[0][1], queue))
+                    continue
+                self.batches[key] = [member[0] for member in chunk]
+                command = self.batch_command(
+                    [member[2] for member in chunk], *flags)
+                commands.append((key, command, queue))
+        return commands
+
+    def batch_command(
+            self, task_instances, mark_success=False,
+            ignore_dependencies=False, force=False):
+        """
+        Returns the command running task instances of the same DAG in a
+        single process
+        """
+        dag = task_instances[0].task.dag
+        task_instances = " ".join(
+            "{}@{}".format(ti.task_id, ti.execution_date.isoformat())
+            for ti in task_instances)
+        return (
+            "airflow run_batch {dag_id} {task_instances} "
+            "{mark_success} {ignore_dependencies} {force} "
+            "-sd DAGS_FOLDER/{filepath} "
+        ).format(
+            dag_id=dag.dag_id,
+            task_instances=task_instances,
+            mark_success="--mark_success" if mark_success else "",
+            ignore_dependencies="-i" if ignore_dependencies else "",
+            force="--force" if force else "",
+            filepath=dag.filepath)
+
+    def open_slots(self):
+        """
+        Returns how many of the commands queued can be handed over now
+        """
+        if not self.parallelism:
+            return len(self.queued_tasks)
+        # A batch takes a single slot
+        batched = sum(len(keys) - 1 for keys in self.batches.values())
+        return self.parallelism - len(self.running) + batched
+
+    def pop_queued(self, open_slots):
+        """
+        Pops the keys of up to ``open_slots`` queued commands, taking one
+        from each lane in turn as long as its queue has slots left, and
+        skipping ahead of the commands that can't run now
+        """
+        lanes = sorted(
+            (queue for queue, lane in self.lanes.items() if lane),
+            key=str)
+        if lanes:
+            # Starting with a different lane on every heartbeat
+            start = self.next_lane % len(lanes)
+            lanes = lanes[start:] + lanes[:start]
+            self.next_lane += 1
+        keys = []
+        popped = set()
+        taken = defaultdict(int)
+        skipped = []
+        while lanes and len(keys) < open_slots:
+            for queue in list(lanes):
+                if len(keys) >= open_slots:
+                    break
+                lane = self.lanes[queue]
+                slots = self.queue_slots.get(queue)
+                if slots is not None and (
+                        self.running_by_queue[queue] + taken[queue] >=
+                        slots):
+                    lanes.remove(queue)
+                    continue
+                key = None
+                while lane and key is None:
+                    entry = heapq.heappop(lane)
+                    key = entry[2]
+                    if key not in self.queued_tasks or key in popped:
+                        key = None
+                    elif not self.reserve(key):
+                        # Skipping ahead to what can run now
+                        skipped.append((queue, entry))
+                        key = None
+                if key is None:
+                    lanes.remove(queue)
+                    del self.lanes[queue]
+                    continue
+                keys.append(key)
+                popped.add(key)
+                taken[queue] += 1
+        for queue, entry in skipped:
+            heapq.heappush(self.lanes[queue], entry)
+        return keys
+
+    def reserve(self, key):
+        """
+        Returns whether the command of ``key`` can run now, setting aside
+        what it needs if so. Executors that keep track of resources
+        override this along with ``release``
+        """
+        return True
+
+    def release(self, key):
+        """
+        Gives back what the command of ``key`` set aside when it ran
+        """
+        pass
+
     def change_state(self, key, state):
-        del self.running[key]
-        self.event_buffer[key] = state
+        # The state of a batch goes to all of its task instances
+        for key in self.batches.pop(key, [key]):
+            del self.running[key]
+            if key in self.running_queues:
+                queue = self.running_queues.pop(key)
+                if self.running_by_queue[queue] > 0:
+                    self.running_by_queue[queue] -= 1
+            self.metrics.finished(key)
+            self.release(key)
+            self.event_buffer[key] = state
 
     def fail(self, key):
         self.change_state(key, State.FAILED)
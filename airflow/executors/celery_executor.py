@@ -1,12 +1,17 @@
 import logging
+import Queue
 import subprocess
+import threading
 import time
 
 from celery import Celery
 from celery import states as celery_states
+from celery.backends.database import DatabaseBackend
+from celery.backends.database.models import Task as TaskMeta
 
 from airflow.executors.base_executor import BaseExecutor
 from airflow.configuration import conf
+from airflow import utils
 
 PARALLELISM = conf.get('core', 'PARALLELISM')
 
@@ -16,6 +21,14 @@ airflow worker
 '''
 
 DEFAULT_QUEUE = conf.get('celery', 'DEFAULT_QUEUE')
+CELERY_EVENTS = conf.getboolean('celery', 'CELERY_EVENTS')
+
+# States of the Celery tasks the events of the workers report
+EVENT_STATES = {
+    'task-succeeded': celery_states.SUCCESS,
+    'task-failed': celery_states.FAILURE,
+    'task-revoked': celery_states.REVOKED,
+}
 
 
 class CeleryConfig(object):
@@ -26,16 +39,26 @@ class CeleryConfig(object):
     CELERY_RESULT_BACKEND = conf.get('celery', 'CELERY_RESULT_BACKEND')
     CELERYD_CONCURRENCY = conf.getint('celery', 'CELERYD_CONCURRENCY')
     CELERY_DEFAULT_QUEUE = DEFAULT_QUEUE
+    CELERY_SEND_EVENTS = CELERY_EVENTS
 
 app = Celery(
     conf.get('celery', 'CELERY_APP_NAME'),
     config_source=CeleryConfig)
 
 
+fork_server = None
+if conf.getboolean('core', 'fork_server'):
+    from airflow.executors.fork_server import ForkServer
+    fork_server = ForkServer()
+
+
 @app.task
 def execute_command(command):
     logging.info("Executing command in Celery " + command)
-    rc = subprocess.Popen(command, shell=True).wait()
+    if fork_server:
+        rc = fork_server.run(command)
+    else:
+        rc = subprocess.Popen(command, shell=True).wait()
     if rc:
         logging.error(rc)
         raise Exception('Celery command failed')
@@ -49,41 +72,105 @@ class CeleryExecutor(BaseExecutor):
     Celery is a simple, flexible and reliable distributed system to process
     vast amounts of messages, while providing operations with the tools
     required to maintain such a system.
+
+    The states of the Celery tasks are fetched in bulk, in a query per
+    chunk of tasks with a database result backend. With ``celery_events``
+    on, the executor also listens to the task events of the workers in a
+    background thread and only fetches the states of all the tasks every
+    ``EVENTS_FETCH_EVERY`` syncs, in case some events were missed.
     """
 
+    EVENTS_FETCH_EVERY = 10
+
     def start(self):
         self.tasks = {}
         self.last_state = {}
+        self.keys_by_id = {}
+        self.events = None
+        self.receiver = None
+        self.syncs = 0
+        if CELERY_EVENTS:
+            self.events = Queue.Queue()
+            thread = threading.Thread(target=self.listen)
+            thread.daemon = True
+            thread.start()
 
     def execute_async(self, key, command, queue=DEFAULT_QUEUE):
         self.tasks[key] = execute_command.apply_async(
             args=[command], queue=queue)
         self.last_state[key] = celery_states.PENDING
+        self.keys_by_id[self.tasks[key].id] = key
+
+    def listen(self):
+        """
+        Buffers the states the task events of the workers report
+        """
+        def on_event(event):
+            self.events.put((event['uuid'], EVENT_STATES[event['type']]))
+
+        handlers = {event_type: on_event for event_type in EVENT_STATES}
+        while True:
+            try:
+                with app.connection() as connection:
+                    self.receiver = app.events.Receiver(
+                        connection, handlers=handlers)
+                    self.receiver.capture(limit=None, timeout=None)
+                    return
+            except Exception as e:
+                logging.exception(e)
+                time.sleep(5)
+
+    def get_states(self):
+        """
+        Returns the states of all the Celery tasks in flight, keyed by task
+        instance key
+        """
+        if not isinstance(app.backend, DatabaseBackend):
+            return {key: async.state for key, async in self.tasks.items()}
+        states = {key: celery_states.PENDING for key in self.tasks}
+        ids = sorted(async.id for async in self.tasks.values())
+        session = app.backend.ResultSession()
+        try:
+            for chunk in utils.chunks(ids):
+                qry = session.query(TaskMeta.task_id, TaskMeta.status).filter(
+                    TaskMeta.task_id.in_(chunk))
+                for task_id, status in qry:
+                    states[self.keys_by_id[task_id]] = status
+        finally:
+            session.close()
+        return states
 
     def sync(self):
         logging.debug(
             "Inquiring about {} celery task(s)".format(len(self.tasks)))
-        for key, async in self.tasks.items():
-            state = async.state
-            if self.last_state[key] != state:
-                if state == celery_states.SUCCESS:
-                    self.success(key)
-                    del self.tasks[key]
-                    del self.last_state[key]
-                elif state == celery_states.FAILURE:
-                    self.fail(key)
-                    del self.tasks[key]
-                    del self.last_state[key]
-                elif state == celery_states.REVOKED:
-                    self.fail(key)
-                    del self.tasks[key]
-                    del self.last_state[key]
-                else:
-                    logging.info("Unexpected state: " + async.state)
-                self.last_state[key] = async.state
+        self.syncs += 1
+        if self.events is None or not self.syncs % self.EVENTS_FETCH_EVERY:
+            states = self.get_states()
+        else:
+            states = {}
+        while self.events is not None and not self.events.empty():
+            task_id, state = self.events.get()
+            if task_id in self.keys_by_id:
+                states[self.keys_by_id[task_id]] = state
+        for key, state in states.items():
+            if key not in self.tasks or self.last_state[key] == state:
+                continue
+            if state == celery_states.SUCCESS:
+                self.success(key)
+            elif state in (celery_states.FAILURE, celery_states.REVOKED):
+                self.fail(key)
+            else:
+                logging.info("Unexpected state: " + state)
+                self.last_state[key] = state
+                continue
+            del self.keys_by_id[self.tasks[key].id]
+            del self.tasks[key]
+            del self.last_state[key]
 
     def end(self):
-        while any([
-                async.state not in celery_states.READY_STATES
-                for async in self.tasks.values()]):
+        while any(
+                state not in celery_states.READY_STATES
+                for state in self.get_states().values()):
             time.sleep(5)
+        if self.receiver:
+            self.receiver.should_stop = True
@@ -0,0 +1,139 @@
+import logging
+import socket
+import subprocess
+import time
+from uuid import uuid4
+
+from airflow import settings
+from airflow import utils
+from airflow.configuration import conf
+from airflow.executors.base_executor import BaseExecutor
+from airflow.utils import State
+
+'''
+To start the workers, run "airflow worker" with the DatabaseExecutor set
+as the executor in the config, on as many hosts as needed.
+'''
+
+WORKER_CONCURRENCY = conf.getint('database_executor', 'WORKER_CONCURRENCY')
+POLL_INTERVAL = conf.getfloat('database_executor', 'POLL_INTERVAL')
+
+
+def heartbeat_timeout():
+    """
+    Seconds after which a command whose worker stopped heartbeating is
+    considered failed
+    """
+    return conf.getint('scheduler', 'JOB_HEARTBEAT_SEC') * 2.1
+
+
+class DatabaseExecutor(BaseExecutor):
+    """
+    DatabaseExecutor distributes the commands over workers through a queue
+    table of the metadata database, so it needs no broker. The commands
+    handed over in a heartbeat are inserted at once, and the states of the
+    commands the workers are done with come back in a single query.
+    """
+
+    def start(self):
+        self.executor_id = uuid4().hex
+        self.priorities = {}
+        self.to_enqueue = []
+
+    def queue_command(self, key, command, priority=1, queue=None):
+        self.priorities[key] = priority
+        super(DatabaseExecutor, self).queue_command(
+            key, command, priority=priority, queue=queue)
+
+    def execute_async(self, key, command, queue=None):
+        for member in self.batches.get(key, [])[1:]:
+            self.priorities.pop(member, None)
+        self.to_enqueue.append((
+            key, command, self.priorities.pop(key, 1),
+            queue or conf.get('celery', 'DEFAULT_QUEUE')))
+
+    def heartbeat(self):
+        super(DatabaseExecutor, self).heartbeat()
+        self.flush()
+
+    def flush(self):
+        from airflow.models import QueuedCommand
+        if self.to_enqueue:
+            QueuedCommand.enqueue(self.executor_id, self.to_enqueue)
+            self.to_enqueue = []
+
+    def sync(self):
+        from airflow.models import QueuedCommand
+        states = QueuedCommand.collect(self.executor_id, heartbeat_timeout())
+        for key, state in states.items():
+            if key in self.running:
+                self.change_state(key, state)
+
+    def end(self):
+        self.heartbeat()
+        while self.running or self.queued_tasks:
+            time.sleep(POLL_INTERVAL)
+            self.heartbeat()
+
+
+class DatabaseWorker(object):
+    """
+    Claims the commands queued on ``queues`` and runs up to
+    ``concurrency`` of them at once, recording how each went and
+    heartbeating the running ones for the executor.
+    """
+    def __init__(
+            self, queues, concurrency=WORKER_CONCURRENCY,
+            poll_interval=POLL_INTERVAL):
+        self.queues = queues
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.hostname = socket.gethostname()
+        self.processes = {}
+        self.last_heartbeat = time.time()
+
+    def heartbeat(self):
+        """
+        Records the commands that are done and claims new ones, returns how
+        many were claimed
+        """
+        from airflow.models import QueuedCommand
+        states = {}
+        for id_, process in self.processes.items():
+            returncode = process.poll()
+            if returncode is not None:
+                states[id_] = (
+                    State.SUCCESS if returncode == 0 else State.FAILED)
+        if states:
+            QueuedCommand.finish(states)
+            # Only forgotten once recorded, to try again otherwise
+            for id_ in states:
+                del self.processes[id_]
+        if self.processes and (
+                time.time() - self.last_heartbeat >=
+                conf.getint('scheduler', 'JOB_HEARTBEAT_SEC')):
+            QueuedCommand.heartbeat(list(self.processes))
+            self.last_heartbeat = time.time()
+        open_slots = self.concurrency - len(self.processes)
+        claimed = []
+        if open_slots > 0:
+            claimed = QueuedCommand.claim(
+                self.queues, open_slots, self.hostname)
+        for id_, command in claimed:
+            logging.info("Running " + command)
+            self.processes[id_] = subprocess.Popen(command, shell=True)
+        return len(claimed)
+
+    def run(self):
+        utils.pessimistic_connection_handling()
+        while True:
+            try:
+                claimed = self.heartbeat()
+            except Exception as e:
+                # The commands running keep being supervised, the database
+                # being locked or unreachable for a while
+                logging.exception(e)
+                settings.Session().rollback()
+                claimed = 0
+            if not claimed:
+                time.sleep(self.poll_interval)
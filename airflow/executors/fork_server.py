@@ -0,0 +1,65 @@
+import logging
+import multiprocessing
+import shlex
+import subprocess
+
+from airflow import settings
+
+
+class ForkServer(object):
+    """
+    Runs the ``airflow run`` commands the executors are handed in a child
+    process forked from the current one instead of a new interpreter, so
+    that the task instances don't pay for importing airflow and parsing
+    their DAG file. The DAG files parsed are kept around and parsed again
+    when they change.
+
+    Commands that aren't ``airflow run`` commands, or that load their DAG
+    from a pickle, run in a shell as usual.
+    """
+    def __init__(self):
+        self.dagbags = {}
+
+    def get_dag(self, subdir, dag_id):
+        """
+        Returns a DAG out of the DagBag of ``subdir``, parsing its file
+        again if it changed, or None if it can't be found
+        """
+        from airflow.models import DagBag
+        dagbag = self.dagbags.get(subdir)
+        if dagbag is None:
+            dagbag = self.dagbags[subdir] = DagBag(subdir)
+        elif dag_id in dagbag.dags:
+            dagbag.process_file(dagbag.dags[dag_id].full_filepath)
+        else:
+            dagbag.collect_dags(dagbag.dag_folder)
+        return dagbag.dags.get(dag_id)
+
+    def run(self, command):
+        """
+        Runs a command and returns its exit code
+        """
+        from airflow.bin import cli
+        argv = shlex.split(command)
+        try:
+            args = cli.get_parser().parse_args(argv[1:])
+        except SystemExit:
+            args = None
+        if argv[0] != 'airflow' or not args or args.func is not cli.run:
+            return subprocess.Popen(command, shell=True).wait()
+        dag = None
+        if not args.pickle:
+            dag = self.get_dag(cli.process_subdir(args.subdir), args.dag_id)
+        process = multiprocessing.Process(target=self._run, args=(args, dag))
+        process.start()
+        process.join()
+        return process.exitcode
+
+    @staticmethod
+    def _run(args, dag):
+        # Forked, not touching the connections of the parent's pool
+        settings.Session.registry.clear()
+        settings.engine.pool = settings.engine.pool.recreate()
+        logging.root.handlers = []
+        from airflow.bin import cli
+        cli.run(args, dag=dag)
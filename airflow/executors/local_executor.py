@@ -1,5 +1,6 @@
 import logging
 import multiprocessing
+import os
 import subprocess
 import time
 
@@ -7,7 +8,28 @@ from airflow.configuration import conf
 from airflow.executors.base_executor import BaseExecutor
 from airflow.utils import State
 
-PARALLELISM = conf.get('core', 'PARALLELISM')
+PARALLELISM = conf.getint('core', 'PARALLELISM')
+
+
+def host_resources():
+    """
+    Returns the CPU cores and the memory in MB of the host, as set by
+    ``host_cpus`` and ``host_memory_mb`` or as detected otherwise. The
+    memory is None when it can't be detected
+    """
+    cpus = conf.get('core', 'HOST_CPUS')
+    cpus = float(cpus) if cpus else multiprocessing.cpu_count()
+    memory_mb = conf.get('core', 'HOST_MEMORY_MB')
+    if memory_mb:
+        memory_mb = int(memory_mb)
+    else:
+        try:
+            memory_mb = (
+                os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') //
+                (1024 * 1024))
+        except (AttributeError, ValueError, OSError):
+            memory_mb = None
+    return cpus, memory_mb
 
 
 class LocalWorker(multiprocessing.Process):
@@ -18,6 +40,10 @@ class LocalWorker(multiprocessing.Process):
         self.result_queue = result_queue
 
     def run(self):
+        fork_server = None
+        if conf.getboolean('core', 'fork_server'):
+            from airflow.executors.fork_server import ForkServer
+            fork_server = ForkServer()
         while True:
             key, command = self.task_queue.get()
             if key is None:
@@ -25,9 +51,12 @@ class LocalWorker(multiprocessing.Process):
                 self.task_queue.task_done()
                 break
             logging.info("%s running %s", self.__class__.__name__, command)
-            command = "exec bash -c '{0}'".format(command)
             try:
-                subprocess.Popen(command, shell=True).wait()
+                if fork_server:
+                    fork_server.run(command)
+                else:
+                    command = "exec bash -c '{0}'".format(command)
+                    subprocess.Popen(command, shell=True).wait()
                 state = State.SUCCESS
             except Exception as e:
                 state = State.FAILED
@@ -43,8 +72,65 @@ class LocalExecutor(BaseExecutor):
     LocalExecutor executes tasks locally in parallel. It uses the
     multiprocessing Python library and queues to parallelize the execution
     of tasks.
+
+    Task instances whose operator declares the CPU cores (``cpus``) or the
+    memory (``memory_mb``) it needs only run while what's left of the host
+    covers it, the task instances queued behind that fit going first. A
+    task instance needing more than the host has runs once no other
+    declared task instance is running.
     """
 
+    def __init__(
+            self, parallelism=PARALLELISM, host_cpus=None,
+            host_memory_mb=None, *args, **kwargs):
+        super(LocalExecutor, self).__init__(
+            parallelism=parallelism, *args, **kwargs)
+        cpus, memory_mb = host_resources()
+        self.host_cpus = host_cpus or cpus
+        self.host_memory_mb = host_memory_mb or memory_mb
+        # (cpus, memory_mb) keyed by task instance key
+        self.requests = {}
+        self.reserved = {}
+        self.used_cpus = 0
+        self.used_memory_mb = 0
+
+    def queue_task_instance(
+            self, task_instance, mark_success=False, pickle_id=None,
+            force=False, ignore_dependencies=False):
+        task = task_instance.task
+        cpus = getattr(task, 'cpus', None) or 0
+        memory_mb = getattr(task, 'memory_mb', None) or 0
+        if cpus or memory_mb:
+            self.requests[task_instance.key] = (cpus, memory_mb)
+        super(LocalExecutor, self).queue_task_instance(
+            task_instance, mark_success=mark_success, pickle_id=pickle_id,
+            force=force, ignore_dependencies=ignore_dependencies)
+
+    def reserve(self, key):
+        if key not in self.requests:
+            return True
+        cpus, memory_mb = self.requests[key]
+        fits = self.used_cpus + cpus <= self.host_cpus and (
+            self.host_memory_mb is None or
+            self.used_memory_mb + memory_mb <= self.host_memory_mb)
+        if not fits:
+            if self.reserved:
+                return False
+            logging.warning(
+                "{} needs more than the host has, running it alone".format(
+                    key))
+        self.reserved[key] = self.requests.pop(key)
+        self.used_cpus += cpus
+        self.used_memory_mb += memory_mb
+        return True
+
+    def release(self, key):
+        self.requests.pop(key, None)
+        if key in self.reserved:
+            cpus, memory_mb = self.reserved.pop(key)
+            self.used_cpus -= cpus
+            self.used_memory_mb -= memory_mb
+
     def start(self):
         self.queue = multiprocessing.JoinableQueue()
         self.result_queue = multiprocessing.Queue()
@@ -56,6 +142,13 @@ class LocalExecutor(BaseExecutor):
         for w in self.workers:
             w.start()
 
+        # Started once the workers are forked, they don't inherit its thread
+        self.agent = None
+        if conf.getboolean('scheduler', 'heartbeat_agent'):
+            from airflow.jobs import HeartbeatAgent
+            self.agent = HeartbeatAgent()
+            self.agent.start()
+
     def execute_async(self, key, command, queue=None):
         self.queue.put((key, command))
 
@@ -69,3 +162,5 @@ class LocalExecutor(BaseExecutor):
         [self.queue.put((None, None)) for w in self.workers]
         # Wait for commands to finish
         self.queue.join()
+        if self.agent:
+            self.agent.stop()
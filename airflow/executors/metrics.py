@@ -0,0 +1,210 @@
+import atexit
+import BaseHTTPServer
+from collections import defaultdict
+import json
+import logging
+import threading
+import time
+import weakref
+
+from airflow import settings
+from airflow.configuration import conf
+
+# The metrics of all the executors of the process, served on the
+# executor_metrics_port
+REGISTRY = weakref.WeakSet()
+_serving = False
+
+
+class ExecutorMetrics(object):
+    """
+    Times the task instances an executor is handed, from the moment they
+    get queued to when the executor hands them over (``queue_wait``), and
+    from then on to when the executor hears they completed
+    (``run_time``), and samples the open slots and the task instances
+    queued and running on every heartbeat, for each queue.
+
+    Timings are sent to statsd when ``statsd_on`` is set, and kept as a
+    count, a sum and a max for the Prometheus text and JSON served on the
+    ``executor_metrics_port``.
+    """
+    def __init__(self, executor):
+        self.executor = executor
+        self.queued_at = {}
+        self.started_at = {}
+        # [count, sum, max] keyed by (name, queue)
+        self.timings = defaultdict(lambda: [0, 0.0, 0.0])
+        # Keyed by (name, queue)
+        self.gauges = {}
+        self.lock = threading.Lock()
+        REGISTRY.add(self)
+
+    def queued(self, key, queue):
+        self.queued_at[key] = (time.time(), queue)
+
+    def launched(self, key):
+        if key in self.queued_at:
+            queued_at, queue = self.queued_at.pop(key)
+            now = time.time()
+            self.started_at[key] = (now, queue)
+            self.timing('queue_wait', queue, now - queued_at)
+
+    def finished(self, key):
+        if key in self.started_at:
+            started_at, queue = self.started_at.pop(key)
+            self.timing('run_time', queue, time.time() - started_at)
+
+    def timing(self, name, queue, seconds):
+        # Overall and for the queue
+        labels = set([(name, None), (name, queue)])
+        with self.lock:
+            for label in labels:
+                timing = self.timings[label]
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+        if settings.statsd:
+            for label in labels:
+                settings.statsd.timing(self.stat(*label), seconds * 1000)
+
+    def gauge(self, name, queue, value):
+        with self.lock:
+            self.gauges[(name, queue)] = value
+        if settings.statsd:
+            settings.statsd.gauge(self.stat(name, queue), value)
+
+    def sample(self, open_slots, queued, running, queue_slots):
+        """
+        Records the open slots of the executor and the numbers of task
+        instances queued and running, keyed by queue
+        """
+        self.gauge('open_slots', None, open_slots)
+        self.gauge('queued', None, sum(queued.values()))
+        self.gauge('running', None, sum(running.values()))
+        for queue in set(queued) | set(running) | set(queue_slots):
+            self.gauge('queued', queue, queued.get(queue, 0))
+            self.gauge('running', queue, running.get(queue, 0))
+            if queue in queue_slots:
+                self.gauge(
+                    'open_slots', queue,
+                    max(queue_slots[queue] - running.get(queue, 0), 0))
+
+    def stat(self, name, queue=None):
+        stat = 'executor.{}.{}'.format(self.executor, name)
+        if queue is not None:
+            stat += '.' + str(queue)
+        return stat
+
+    def as_dict(self):
+        with self.lock:
+            timings = [{
+                'name': name,
+                'queue': queue,
+                'count': count,
+                'sum': total,
+                'max': longest,
+            } for (name, queue), (count, total, longest)
+                in sorted(self.timings.items())]
+            gauges = [{
+                'name': name,
+                'queue': queue,
+                'value': value,
+            } for (name, queue), value in sorted(self.gauges.items())]
+        return {
+            'executor': self.executor,
+            'timings': timings,
+            'gauges': gauges,
+        }
+
+
+def _labels(metrics, queue):
+    labels = [('executor', metrics['executor'])]
+    if queue is not None:
+        labels.append(('queue', queue))
+    return ','.join(
+        '{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels)
+
+
+def as_prometheus():
+    """
+    Returns the metrics of all the executors of the process in the
+    Prometheus text format
+    """
+    lines = []
+    all_metrics = [metrics.as_dict() for metrics in list(REGISTRY)]
+    for name in ('queue_wait', 'run_time'):
+        metric = 'airflow_executor_{}_seconds'.format(name)
+        lines.append('# TYPE {} summary'.format(metric))
+        for metrics in all_metrics:
+            for timing in metrics['timings']:
+                if timing['name'] != name:
+                    continue
+                labels = _labels(metrics, timing['queue'])
+                lines.append('{}_count{{{}}} {}'.format(
+                    metric, labels, timing['count']))
+                lines.append('{}_sum{{{}}} {}'.format(
+                    metric, labels, timing['sum']))
+    for name in ('open_slots', 'queued', 'running'):
+        metric = 'airflow_executor_' + name
+        lines.append('# TYPE {} gauge'.format(metric))
+        for metrics in all_metrics:
+            for gauge in metrics['gauges']:
+                if gauge['name'] == name:
+                    lines.append('{}{{{}}} {}'.format(
+                        metric, _labels(metrics, gauge['queue']),
+                        gauge['value']))
+    return '\n'.join(lines) + '\n'
+
+
+def as_json():
+    return json.dumps([metrics.as_dict() for metrics in list(REGISTRY)])
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = as_prometheus()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = as_json()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve(port=None):
+    """
+    Serves the metrics of the executors of the process on ``/metrics``
+    (Prometheus) and ``/metrics.json`` from a daemon thread, once per
+    process, if ``executor_metrics_port`` is set
+    """
+    global _serving
+    port = port or conf.get('scheduler', 'EXECUTOR_METRICS_PORT')
+    if _serving or not port:
+        return
+    # Not trying again on every heartbeat if the port is taken
+    _serving = True
+    try:
+        server = BaseHTTPServer.HTTPServer(('', int(port)), MetricsHandler)
+    except Exception as e:
+        logging.error(
+            "Couldn't serve the executor metrics on port {}: {}".format(
+                port, e))
+        return
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    atexit.register(server.shutdown)
+    return server
@@ -0,0 +1,237 @@
+import ctypes
+from datetime import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import thread
+import time
+
+from airflow import settings
+from airflow import utils
+from airflow.configuration import conf
+from airflow.executors.local_executor import LocalExecutor
+from airflow.executors.base_executor import PARALLELISM
+from airflow.utils import State
+
+THREADS = conf.getint('core', 'THREADS')
+THREAD_QUEUES = [
+    queue.strip() for queue in conf.get('core', 'THREAD_QUEUES').split(',')
+    if queue.strip()]
+
+
+class TaskKilled(Exception):
+    """
+    Raised in the thread of a task instance whose job was shut down
+    """
+
+
+class ThreadLogHandler(logging.Handler):
+    """
+    Hands the records logged by the threads running task instances over
+    to the handler writing the log file of their task instance
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.handlers = {}
+
+    def emit(self, record):
+        handler = self.handlers.get(record.thread)
+        if handler:
+            handler.handle(record)
+
+
+def task_log_handler(task_instance):
+    """
+    Returns a handler writing to the log file of a task instance
+    """
+    directory = os.path.join(
+        os.path.expanduser(conf.get('core', 'BASE_LOG_FOLDER')),
+        task_instance.dag_id, task_instance.task_id)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    handler = logging.FileHandler(os.path.join(
+        directory, task_instance.execution_date.isoformat()))
+    handler.setFormatter(logging.Formatter(settings.LOG_FORMAT))
+    return handler
+
+
+class ThreadExecutor(LocalExecutor):
+    """
+    ThreadExecutor runs the task instances that spend their time waiting on
+    other systems, sensors typically, in a pool of threads of its own
+    process rather than in a process each, so that a single host can keep
+    thousands of them going. The task instances of the queues listed in
+    ``thread_queues``, and those of the operators whose ``run_in_thread``
+    attribute is set, run in threads. They don't take any of the slots of
+    the ``parallelism``, the other task instances run as they would with
+    the LocalExecutor.
+
+    Each task instance running in a thread gets its job and log file as it
+    would in its own process. The executor heartbeats their jobs in bulk,
+    and when one of them is shut down externally, calls the ``on_kill``
+    method of its task and raises ``TaskKilled`` in its thread.
+    """
+
+    def __init__(
+            self, parallelism=PARALLELISM, threads=THREADS,
+            thread_queues=None, *args, **kwargs):
+        super(ThreadExecutor, self).__init__(
+            parallelism=parallelism, *args, **kwargs)
+        self.threads = threads
+        self.thread_queues = set(
+            THREAD_QUEUES if thread_queues is None else thread_queues)
+        # Keyed by task instance key
+        self.thread_queued = {}
+        self.threaded = {}
+        self.last_job_heartbeat = None
+
+    def runs_in_thread(self, task_instance):
+        task = task_instance.task
+        return task.run_in_thread or task.queue in self.thread_queues
+
+    def start(self):
+        # Forking the workers before starting any thread
+        super(ThreadExecutor, self).start()
+        self.pool = ThreadPool(self.threads)
+        self.log_handler = ThreadLogHandler()
+        logging.root.addHandler(self.log_handler)
+
+    def queue_task_instance(
+            self, task_instance, mark_success=False, pickle_id=None,
+            force=False, ignore_dependencies=False):
+        if not self.runs_in_thread(task_instance):
+            return super(ThreadExecutor, self).queue_task_instance(
+                task_instance, mark_success=mark_success,
+                pickle_id=pickle_id, force=force,
+                ignore_dependencies=ignore_dependencies)
+        from airflow.models import TaskInstance
+        key = task_instance.key
+        if key not in self.thread_queued and key not in self.running:
+            logging.info("Adding to thread queue: {}".format(task_instance))
+            # The caller may keep refreshing its own copy meanwhile
+            ti = TaskInstance(
+                task_instance.task, task_instance.execution_date)
+            self.metrics.queued(key, task_instance.task.queue)
+            self.thread_queued[key] = (ti, {
+                'mark_success': mark_success,
+                'force': force,
+                'ignore_dependencies': ignore_dependencies,
+            })
+
+    def open_slots(self):
+        return super(ThreadExecutor, self).open_slots() + len(self.threaded)
+
+    def heartbeat(self):
+        queued = sorted(
+            self.thread_queued.items(),
+            key=lambda item: -item[1][0].task.priority_weight_total)
+        self.thread_queued = {}
+        for key, (ti, kwargs) in queued:
+            self.running[key] = str(ti)
+            # Job and thread ids are filled in once the thread started
+            self.threaded[key] = [ti, None, None]
+            self.metrics.launched(key)
+            self.pool.apply_async(self.run_thread, (key, ti, kwargs))
+        heartrate = conf.getint('scheduler', 'JOB_HEARTBEAT_SEC')
+        now = datetime.now()
+        if not self.last_job_heartbeat or (
+                (now - self.last_job_heartbeat).total_seconds() >=
+                heartrate):
+            self.last_job_heartbeat = now
+            self.heartbeat_jobs()
+        super(ThreadExecutor, self).heartbeat()
+
+    def heartbeat_jobs(self):
+        """
+        Updates the heartbeat of the jobs of the task instances running in
+        threads, and kills those that were shut down externally
+        """
+        from airflow.jobs import BaseJob
+        running = dict(
+            (job_id, key) for key, (ti, job_id, thread_id)
+            in self.threaded.items() if job_id)
+        if not running:
+            return
+        session = settings.Session()
+        shutdown = []
+        for ids in utils.chunks(sorted(running)):
+            session.query(BaseJob).filter(BaseJob.id.in_(ids)).update(
+                {BaseJob.latest_heartbeat: datetime.now()},
+                synchronize_session=False)
+            shutdown += [
+                job.id for job in session.query(BaseJob.id).filter(
+                    BaseJob.id.in_(ids),
+                    BaseJob.state == State.SHUTDOWN)]
+        session.commit()
+        session.close()
+        for job_id in shutdown:
+            self.kill(running[job_id])
+
+    def kill(self, key):
+        ti, job_id, thread_id = self.threaded[key]
+        if not thread_id:
+            return
+        logging.error("Killing {} running in a thread".format(ti))
+        try:
+            ti.task.on_kill()
+        except Exception as e:
+            logging.exception(e)
+        # Raised as soon as the thread runs Python code again
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_long(thread_id), ctypes.py_object(TaskKilled))
+
+    def run_thread(self, key, ti, kwargs):
+        from airflow.jobs import BaseJob, LocalTaskJob
+        thread_id = thread.get_ident()
+        job_id = handler = None
+        # Whatever goes wrong, the executor hears back about the key
+        state = State.FAILED
+        try:
+            session = settings.Session()
+            job = LocalTaskJob(task_instance=ti, executor=self, **kwargs)
+            job.state = State.RUNNING
+            session.add(job)
+            session.commit()
+            job_id = job.id
+            session.close()
+
+            handler = task_log_handler(ti)
+            self.log_handler.handlers[thread_id] = handler
+            self.threaded[key][1:] = [job_id, thread_id]
+            ti.run(job_id=job_id, **kwargs)
+            state = State.SUCCESS
+        except Exception as e:
+            logging.error("{} failed: {}".format(ti, repr(e)))
+        finally:
+            self.threaded[key][1:] = [None, None]
+            if handler:
+                del self.log_handler.handlers[thread_id]
+                handler.close()
+            try:
+                session = settings.Session()
+                if job_id:
+                    session.query(BaseJob).filter(
+                        BaseJob.id == job_id
+                    ).update({
+                        BaseJob.state: State.SUCCESS,
+                        BaseJob.end_date: datetime.now(),
+                    }, synchronize_session=False)
+                    session.commit()
+                session.close()
+            except Exception as e:
+                logging.exception(e)
+                session.rollback()
+            self.result_queue.put((key, state))
+
+    def change_state(self, key, state):
+        self.threaded.pop(key, None)
+        super(ThreadExecutor, self).change_state(key, state)
+
+    def end(self):
+        while self.threaded or self.thread_queued:
+            self.heartbeat()
+            time.sleep(1)
+        super(ThreadExecutor, self).end()
+        self.pool.close()
+        self.pool.join()
+        logging.root.removeHandler(self.log_handler)
@@ -1,19 +1,29 @@
 from collections import defaultdict
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import errno
 import getpass
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
+import os
 import signal
 import subprocess
 import sys
+import threading
+import time
 from time import sleep
+import zlib
 
 from sqlalchemy import (
     Column, Integer, String, DateTime)
-from sqlalchemy import func, Index
+from sqlalchemy import and_, bindparam, func, Index
 from sqlalchemy.orm.session import make_transient
 
 from airflow import executors
-from airflow.configuration import conf
+from airflow.configuration import conf, mkdir_p
 from airflow import models
 from airflow import settings
 from airflow import utils
@@ -24,14 +34,45 @@ from airflow.utils import State
 Base = models.Base
 ID_LEN = models.ID_LEN
 
-# Setting up a statsd client if needed
-statsd = None
-if conf.get('scheduler', 'statsd_on'):
-    from statsd import StatsClient
-    statsd = StatsClient(
-        host=conf.get('scheduler', 'statsd_host'),
-        port=conf.getint('scheduler', 'statsd_port'),
-        prefix=conf.get('scheduler', 'statsd_prefix'))
+statsd = settings.statsd
+
+# Counts the queries run against the metadata database by this process
+query_counter = utils.QueryCounter(settings.engine)
+
+
+# Set in the workers of the scheduler's DAG processing pool
+_dag_processor_context = {}
+
+
+def _init_dag_processor(job, dagbag):
+    """
+    Initializes a worker of the scheduler's DAG processing pool. Workers
+    are forked, so they inherit the job and the DagBag as is, but they need
+    their own database connections.
+    """
+    global _dag_processor_context
+    _dag_processor_context = {'job': job, 'dagbag': dagbag}
+    settings.Session.registry.clear()
+    settings.engine.pool = settings.engine.pool.recreate()
+
+
+def _process_dag_in_subprocess(dag_id, task_ids):
+    """
+    Processes a DAG in a worker of the scheduler's DAG processing pool and
+    returns the keys of the task instances to queue along with the wakeups
+    and the next due dates registered while processing it.
+    """
+    job = _dag_processor_context['job']
+    dag = _dag_processor_context['dagbag'].dags[dag_id]
+    job.wakeups = []
+    job.wakeup_keys = set()
+    job.next_due = {}
+    job.due_heap = []
+    with utils.timeout(
+            job.dag_processing_timeout,
+            "Processing {} timed out".format(dag_id)):
+        tis = job.process_dag(dag, executor=None, task_ids=task_ids) or []
+    return [ti.key for ti in tis], job.wakeups, job.next_due
 
 
 class BaseJob(Base):
@@ -136,6 +177,10 @@ class BaseJob(Base):
                 datetime.now() - job.latest_heartbeat).total_seconds()
             if sleep_for > 0:
                 sleep(sleep_for)
+                if statsd:
+                    statsd.timing(
+                        self.__class__.__name__.lower() + '_heartbeat_sleep',
+                        sleep_for * 1000)
 
         job.latest_heartbeat = datetime.now()
 
@@ -193,6 +238,25 @@ class SchedulerJob(BaseJob):
     :param refresh_dags_every: force refresh the DAG definition every N
         runs, as specified here
     :type refresh_dags_every: int
+    :param event_driven: instead of sleeping between runs, listen to
+        the executor's completion events and schedule the downstream tasks
+        of the finished task instances right away, as well as the task
+        instances whose schedule or retry delay comes due
+    :type event_driven: bool
+    :param event_poll_interval: in event driven mode, how often (in
+        seconds) the executor is polled for completion events
+    :type event_poll_interval: int
+    :param dag_processors: the number of worker processes to shard the
+        DAGs across when processing them, the DAGs are processed one at
+        a time in the scheduler's process if set to ``1``
+    :type dag_processors: int
+    :param dag_processing_timeout: how long (in seconds) a worker process
+        can spend on a single DAG before giving up on it for the run, this
+        is also how long the lease a scheduler takes on a DAG lasts
+    :type dag_processing_timeout: int
+    :param num_runs: the number of runs to go through before exiting,
+        forever if ``None``
+    :type num_runs: int
     """
 
     __mapper_args__ = {
@@ -205,43 +269,111 @@ class SchedulerJob(BaseJob):
             subdir=None,
             test_mode=False,
             refresh_dags_every=10,
+            event_driven=conf.getboolean('scheduler', 'EVENT_DRIVEN'),
+            event_poll_interval=1,
+            dag_processors=conf.getint('scheduler', 'DAG_PROCESSORS'),
+            dag_processing_timeout=conf.getint(
+                'scheduler', 'DAG_PROCESSING_TIMEOUT'),
+            num_runs=None,
             *args, **kwargs):
         self.dag_id = dag_id
         self.subdir = subdir
         self.test_mode = test_mode
         self.refresh_dags_every = refresh_dags_every
+        self.event_driven = event_driven
+        self.event_poll_interval = event_poll_interval
+        self.dag_processors = dag_processors
+        self.dag_processing_timeout = dag_processing_timeout
+        self.num_runs = num_runs
+        # (index, count) of the share of the DAGs this scheduler handles
+        self.shard = (0, 1)
+        # Heap of (due_date, dag_id, task_id, execution_date, check_pool)
+        # for the task instances waiting on their schedule or retry delay
+        self.wakeups = []
+        self.wakeup_keys = set()
+        # Next date each (dag_id, task_id) can become runnable, ``None``
+        # meaning never as far as we know, and the matching heap of
+        # (due_date, dag_id, task_id). Tasks missing from the index are due.
+        self.next_due = {}
+        self.due_heap = []
+        # The last_loaded of the DAGs as of when their tasks were indexed
+        self.dag_versions = {}
+        # Open slots per pool, reconciled with the metadata DB on every run
+        # and decremented as task instances get queued in between
+        self.pool_slots = None
+        # Keys of the queued task instances handed over to the executor by
+        # prioritize_queued on the current run
+        self.prioritized_keys = set()
         super(SchedulerJob, self).__init__(*args, **kwargs)
 
         self.heartrate = conf.getint('scheduler', 'SCHEDULER_HEARTBEAT_SEC')
 
-    def process_dag(self, dag, executor):
+    @contextmanager
+    def phase(self, name):
+        """
+        Times a phase of the scheduler's work and counts the queries it
+        runs against the metadata database, reporting both to statsd as
+        ``scheduler.<name>`` and ``scheduler.<name>.queries``
+        """
+        start = datetime.now()
+        queries = query_counter.count
+        try:
+            yield
+        finally:
+            duration = (datetime.now() - start).total_seconds()
+            queries = query_counter.count - queries
+            logging.debug("{} took {:.3f}s and {} queries".format(
+                name, duration, queries))
+            if statsd:
+                statsd.timing('scheduler.' + name, duration * 1000)
+                statsd.incr('scheduler.{}.queries'.format(name), queries)
+
+    def process_dag(self, dag, executor, task_ids=None):
         """
         This method schedules a single DAG by looking at the latest
-        run for each task and attempting to schedule the following run.
-
-        As multiple schedulers may be running for redundancy, this
-        function takes a lock on the DAG and timestamps the last run
-        in ``last_scheduler_run``.
+        run for each task and attempting to schedule the following runs
+        that are due, keeping at most ``max_active_runs`` execution dates
+        of the DAG in flight. Retries and queued task instances get
+        scheduled as their retry delay and pool allow.
+
+        Only the tasks in ``task_ids`` are evaluated if specified. The next
+        date each evaluated task can become runnable gets recorded in the
+        ``next_due`` index.
+
+        As multiple schedulers may be running, this function takes a lease
+        on the DAG and timestamps the last run in ``last_scheduler_run``.
+        The DAG is skipped if another scheduler holds the lease or if it was
+        scheduled less than a heartbeat ago.
+
+        Returns the list of task instances that are ready to run. They get
+        queued in ``executor`` unless it is ``None``.
         """
         DagModel = models.DagModel
         session = settings.Session()
 
-        db_dag = session.query(
-            DagModel).filter(DagModel.dag_id == dag.dag_id).first()
-        last_scheduler_run = db_dag.last_scheduler_run or datetime(2000, 1, 1)
-        secs_since_last = (
-            datetime.now() - last_scheduler_run).total_seconds()
-        # if db_dag.scheduler_lock or
-        if secs_since_last < self.heartrate:
-            session.commit()
+        locked = DagModel.acquire_scheduler_lock(
+            dag.dag_id,
+            owner=self.lock_owner,
+            lease=timedelta(seconds=self.dag_processing_timeout),
+            min_interval=timedelta(seconds=self.heartrate),
+            session=session)
+        if not locked:
             session.close()
             return None
-        else:
-            # Taking a lock
-            db_dag.scheduler_lock = True
-            db_dag.last_scheduler_run = datetime.now()
-            session.commit()
+        try:
+            with self.phase('process_dag.' + dag.dag_id):
+                tis = self._process_dag(dag, executor, session, task_ids)
+        finally:
+            logging.debug("Releasing the lease on " + dag.dag_id)
+            DagModel.release_scheduler_lock(
+                dag.dag_id, owner=self.lock_owner, session=session)
+            session.close()
+        return tis
 
+    def _process_dag(self, dag, executor, session, task_ids=None):
+        """
+        Does the actual work of ``process_dag`` while holding the lease
+        """
         TI = models.TaskInstance
         logging.info(
             "Getting latest instance "
@@ -265,92 +397,474 @@ class SchedulerJob(BaseJob):
         session.commit()
         logging.debug("{} rows returned".format(len(latest_ti)))
 
-        for task in dag.tasks:
-            if task.adhoc:
-                continue
-            if task.task_id not in ti_dict:
-                # Brand new task, let's get started
-                ti = TI(task, task.start_date)
-                ti.refresh_from_db()
-                if ti.is_runnable():
-                    logging.info(
-                        'First run for {ti}'.format(**locals()))
-                    executor.queue_task_instance(ti)
+        # The task instances in flight, including the retries and queued
+        # ones that aren't the latest of their task anymore
+        active_tis = session.query(TI).filter(
+            TI.dag_id == dag.dag_id,
+            TI.state.in_((State.RUNNING, State.QUEUED, State.UP_FOR_RETRY)),
+        ).all()
+        session.expunge_all()
+        session.commit()
+        tasks = {
+            t.task_id: t for t in dag.tasks
+            if not t.adhoc and (task_ids is None or t.task_id in task_ids)}
+
+        # Retries need to meet their retry delay, previously queued task
+        # instances need a slot in their pool
+        retries = [
+            (tasks[ti.task_id], ti.execution_date, True)
+            for ti in active_tis
+            if ti.state != State.RUNNING and ti.task_id in tasks]
+
+        # Enumerating the schedules that are due after the latest instance
+        # of each task, so that a DAG that is behind catches up in one pass
+        now = datetime.now()
+        schedules = []
+        for task in tasks.values():
+            if task.task_id in ti_dict:
+                execution_date = (
+                    ti_dict[task.task_id].execution_date +
+                    task.schedule_interval)
+                check_pool = False
             else:
-                ti = ti_dict[task.task_id]
-                ti.task = task  # Hacky but worky
-                if ti.state == State.RUNNING:
-                    continue  # Only one task at a time
-                elif ti.state == State.UP_FOR_RETRY:
-                    # If task instance if up for retry, make sure
-                    # the retry delay is met
-                    if ti.is_runnable():
-                        logging.debug('Triggering retry: ' + str(ti))
-                        executor.queue_task_instance(ti)
-                elif ti.state == State.QUEUED:
-                    # If task instance if up for retry, make sure
-                    if ti.is_runnable():
-                        logging.debug(
-                            'Starting previously queued : ' + str(ti))
-                        executor.queue_task_instance(ti)
-                else:
-                    # Trying to run the next schedule
-                    next_schedule = (
-                        ti.execution_date + task.schedule_interval)
-                    if (
-                            ti.task.end_date and
-                            next_schedule > ti.task.end_date):
-                        continue
-                    ti = TI(
-                        task=task,
-                        execution_date=next_schedule,
-                    )
-                    ti.refresh_from_db()
-                    if ti.is_queueable():
-                        logging.debug('Queuing next run: ' + str(ti))
-                        executor.queue_task_instance(ti)
-        # Releasing the lock
-        logging.debug("Unlocking DAG (scheduler_lock)")
-        db_dag = (
-            session.query(DagModel)
-            .filter(DagModel.dag_id == dag.dag_id)
-            .first()
-        )
-        db_dag.scheduler_lock = False
-        session.merge(db_dag)
+                # Brand new task, let's get started
+                execution_date = task.start_date
+                check_pool = True
+            dates = []
+            while (
+                    len(dates) < dag.max_active_runs and
+                    not (task.end_date and execution_date > task.end_date)
+                    and (
+                        not dates or
+                        execution_date <= now - task.schedule_interval)):
+                dates.append(execution_date)
+                execution_date += task.schedule_interval
+            schedules.append((task, dates, check_pool))
+
+        # Only letting max_active_runs execution dates be in flight at once
+        allowed_dates = {ti.execution_date for ti in active_tis}
+        for execution_date in sorted({
+                d for task, dates, check_pool in schedules for d in dates}):
+            if len(allowed_dates) >= dag.max_active_runs:
+                break
+            allowed_dates.add(execution_date)
+        capped_task_ids = {
+            task.task_id for task, dates, check_pool in schedules
+            if dates and not any(d in allowed_dates for d in dates)}
+        schedules = [
+            (task, [d for d in dates if d in allowed_dates], check_pool)
+            for task, dates, check_pool in schedules]
+
+        candidates = retries + [
+            (task, d, check_pool)
+            for task, dates, check_pool in schedules for d in dates]
+        not_ready = []
+        ready = {
+            ti.key: ti for ti in self.get_ready_task_instances(
+                dag, candidates, session, not_ready=not_ready)}
+
+        tis = [
+            ready[(dag.dag_id, task.task_id, d)]
+            for task, d, check_pool in retries
+            if (dag.dag_id, task.task_id, d) in ready]
+        # The schedules of a task are queued in order, the ones following
+        # a schedule that isn't ready are left for later so that the latest
+        # instance of a task never leaves a gap behind
+        for task, dates, check_pool in schedules:
+            for d in dates:
+                key = (dag.dag_id, task.task_id, d)
+                if key not in ready:
+                    break
+                tis.append(ready[key])
+        if statsd:
+            statsd.incr(
+                'scheduler.process_dag.{}.examined'.format(dag.dag_id),
+                len(candidates))
+            statsd.incr(
+                'scheduler.process_dag.{}.queued'.format(dag.dag_id),
+                len(tis))
+
+        # Indexing when each task can next become runnable. Tasks with
+        # instances in flight, blocked by their dependencies, their pool or
+        # max_active_runs need another look on the next run, the others
+        # can wait for their next schedule or retry delay.
+        now = datetime.now()
+        next_due = dict.fromkeys(tasks)
+        for task_id in capped_task_ids:
+            next_due[task_id] = now
+        for ti in tis + active_tis:
+            if ti.task_id in tasks and ti.state != State.UP_FOR_RETRY:
+                next_due[ti.task_id] = now
+        for ti in not_ready:
+            due = max(self.get_runnable_date(ti), now)
+            if next_due[ti.task_id] is None or due < next_due[ti.task_id]:
+                next_due[ti.task_id] = due
+        for task_id, due in next_due.items():
+            self.set_next_due(dag.dag_id, task_id, due)
+
+        if executor:
+            for ti in tis:
+                logging.debug('Queuing: ' + str(ti))
+                executor.queue_task_instance(ti)
+        return tis
+
+    @property
+    def lock_owner(self):
+        """
+        Identifies this scheduler as the holder of leases on DAGs
+        """
+        return "{}:{}".format(self.hostname, self.id)
+
+    def refresh_shard(self):
+        """
+        Figures out the share of the DAGs this scheduler is responsible
+        for, based on the scheduler jobs that are alive according to their
+        heartbeat. DAGs are spread across them by hashing their dag_id, so
+        their share gets rebalanced as schedulers start or die.
+        """
+        session = settings.Session()
+        limit = datetime.now() - timedelta(seconds=self.heartrate * 2.1)
+        alive_ids = [
+            job.id for job in session.query(BaseJob.id).filter(
+                BaseJob.job_type == self.__class__.__name__,
+                BaseJob.state == State.RUNNING,
+                BaseJob.latest_heartbeat > limit,
+            ).order_by(BaseJob.id)]
         session.commit()
+        session.close()
+        if self.id in alive_ids:
+            self.shard = (alive_ids.index(self.id), len(alive_ids))
+        else:
+            self.shard = (0, 1)
+        logging.debug("Scheduling shard {} out of {}".format(*self.shard))
+
+    def in_shard(self, dag_id):
+        index, count = self.shard
+        return (zlib.crc32(dag_id) & 0xffffffff) % count == index
+
+    def get_ready_task_instances(
+            self, dag, candidates, session, not_ready=None):
+        """
+        Returns the task instances that are ready to be queued among a list
+        of ``(task, execution_date, check_pool)`` candidates. The ones that
+        aren't get appended to the ``not_ready`` list if specified.
+
+        The states of all the task instances the candidates depend on
+        (upstream tasks, previous schedule and its downstream tasks
+        for wait_for_downstream) are fetched in bulk and the dependencies
+        are evaluated in memory, as opposed to a few queries per candidate.
+        """
+        TI = models.TaskInstance
+        execution_dates = set()
+        for task, execution_date, check_pool in candidates:
+            execution_dates.add(execution_date)
+            if task.depends_on_past:
+                execution_dates.add(execution_date - task.schedule_interval)
+        db_tis = {
+            (ti.task_id, ti.execution_date): ti
+            for ti in dag.get_task_instances_for_dates(
+                session, execution_dates)}
+        session.expunge_all()
+        session.commit()
+        ti_states = {key: ti.state for key, ti in db_tis.items()}
+
+        if self.pool_slots is None and any(
+                check_pool for task, execution_date, check_pool in candidates):
+            self.pool_slots = models.Pool.get_open_slots(session)
+            session.commit()
 
+        ready = []
+        for task, execution_date, check_pool in candidates:
+            ti = db_tis.get((task.task_id, execution_date))
+            if ti:
+                ti.task = task  # Hacky but worky
+            else:
+                ti = TI(task, execution_date)
+            if ti.key in self.prioritized_keys:
+                # Already taken care of
+                continue
+            if check_pool:
+                is_ready = ti.is_runnable(
+                    ti_states=ti_states, pool_slots=self.pool_slots)
+                if is_ready and task.pool in self.pool_slots:
+                    self.pool_slots[task.pool] -= 1
+            else:
+                is_ready = ti.is_queueable(ti_states=ti_states)
+            if is_ready:
+                ready.append(ti)
+                continue
+            if not_ready is not None:
+                not_ready.append(ti)
+            if self.event_driven:
+                self.add_wakeup(ti, check_pool)
+        return ready
+
+    def schedule_candidates(self, dag, candidates, executor, session):
+        """
+        Queues the ``(task, execution_date, check_pool)`` candidates that
+        are ready to run in the executor, if any, and returns them.
+        """
+        tis = self.get_ready_task_instances(dag, candidates, session)
+        if executor:
+            for ti in tis:
+                logging.debug('Queuing: ' + str(ti))
+                executor.queue_task_instance(ti)
+        return tis
+
+    def add_wakeup(self, ti, check_pool):
+        """
+        Registers the moment a task instance that isn't ready can become
+        runnable on its own, meaning when its schedule or its retry delay
+        comes due. Task instances blocked by their dependencies are
+        unblocked by completion events instead.
+        """
+        due = self.get_runnable_date(ti)
+        if due > datetime.now():
+            self.push_wakeup((
+                due, ti.dag_id, ti.task_id, ti.execution_date, check_pool))
+
+    @staticmethod
+    def get_runnable_date(ti):
+        """
+        Returns the earliest date a task instance can run at as far as its
+        schedule and retry delay are concerned
+        """
+        due = ti.execution_date + ti.task.schedule_interval
+        if ti.state == State.UP_FOR_RETRY and ti.end_date:
+            due = max(due, ti.end_date + ti.task.retry_delay)
+        return due
+
+    def push_wakeup(self, wakeup):
+        due, dag_id, task_id, execution_date, check_pool = wakeup
+        key = (dag_id, task_id, execution_date)
+        if key not in self.wakeup_keys:
+            self.wakeup_keys.add(key)
+            heapq.heappush(self.wakeups, wakeup)
+
+    def pop_due_wakeups(self):
+        """
+        Pops the registered wakeups that have come due, grouped as lists of
+        ``(task_id, execution_date, check_pool)`` by dag_id
+        """
+        now = datetime.now()
+        d = defaultdict(list)
+        while self.wakeups and self.wakeups[0][0] <= now:
+            due, dag_id, task_id, execution_date, check_pool = \
+                heapq.heappop(self.wakeups)
+            self.wakeup_keys.discard((dag_id, task_id, execution_date))
+            d[dag_id].append((task_id, execution_date, check_pool))
+        return d
+
+    def set_next_due(self, dag_id, task_id, due):
+        """
+        Records the next date a task can become runnable, ``None`` meaning
+        never unless its DAG changes
+        """
+        self.next_due[(dag_id, task_id)] = due
+        if due:
+            heapq.heappush(self.due_heap, (due, dag_id, task_id))
+
+    def pop_due_tasks(self):
+        """
+        Drops the tasks that have come due from the ``next_due`` index,
+        the heap entries that have been superseded since they were pushed
+        are ignored
+        """
+        now = datetime.now()
+        while self.due_heap and self.due_heap[0][0] <= now:
+            due, dag_id, task_id = heapq.heappop(self.due_heap)
+            if self.next_due.get((dag_id, task_id)) == due:
+                del self.next_due[(dag_id, task_id)]
+
+    def get_due_task_ids(self, dag):
+        """
+        Returns the ids of the tasks of a DAG that are due for evaluation,
+        all of them if the DAG was reloaded since they were indexed
+        """
+        if self.dag_versions.get(dag.dag_id) != dag.last_loaded:
+            self.dag_versions[dag.dag_id] = dag.last_loaded
+            for task in dag.tasks:
+                self.next_due.pop((dag.dag_id, task.task_id), None)
+        return {
+            task.task_id for task in dag.tasks
+            if not task.adhoc and
+            (dag.dag_id, task.task_id) not in self.next_due}
+
+    def process_events(self, events, dagbag, executor, paused_dag_ids):
+        """
+        Schedules the task instances that may have been unblocked by the
+        completion of the task instances reported in ``events``, as
+        returned by the executor's ``get_event_buffer``. Only the
+        downstream tasks of the finished task instances get evaluated.
+        """
+        d = defaultdict(dict)
+        for (dag_id, task_id, execution_date), state in events.items():
+            dag = dagbag.dags.get(dag_id)
+            if not dag or dag_id in paused_dag_ids or \
+                    not self.in_shard(dag_id):
+                continue
+            try:
+                task = dag.get_task(task_id)
+            except:
+                continue
+            for t in task.downstream_list:
+                d[dag_id][(t.task_id, execution_date)] = (
+                    t, execution_date, True)
+
+        session = settings.Session()
+        for dag_id, candidates in d.items():
+            logging.info(
+                "Evaluating {} downstream task instance(s) "
+                "in {}".format(len(candidates), dag_id))
+            self.schedule_candidates(
+                dagbag.dags[dag_id], candidates.values(), executor, session)
+        session.close()
+
+    def process_wakeups(self, dagbag, executor, paused_dag_ids):
+        """
+        Schedules the task instances whose schedule or retry delay has
+        come due since they were last evaluated.
+        """
+        session = settings.Session()
+        for dag_id, wakeups in self.pop_due_wakeups().items():
+            dag = dagbag.dags.get(dag_id)
+            if not dag or dag_id in paused_dag_ids or \
+                    not self.in_shard(dag_id):
+                continue
+            candidates = []
+            for task_id, execution_date, check_pool in wakeups:
+                try:
+                    task = dag.get_task(task_id)
+                except:
+                    continue
+                candidates.append((task, execution_date, check_pool))
+            self.schedule_candidates(dag, candidates, executor, session)
         session.close()
 
+    def process_dags_in_pool(self, dags, dagbag, executor):
+        """
+        Shards the ``(dag, task_ids)`` to process across a pool of
+        ``dag_processors`` worker processes. The workers evaluate their
+        DAGs and send back the keys of the task instances to queue, this
+        process alone talks to the executor. Each DAG gets
+        ``dag_processing_timeout`` seconds before being skipped for this
+        run, so that one pathological DAG can't stall the whole loop.
+        """
+        pool = multiprocessing.Pool(
+            self.dag_processors,
+            initializer=_init_dag_processor,
+            initargs=(self, dagbag))
+        results = [
+            (dag, pool.apply_async(
+                _process_dag_in_subprocess, (dag.dag_id, task_ids)))
+            for dag, task_ids in dags]
+        pool.close()
+
+        # The workers time out on their own, this is a safety net for those
+        # that get stuck in a way the alarm can't interrupt
+        deadline = datetime.now() + timedelta(
+            seconds=self.dag_processing_timeout * (
+                len(dags) / self.dag_processors + 1))
+        stuck = False
+        for dag, result in results:
+            try:
+                timeout = (deadline - datetime.now()).total_seconds()
+                keys, wakeups, next_due = result.get(
+                    timeout=max(timeout, 0))
+            except multiprocessing.TimeoutError:
+                logging.error(
+                    "Gave up on waiting for {}".format(dag.dag_id))
+                stuck = True
+                continue
+            except Exception as e:
+                logging.exception(e)
+                continue
+            for dag_id, task_id, execution_date in keys:
+                ti = models.TaskInstance(
+                    dag.get_task(task_id), execution_date)
+                logging.debug('Queuing: ' + str(ti))
+                executor.queue_task_instance(ti)
+            for wakeup in wakeups:
+                self.push_wakeup(wakeup)
+            for (dag_id, task_id), due in next_due.items():
+                self.set_next_due(dag_id, task_id, due)
+        if stuck:
+            pool.terminate()
+        pool.join()
+
+    def wait_for_events(self, executor, dagbag, paused_dag_ids, until):
+        """
+        Used in event driven mode instead of idling until the next
+        heartbeat: polls the executor for completion events and reacts
+        to them, as well as to wakeups coming due, until ``until``.
+        """
+        while datetime.now() < until:
+            events = executor.get_event_buffer()
+            if events:
+                self.process_events(
+                    events, dagbag, executor, paused_dag_ids)
+            self.process_wakeups(dagbag, executor, paused_dag_ids)
+            executor.heartbeat()
+            sleep_for = (until - datetime.now()).total_seconds()
+            if self.wakeups:
+                sleep_for = min(
+                    sleep_for,
+                    (self.wakeups[0][0] - datetime.now()).total_seconds())
+            sleep(max(0, min(sleep_for, self.event_poll_interval)))
+
+    def get_dagbag(self):
+        """
+        Collects the DAGs to schedule, syncing them to the metadata DB
+        """
+        return models.DagBag(
+            self.subdir, executor=self.executor, sync_to_db=True)
+
     @utils.provide_session
     def prioritize_queued(self, session, executor, dagbag):
-        # Prioritizing queued task instances
-
-        pools = {p.pool: p for p in session.query(models.Pool).all()}
+        """
+        Reconciles the open slots of the pools with the metadata DB and
+        hands the queued task instances with the highest priority over to
+        the executor, as many as their pool has open slots for. The running
+        and queued task instances are counted for all the pools in a single
+        query and the queued ones of each pool are fetched by priority, up
+        to its number of open slots. Only the task instances of the DAGs in
+        this scheduler's shard are handed over, the other schedulers take
+        care of theirs.
+        """
         TI = models.TaskInstance
-        queued_tis = (
-            session.query(TI)
-            .filter(TI.state == State.QUEUED)
-            .all()
-        )
-        d = defaultdict(list)
-        for ti in queued_tis:
-            d[ti.pool].append(ti)
-
-        for pool, tis in d.items():
-            open_slots = pools[ti.pool].open_slots(session=session)
-            if open_slots > 0:
-                tis = sorted(
-                    tis, key=lambda ti: ti.priority_weight, reverse=True)
-                for ti in tis[:open_slots]:
-                    task = None
-                    try:
-                        task = dagbag.dags[ti.dag_id].get_task(ti.task_id)
-                    except:
-                        logging.error("Queued task {} seems gone".format(ti))
-                    if task:
-                        ti.task = task
-                        executor.queue_task_instance(ti)
+        usage = models.Pool.get_usage(session)
+        self.pool_slots = models.Pool.get_open_slots(session, usage=usage)
+        self.prioritized_keys = set()
+
+        for pool, counts in usage.items():
+            if not counts.get(State.QUEUED):
+                continue
+            qry = (
+                session.query(TI)
+                .filter(TI.pool == pool, TI.state == State.QUEUED)
+                .order_by(TI.priority_weight.desc())
+            )
+            if pool in self.pool_slots:
+                if self.pool_slots[pool] <= 0:
+                    continue
+                if self.shard[1] == 1:
+                    qry = qry.limit(self.pool_slots[pool])
+            for ti in qry.all():
+                if pool in self.pool_slots and self.pool_slots[pool] <= 0:
+                    break
+                if not self.in_shard(ti.dag_id):
+                    continue
+                task = None
+                try:
+                    task = dagbag.dags[ti.dag_id].get_task(ti.task_id)
+                except:
+                    logging.error("Queued task {} seems gone".format(ti))
+                if task:
+                    ti.task = task
+                    executor.queue_task_instance(ti)
+                    self.prioritized_keys.add(ti.key)
+                    if pool in self.pool_slots:
+                        self.pool_slots[pool] -= 1
 
     def _execute(self):
         dag_id = self.dag_id
@@ -365,22 +879,32 @@ class SchedulerJob(BaseJob):
         logging.basicConfig(level=logging.DEBUG)
         logging.info("Starting the scheduler")
 
-        dagbag = models.DagBag(self.subdir, sync_to_db=True)
+        dagbag = self.get_dagbag()
         executor = dagbag.executor
         executor.start()
         i = 0
-        while (not self.test_mode) or i < 1:
+        while (
+                ((not self.test_mode) or i < 1) and
+                (self.num_runs is None or i < self.num_runs)):
+            loop_start_dttm = datetime.now()
+            self.refresh_shard()
             try:
-                self.prioritize_queued(executor=executor, dagbag=dagbag)
+                with self.phase('prioritize_queued'):
+                    self.prioritize_queued(executor=executor, dagbag=dagbag)
             except Exception as e:
                 logging.exception(e)
 
             i += 1
             try:
-                if i % self.refresh_dags_every == 0:
-                    dagbag = models.DagBag(self.subdir, sync_to_db=True)
-                else:
-                    dagbag.collect_dags(only_if_updated=True)
+                with self.phase('dagbag_refresh'):
+                    if i % self.refresh_dags_every == 0:
+                        dagbag = self.get_dagbag()
+                        # Evaluating everything once in a while picks up the
+                        # changes made behind the scheduler's back
+                        self.next_due = {}
+                        self.due_heap = []
+                    else:
+                        dagbag.collect_dags(only_if_updated=True)
             except:
                 logging.error("Failed at reloading the dagbag")
                 if statsd:
@@ -393,20 +917,53 @@ class SchedulerJob(BaseJob):
                 dags = [
                     dag for dag in dagbag.dags.values() if not dag.parent_dag]
             paused_dag_ids = dagbag.paused_dags()
+            self.pop_due_tasks()
+            dags_to_process = []
             for dag in dags:
-                logging.debug("Scheduling {}".format(dag.dag_id))
+                if not self.in_shard(dag.dag_id):
+                    continue
                 dag = dagbag.get_dag(dag.dag_id)
                 if not dag or (dag.dag_id in paused_dag_ids):
                     continue
-                try:
-                    self.process_dag(dag, executor)
-                except Exception as e:
-                    logging.exception(e)
+                task_ids = self.get_due_task_ids(dag)
+                if task_ids:
+                    dags_to_process.append((dag, task_ids))
+            logging.info("{} DAG(s) have tasks due out of {}".format(
+                len(dags_to_process), len(dags)))
+            if statsd:
+                statsd.gauge('scheduler.dags_due', len(dags_to_process))
+
+            with self.phase('process_dags'):
+                if self.dag_processors > 1:
+                    try:
+                        self.process_dags_in_pool(
+                            dags_to_process, dagbag, executor)
+                    except Exception as e:
+                        logging.exception(e)
+                else:
+                    for dag, task_ids in dags_to_process:
+                        logging.debug("Scheduling {}".format(dag.dag_id))
+                        try:
+                            self.process_dag(dag, executor, task_ids)
+                        except Exception as e:
+                            logging.exception(e)
             logging.debug(
                 "Done queuing tasks, calling the executor's heartbeat")
             try:
                 # We really just want the scheduler to never ever stop.
-                executor.heartbeat()
+                with self.phase('executor_heartbeat'):
+                    executor.heartbeat()
+                if self.event_driven and not self.test_mode:
+                    with self.phase('wait_for_events'):
+                        self.wait_for_events(
+                            executor, dagbag, paused_dag_ids,
+                            until=loop_start_dttm + timedelta(
+                                seconds=self.heartrate))
+                if statsd:
+                    statsd.timing(
+                        'scheduler.loop',
+                        (datetime.now() - loop_start_dttm).total_seconds() *
+                        1000)
                 self.heartbeat()
             except Exception as e:
                 logging.exception(e)
@@ -418,22 +975,219 @@ class SchedulerJob(BaseJob):
             statsd.gauge('scheduler_heartbeat', 1, 1)
 
 
+class BackfillGraph(object):
+    """
+    Dependency graph of the task instances of a backfill, keyed by
+    ``(dag_id, task_id, execution_date)``. Schedules are added as they get
+    admitted, with edges from the upstream tasks of the same schedule and,
+    for the tasks that depend on the past, from the previous schedule of
+    the task (and its downstream tasks for wait_for_downstream).
+
+    Each node counts its upstream nodes that haven't succeeded yet and
+    becomes ready when that count drops to zero, so marking a node as
+    succeeded or failed costs O(out-degree) however long the range.
+    Dependencies on task instances outside of the graph are met or not at
+    the time the schedule is added, based on ``ti_states``. The nodes
+    depending on a task instance that has failed, be it outside of the
+    graph or already marked as failed in it, are listed in ``blocked``
+    along with that task instance.
+
+    :param dag: the DAG being backfilled
+    :type dag: DAG
+    :param tasks: the tasks of the DAG that are part of the backfill
+    :type tasks: list
+    """
+    def __init__(self, dag, tasks):
+        self.dag = dag
+        self.tasks = tasks
+        self.task_ids = {task.task_id for task in tasks}
+        self.priority_weights = {
+            task.task_id: task.priority_weight_total for task in tasks}
+        self.dates = set()
+        # Number of unmet dependencies of the nodes left to run
+        self.pending = {}
+        self.dependents = defaultdict(list)
+        # Heap of (-priority_weight, execution_date, key)
+        self.ready = []
+        self.succeeded = set()
+        # Nodes that failed or won't run
+        self.failed = set()
+        # (key, failed_key) of the nodes added that can't run
+        self.blocked = []
+        # Number of nodes left to run for each schedule
+        self.outstanding = defaultdict(int)
+
+    def add_schedule(self, execution_date, ti_states):
+        """
+        Adds the task instances of a schedule to the graph and returns the
+        keys of those that had already succeeded.
+
+        :param ti_states: the states of the task instances of the schedule
+            and of the previous schedule, as returned by
+            ``DAG.get_task_instance_states``
+        :type ti_states: dict
+        """
+        dag_id = self.dag.dag_id
+        previous_date = execution_date - self.dag.schedule_interval
+        self.dates.add(execution_date)
+        done = []
+        for task in self.tasks:
+            if ti_states.get(
+                    (task.task_id, execution_date)) == State.SUCCESS:
+                key = (dag_id, task.task_id, execution_date)
+                self.succeeded.add(key)
+                done.append(key)
+
+        for task in self.tasks:
+            key = (dag_id, task.task_id, execution_date)
+            if key in self.succeeded:
+                continue
+            upstream = [
+                (t.task_id, execution_date) for t in task.upstream_list]
+            if (task.depends_on_past and
+                    execution_date != task.start_date):
+                upstream.append((task.task_id, previous_date))
+                if task.wait_for_downstream:
+                    upstream += [
+                        (t.task_id, previous_date)
+                        for t in task.downstream_list]
+            self.pending[key] = 0
+            self.outstanding[execution_date] += 1
+            blocker = None
+            for task_id, dttm in upstream:
+                upstream_key = (dag_id, task_id, dttm)
+                if upstream_key in self.succeeded:
+                    continue
+                if upstream_key in self.failed:
+                    blocker = upstream_key
+                    self.pending[key] += 1
+                elif task_id in self.task_ids and dttm in self.dates:
+                    self.dependents[upstream_key].append(key)
+                    self.pending[key] += 1
+                elif ti_states.get((task_id, dttm)) != State.SUCCESS:
+                    # Not part of the backfill and not done, won't be
+                    self.pending[key] += 1
+                    if ti_states.get((task_id, dttm)) == State.FAILED:
+                        blocker = upstream_key
+            if blocker:
+                self.blocked.append((key, blocker))
+            elif not self.pending[key]:
+                self.push_ready(key)
+        if not self.outstanding[execution_date]:
+            del self.outstanding[execution_date]
+        return done
+
+    def push_ready(self, key):
+        heapq.heappush(
+            self.ready, (-self.priority_weights[key[1]], key[2], key))
+
+    def pop_ready(self):
+        """
+        Pops the keys of the nodes that are ready to run, highest priority
+        and earliest schedule first
+        """
+        keys = []
+        while self.ready:
+            keys.append(heapq.heappop(self.ready)[2])
+        return keys
+
+    def _resolve(self, key):
+        del self.pending[key]
+        execution_date = key[2]
+        self.outstanding[execution_date] -= 1
+        if not self.outstanding[execution_date]:
+            del self.outstanding[execution_date]
+
+    def mark_succeeded(self, key):
+        """
+        Marks a node as succeeded and unblocks its dependents
+        """
+        self._resolve(key)
+        self.succeeded.add(key)
+        for dependent in self.dependents.pop(key, []):
+            self.pending[dependent] -= 1
+            if not self.pending[dependent]:
+                self.push_ready(dependent)
+
+    def mark_failed(self, key):
+        """
+        Marks a node as failed and returns the keys of the nodes that
+        won't run as a result, which get removed from the graph
+        """
+        self._resolve(key)
+        self.failed.add(key)
+        wont_run = []
+        to_visit = self.dependents.pop(key, [])
+        while to_visit:
+            dependent = to_visit.pop()
+            if dependent in self.pending:
+                self._resolve(dependent)
+                self.failed.add(dependent)
+                wont_run.append(dependent)
+                to_visit += self.dependents.pop(dependent, [])
+        return wont_run
+
+    def pop_blocked(self):
+        """
+        Pops the (key, failed_key) tuples of the nodes that can't run
+        because a task instance they depend on has failed
+        """
+        blocked = self.blocked
+        self.blocked = []
+        return blocked
+
+    def drop(self, key):
+        """
+        Removes a node that won't run without failing, its dependents won't
+        run either
+        """
+        return [key] + self.mark_failed(key)
+
+    def __len__(self):
+        """
+        Number of nodes left to run
+        """
+        return len(self.pending)
+
+
 class BackfillJob(BaseJob):
     """
     A backfill job consists of a dag or subdag for a specific time range. It
     triggers a set of task instance runs, in the right order and lasts for
     as long as it takes for the set of task instance to be completed.
+
+    :param max_running: caps the number of task instances of the DAG
+        running at once, counted in the metadata DB so that the cap holds
+        across the processes of a sharded backfill
+    :type max_running: int
+    :param resume_job_id: id of an interrupted backfill job to resume, the
+        task instances its plan has as successful are skipped without
+        being checked again
+    :type resume_job_id: int
+    :param progress_file: path of a JSON file to keep updated with the
+        progress of the backfill, its throughput and an ETA
+    :type progress_file: string
     """
 
     __mapper_args__ = {
         'polymorphic_identity': 'BackfillJob'
     }
 
+    # The date range the backfill was started with, for resuming it
+    bf_start_date = Column(DateTime())
+    bf_end_date = Column(DateTime())
+    # Id of the job the plan is recorded under, that of the backfill that
+    # started it, through any number of resumes
+    bf_plan_id = Column(Integer())
+
     def __init__(
             self,
             dag, start_date=None, end_date=None, mark_success=False,
             include_adhoc=False,
             donot_pickle=False,
+            max_running=None,
+            resume_job_id=None,
+            progress_file=None,
             *args, **kwargs):
         self.dag = dag
         dag.override_start_date(start_date)
@@ -443,20 +1197,39 @@ class BackfillJob(BaseJob):
         self.mark_success = mark_success
         self.include_adhoc = include_adhoc
         self.donot_pickle = donot_pickle
+        self.max_running = max_running
+        self.resume_job_id = resume_job_id
+        self.progress_file = progress_file
         super(BackfillJob, self).__init__(*args, **kwargs)
 
+    def get_plan_id(self, session):
+        """
+        Returns the id of the job the plan of this backfill is recorded
+        under, following the job it resumes back to the one that started
+        the plan, and records it on this job's row
+        """
+        plan_id = self.id
+        if self.resume_job_id:
+            resumed = session.query(BackfillJob).filter(
+                BackfillJob.id == self.resume_job_id).first()
+            plan_id = (
+                resumed and resumed.bf_plan_id) or self.resume_job_id
+        session.query(BackfillJob).filter(BackfillJob.id == self.id).update(
+            {BackfillJob.bf_plan_id: plan_id}, synchronize_session=False)
+        session.commit()
+        self.bf_plan_id = plan_id
+        return plan_id
+
     def _execute(self):
         """
         Runs a dag for a specified date range.
         """
         session = settings.Session()
 
-        start_date = self.bf_start_date
-        end_date = self.bf_end_date
-
         # picklin'
         pickle_id = None
-        if not self.donot_pickle and self.executor.__class__ not in (
+        if not self.donot_pickle and not self.mark_success and \
+                self.executor.__class__ not in (
                 executors.LocalExecutor, executors.SequentialExecutor):
             pickle = models.DagPickle(self.dag)
             session.add(pickle)
@@ -466,81 +1239,886 @@ class BackfillJob(BaseJob):
         executor = self.executor
         executor.start()
 
-        # Build a list of all instances to run
-        tasks_to_run = {}
+        tasks, schedules = self.get_schedules()
+        schedules_left = len(schedules)
+        schedules = iter(schedules)
+        total = schedules_left * len(tasks)
+
+        # The plan is recorded under the id of the job that started it
+        plan_id = self.get_plan_id(session)
+        plan_updates = {}
+        durations = self.get_durations(session)
+        schedule_seconds = sum(
+            durations.get(task.task_id, 0) for task in tasks)
+        run_start = last_heartbeat = datetime.now()
+        # Task instances that had succeeded before this run
+        skipped = 0
+
+        graph = BackfillGraph(self.dag, tasks)
+        tasks_by_id = {task.task_id: task for task in tasks}
+        # Task instances fetched from the database that aren't done yet
+        db_tis = {}
+        # Heap of (due_date, key) of the task instances to look at again
+        rechecks = []
         failed = []
-        succeeded = []
-        started = []
-        wont_run = []
-        for task in self.dag.tasks:
-            if (not self.include_adhoc) and task.adhoc:
-                continue
-
-            start_date = start_date or task.start_date
-            end_date = end_date or task.end_date or datetime.now()
-            for dttm in utils.date_range(
-                    start_date, end_date, task.dag.schedule_interval):
-                ti = models.TaskInstance(task, dttm)
-                tasks_to_run[ti.key] = ti
-
-        # Triggering what is ready to get triggered
-        while tasks_to_run:
-            msg = (
-                "Yet to run: {0} | "
-                "Succeeded: {1} | "
-                "Started: {2} | "
-                "Failed: {3} | "
-                "Won't run: {4} ").format(
-                len(tasks_to_run),
-                len(succeeded),
-                len(started),
-                len(failed),
-                len(wont_run))
-
-            logging.info(msg)
-            for key, ti in tasks_to_run.items():
-                ti.refresh_from_db()
-                if ti.state == State.SUCCESS and key in tasks_to_run:
-                    succeeded.append(key)
-                    del tasks_to_run[key]
-                elif ti.is_runnable():
-                    executor.queue_task_instance(
-                        ti,
-                        mark_success=self.mark_success,
-                        pickle_id=pickle_id)
-                    ti.state = State.RUNNING
-                    if key not in started:
-                        started.append(key)
-            self.heartbeat()
+        succeeded = set()
+        started = set()
+        wont_run = set()
+        while True:
+            # Admitting the schedules as the ones in flight complete,
+            # max_active_runs of them at a time, so that long ranges never
+            # get materialized
+            new_dates = list(itertools.islice(
+                schedules,
+                max(0, self.dag.max_active_runs - len(graph.outstanding))))
+            if new_dates:
+                schedules_left -= len(new_dates)
+                plan = models.BackfillPlan.get_states(
+                    session, plan_id, self.dag_id, new_dates)
+                session.commit()
+                # The schedules the plan has as done aren't checked again
+                done_count = defaultdict(int)
+                for key, state in plan.items():
+                    if state == State.SUCCESS and key[1] in tasks_by_id:
+                        done_count[key[2]] += 1
+                to_check = [
+                    dttm for dttm in new_dates
+                    if done_count[dttm] < len(tasks)]
+                ti_states = {}
+                if to_check:
+                    dates = set(to_check)
+                    dates.add(to_check[0] - self.dag.schedule_interval)
+                    tis = self.dag.get_task_instances_for_dates(
+                        session, dates)
+                    session.expunge_all()
+                    session.commit()
+                    for ti in tis:
+                        ti_states[(ti.task_id, ti.execution_date)] = \
+                            ti.state
+                        if ti.state != State.SUCCESS and \
+                                ti.task_id in tasks_by_id:
+                            ti.task = tasks_by_id[ti.task_id]
+                            db_tis[ti.key] = ti
+                for key, state in plan.items():
+                    if state == State.SUCCESS:
+                        ti_states[key[1:]] = State.SUCCESS
+                        db_tis.pop(key, None)
+                new_plan = {}
+                for dttm in new_dates:
+                    done = graph.add_schedule(dttm, ti_states)
+                    succeeded.update(done)
+                    skipped += len(done)
+                    for task in tasks:
+                        key = (self.dag_id, task.task_id, dttm)
+                        state = State.SUCCESS if key in graph.succeeded \
+                            else None
+                        if key not in plan:
+                            new_plan[key] = state
+                        elif state and plan[key] != state:
+                            plan_updates[key] = state
+                models.BackfillPlan.insert(plan_id, new_plan)
+                for key, failed_key in graph.pop_blocked():
+                    if key not in graph.pending:
+                        continue
+                    logging.error(
+                        "Task instance {} won't run, {} has failed".format(
+                            key, failed_key))
+                    for k in graph.drop(key):
+                        wont_run.add(k)
+                        plan_updates[k] = models.BackfillPlan.WONT_RUN
+                        db_tis.pop(k, None)
+
+            if plan_updates:
+                models.BackfillPlan.update(plan_id, plan_updates)
+                plan_updates = {}
+
+            remaining_seconds = schedules_left * schedule_seconds + sum(
+                durations.get(key[1], 0) for key in graph.pending)
+            self.report_progress(
+                plan_id=plan_id,
+                total=total,
+                yet_to_run=len(graph) + schedules_left * len(tasks),
+                succeeded=len(succeeded),
+                started=len(started),
+                failed=len(failed),
+                wont_run=len(wont_run),
+                completed=len(succeeded) - skipped + len(failed),
+                elapsed=datetime.now() - run_start,
+                remaining_seconds=remaining_seconds if durations else None)
+
+            if not len(graph) and not schedules_left:
+                break
+
+            # Looking again at the task instances that came due
+            now = datetime.now()
+            due = []
+            while rechecks and rechecks[0][0] <= now:
+                due.append(heapq.heappop(rechecks)[1])
+            self.refresh_task_instances(
+                [db_tis[key] for key in due], session)
+
+            # Queuing the task instances that are ready to run
+            to_queue = []
+            for key in due:
+                ti = db_tis[key]
+                if ti.state == State.SUCCESS:
+                    succeeded.add(key)
+                    plan_updates[key] = State.SUCCESS
+                    graph.mark_succeeded(key)
+                    del db_tis[key]
+                elif ti.state == State.FAILED and key in started:
+                    failed.append(key)
+                    plan_updates[key] = State.FAILED
+                    logging.error("Task instance " + str(key) + " failed")
+                    del db_tis[key]
+                    for k in graph.mark_failed(key):
+                        wont_run.add(k)
+                        plan_updates[k] = models.BackfillPlan.WONT_RUN
+                        db_tis.pop(k, None)
+                else:
+                    to_queue.append(ti)
+            if self.mark_success:
+                # Writing the rows directly instead of going through the
+                # executor, marking what each wave unblocks right away
+                marked = []
+                ready = graph.pop_ready()
+                while ready:
+                    for key in ready:
+                        ti = db_tis.get(key)
+                        task = tasks_by_id[key[1]]
+                        if task.end_date and key[2] > task.end_date:
+                            dropped = graph.drop(key)
+                        elif key[2] + task.schedule_interval > now:
+                            # The schedule isn't over, left to the scheduler
+                            logging.warning(
+                                "Task instance {} isn't due yet, not marking "
+                                "it as successful".format(key))
+                            dropped = graph.drop(key)
+                        elif ti and ti.state == State.RUNNING:
+                            logging.warning(
+                                "Task instance {} is running, not marking "
+                                "it as successful".format(key))
+                            dropped = graph.drop(key)
+                        else:
+                            graph.mark_succeeded(key)
+                            marked.append(key)
+                            continue
+                        for k in dropped:
+                            wont_run.add(k)
+                            plan_updates[k] = models.BackfillPlan.WONT_RUN
+                    ready = graph.pop_ready()
+                self.mark_success_in_bulk(marked, db_tis, tasks_by_id)
+                for key in marked:
+                    succeeded.add(key)
+                    plan_updates[key] = State.SUCCESS
+                    db_tis.pop(key, None)
+            for key in graph.pop_ready():
+                dag_id, task_id, execution_date = key
+                to_queue.append(db_tis.get(key) or models.TaskInstance(
+                    tasks_by_id[task_id], execution_date))
+            pool_slots = None
+            if any(ti.task.pool for ti in to_queue):
+                pool_slots = models.Pool.get_open_slots(session)
+                session.commit()
+            if self.max_running and to_queue:
+                TI = models.TaskInstance
+                running = session.query(func.count(TI.task_id)).filter(
+                    TI.dag_id == self.dag_id,
+                    TI.state == State.RUNNING,
+                ).scalar()
+                session.commit()
+                budget = max(
+                    0,
+                    self.max_running - running - len(executor.queued_tasks))
+                for ti in to_queue[budget:]:
+                    db_tis[ti.key] = ti
+                    heapq.heappush(
+                        rechecks,
+                        (now + timedelta(seconds=self.heartrate), ti.key))
+                to_queue = to_queue[:budget]
+            for ti in to_queue:
+                key = ti.key
+                if ti.task.end_date and \
+                        ti.execution_date > ti.task.end_date:
+                    for k in graph.drop(key):
+                        wont_run.add(k)
+                        plan_updates[k] = models.BackfillPlan.WONT_RUN
+                    continue
+                due_date = None
+                if ti.state == State.RUNNING:
+                    due_date = now + timedelta(seconds=self.heartrate)
+                elif ti.state == State.UP_FOR_RETRY and \
+                        not ti.ready_for_retry():
+                    due_date = ti.end_date + ti.task.retry_delay
+                elif ti.execution_date + ti.task.schedule_interval > now:
+                    due_date = ti.execution_date + ti.task.schedule_interval
+                elif ti.pool_full(pool_slots=pool_slots):
+                    due_date = now + timedelta(seconds=self.heartrate)
+                if due_date:
+                    db_tis[key] = ti
+                    heapq.heappush(rechecks, (due_date, key))
+                    continue
+                executor.queue_task_instance(
+                    ti,
+                    mark_success=self.mark_success,
+                    pickle_id=pickle_id)
+                ti.state = State.RUNNING
+                db_tis[key] = ti
+                started.add(key)
+                plan_updates[key] = State.RUNNING
+                if pool_slots and ti.task.pool in pool_slots:
+                    pool_slots[ti.task.pool] -= 1
+
+            if not self.mark_success or (
+                    datetime.now() - last_heartbeat >=
+                    timedelta(seconds=self.heartrate)):
+                # Not waiting on a heartbeat to mark the next schedules
+                self.heartbeat()
+                last_heartbeat = datetime.now()
             executor.heartbeat()
 
             # Reacting to events
-            for key, state in executor.get_event_buffer().items():
-                dag_id, task_id, execution_date = key
-                if key not in tasks_to_run:
-                    continue
-                ti = tasks_to_run[key]
-                ti.refresh_from_db()
-                if ti.state == State.FAILED:
+            events = [
+                key for key in executor.get_event_buffer()
+                if key in db_tis and key in graph.pending]
+            self.refresh_task_instances(
+                [db_tis[key] for key in events], session)
+            for key in events:
+                ti = db_tis[key]
+                if ti.state == State.SUCCESS:
+                    succeeded.add(key)
+                    plan_updates[key] = State.SUCCESS
+                    graph.mark_succeeded(key)
+                    del db_tis[key]
+                elif ti.state == State.FAILED:
                     failed.append(key)
+                    plan_updates[key] = State.FAILED
                     logging.error("Task instance " + str(key) + " failed")
-                    del tasks_to_run[key]
-                    # Removing downstream tasks from the one that has failed
-                    for t in self.dag.get_task(task_id).get_flat_relatives(
-                            upstream=False):
-                        key = (ti.dag_id, t.task_id, execution_date)
-                        if key in tasks_to_run:
-                            wont_run.append(key)
-                            del tasks_to_run[key]
-                elif ti.state == State.SUCCESS:
-                    succeeded.append(key)
-                    del tasks_to_run[key]
+                    del db_tis[key]
+                    # Removing what depends on the one that has failed
+                    for k in graph.mark_failed(key):
+                        wont_run.add(k)
+                        plan_updates[k] = models.BackfillPlan.WONT_RUN
+                        db_tis.pop(k, None)
+                else:
+                    # Retries, task instances put back in the queue by
+                    # their pool or whose run didn't update the state
+                    heapq.heappush(rechecks, (now, key))
+
+            if len(graph) and not graph.ready and not rechecks and \
+                    not executor.queued_tasks and not executor.running:
+                # Nothing left can run, what's left is waiting on task
+                # instances that are not part of the backfill
+                logging.error(
+                    "Some task instances have unmet dependencies outside "
+                    "of the backfill: {}".format(sorted(graph.pending)))
+                for key in list(graph.pending):
+                    if key in graph.pending:
+                        for k in graph.drop(key):
+                            wont_run.add(k)
+                            plan_updates[k] = models.BackfillPlan.WONT_RUN
         executor.end()
         session.close()
         if failed:
             raise Exception(
                 "Some tasks instances failed, here's the list:\n"+str(failed))
 
+    def mark_success_in_bulk(self, keys, db_tis, tasks_by_id):
+        """
+        Marks task instances as successful the way ``airflow run
+        --mark_success`` does, without a process per task instance: the
+        task instances fetched from the database (``db_tis``) are updated
+        and the others inserted along with their log entries, with batched
+        statements committed a chunk at a time in the order of ``keys``.
+        """
+        TI = models.TaskInstance.__table__
+        Log = models.Log.__table__
+        update = TI.update().where(and_(
+            TI.c.dag_id == bindparam('b_dag_id'),
+            TI.c.task_id == bindparam('b_task_id'),
+            TI.c.execution_date == bindparam('b_execution_date'),
+        )).values(
+            state=State.SUCCESS,
+            start_date=bindparam('b_start_date'),
+            end_date=bindparam('b_start_date'),
+            duration=0,
+            try_number=bindparam('b_try_number'),
+            hostname=bindparam('b_hostname'),
+            unixname=bindparam('b_unixname'),
+            job_id=self.id,
+            pool=bindparam('b_pool'),
+            queue=bindparam('b_queue'),
+            priority_weight=bindparam('b_priority_weight'))
+        hostname = socket.gethostname()
+        unixname = getpass.getuser()
+        for chunk in utils.chunks(keys):
+            now = datetime.now()
+            inserts = []
+            updates = []
+            logs = []
+            for key in chunk:
+                dag_id, task_id, execution_date = key
+                task = tasks_by_id[task_id]
+                ti = db_tis.get(key)
+                if ti:
+                    updates.append({
+                        'b_dag_id': dag_id,
+                        'b_task_id': task_id,
+                        'b_execution_date': execution_date,
+                        'b_start_date': now,
+                        'b_try_number': (
+                            ti.try_number + 1
+                            if ti.state == State.UP_FOR_RETRY else 1),
+                        'b_hostname': hostname,
+                        'b_unixname': unixname,
+                        'b_pool': task.pool,
+                        'b_queue': task.queue,
+                        'b_priority_weight': task.priority_weight_total,
+                    })
+                else:
+                    inserts.append({
+                        'dag_id': dag_id,
+                        'task_id': task_id,
+                        'execution_date': execution_date,
+                        'state': State.SUCCESS,
+                        'start_date': now,
+                        'end_date': now,
+                        'duration': 0,
+                        'try_number': 1,
+                        'hostname': hostname,
+                        'unixname': unixname,
+                        'job_id': self.id,
+                        'pool': task.pool,
+                        'queue': task.queue,
+                        'priority_weight': task.priority_weight_total,
+                    })
+                for event in (State.RUNNING, State.SUCCESS):
+                    logs.append({
+                        'dttm': now,
+                        'dag_id': dag_id,
+                        'task_id': task_id,
+                        'event': event,
+                        'execution_date': execution_date,
+                        'owner': task.owner,
+                    })
+            with settings.engine.begin() as conn:
+                if updates:
+                    conn.execute(update, updates)
+                if inserts:
+                    conn.execute(TI.insert(), inserts)
+                conn.execute(Log.insert(), logs)
+            logging.info(
+                "Marked {} task instances as successful".format(len(chunk)))
+
+    def get_schedules(self):
+        """
+        Returns the tasks that are part of the backfill and the range of
+        their schedules
+        """
+        tasks = [
+            task for task in self.dag.tasks
+            if self.include_adhoc or not task.adhoc]
+        if not tasks:
+            return tasks, []
+        start_date = self.bf_start_date or tasks[0].start_date
+        end_date = (
+            self.bf_end_date or tasks[0].end_date or datetime.now())
+        return tasks, utils.ScheduleRange(
+            start_date, end_date, self.dag.schedule_interval)
+
+    def estimate(self):
+        """
+        Plans the backfill without running anything, to size parallelism
+        and pools before launching it.
+
+        The task instances that already succeeded are fetched in a single
+        query and skipped. Running the others is then simulated in the
+        order the backfill would run them, admitting max_active_runs
+        schedules at a time and filling the slots of the executor (capped
+        by ``max_running``) and of the pools, each task instance lasting
+        the average duration of the past runs of its task. Tasks without
+        history are counted as lasting the average of the others.
+
+        Returns a dictionary with the number of task instances to run,
+        the estimated wall-clock time in seconds, the use of the pools and
+        the critical path: the chain of dependent task instances that would
+        take the longest however many slots there are, as a list of
+        ``(key, seconds)``.
+        """
+        session = settings.Session()
+        tasks, schedules = self.get_schedules()
+        tasks_by_id = {task.task_id: task for task in tasks}
+        TI = models.TaskInstance
+        ti_states = {}
+        if schedules:
+            qry = session.query(TI.task_id, TI.execution_date).filter(
+                TI.dag_id == self.dag_id,
+                TI.state == State.SUCCESS,
+                TI.execution_date >=
+                schedules[0] - self.dag.schedule_interval,
+                TI.execution_date <= schedules.end_date,
+            )
+            for task_id, execution_date in qry:
+                ti_states[(task_id, execution_date)] = State.SUCCESS
+        durations = self.get_durations(session)
+        pool_slots = {
+            pool.pool: pool.slots for pool in session.query(models.Pool)}
+        session.commit()
+        session.close()
+
+        no_history = sorted(
+            task.task_id for task in tasks if task.task_id not in durations)
+        default_duration = (
+            sum(durations.values()) / len(durations) if durations else 0)
+        for task in tasks:
+            durations.setdefault(task.task_id, default_duration)
+        slots = [
+            n for n in (self.max_running, self.executor.parallelism) if n]
+        slots = min(slots) if slots else None
+
+        graph = BackfillGraph(self.dag, tasks)
+        schedules = iter(schedules)
+        pools = {
+            pool: {'slots': pool_slots[pool], 'task_instances': 0,
+                   'seconds': 0}
+            for pool in set(task.pool for task in tasks)
+            if pool in pool_slots}
+        open_slots = dict(pool_slots)
+        clock = 0
+        skipped = 0
+        to_run = 0
+        # Heaps of (end, key) and (-priority_weight, execution_date, key)
+        running = []
+        waiting = []
+        # Earliest finish of the task instances with unlimited slots, and
+        # their upstream task instance finishing last
+        finish = {}
+        ready_at = {}
+        critical_upstream = {}
+        while True:
+            for dttm in itertools.islice(
+                    schedules,
+                    max(0,
+                        self.dag.max_active_runs - len(graph.outstanding))):
+                skipped += len(graph.add_schedule(dttm, ti_states))
+            for key in graph.pop_ready():
+                heapq.heappush(
+                    waiting,
+                    (-graph.priority_weights[key[1]], key[2], key))
+            blocked = []
+            while waiting and (slots is None or len(running) < slots):
+                item = heapq.heappop(waiting)
+                key = item[2]
+                pool = tasks_by_id[key[1]].pool
+                if pool in open_slots:
+                    if open_slots[pool] <= 0:
+                        blocked.append(item)
+                        continue
+                    open_slots[pool] -= 1
+                    pools[pool]['task_instances'] += 1
+                    pools[pool]['seconds'] += durations[key[1]]
+                heapq.heappush(running, (clock + durations[key[1]], key))
+                to_run += 1
+            for item in blocked:
+                heapq.heappush(waiting, item)
+            if not running:
+                break
+
+            clock, key = heapq.heappop(running)
+            pool = tasks_by_id[key[1]].pool
+            if pool in open_slots:
+                open_slots[pool] += 1
+            finish[key] = ready_at.pop(key, 0) + durations[key[1]]
+            for dependent in graph.dependents.get(key, []):
+                if finish[key] >= ready_at.get(dependent, 0):
+                    ready_at[dependent] = finish[key]
+                    critical_upstream[dependent] = key
+            graph.mark_succeeded(key)
+
+        critical_path = []
+        if finish:
+            key = max(finish, key=lambda k: finish[k])
+            while key:
+                critical_path.append((key, durations[key[1]]))
+                key = critical_upstream.get(key)
+            critical_path.reverse()
+        return {
+            'task_instances': to_run,
+            'succeeded': skipped,
+            'blocked': len(graph),
+            'parallelism': slots,
+            'work_seconds': sum(durations[key[1]] for key in finish),
+            'estimated_seconds': clock,
+            'pools': pools,
+            'tasks_without_history': no_history,
+            'critical_path': critical_path,
+            'critical_path_seconds': sum(s for _, s in critical_path),
+        }
+
+    def get_durations(self, session):
+        """
+        Returns the average duration in seconds of the successful runs of
+        the tasks of the DAG, keyed by task_id, in a single query
+        """
+        TI = models.TaskInstance
+        durations = session.query(
+            TI.task_id, func.avg(TI.duration)
+        ).filter(
+            TI.dag_id == self.dag_id,
+            TI.state == State.SUCCESS,
+            TI.duration != None,
+        ).group_by(TI.task_id).all()
+        session.commit()
+        return {
+            task_id: float(duration)
+            for task_id, duration in durations}
+
+    def report_progress(
+            self, plan_id, total, yet_to_run, succeeded, started, failed,
+            wont_run, completed, elapsed, remaining_seconds=None):
+        """
+        Logs where the backfill stands along with its throughput, in task
+        instances completed per minute since it started, and an estimate of
+        the time left. The estimate spreads the historical durations of the
+        task instances left to run over the slots available to the backfill
+        or, without history to go by, extrapolates the throughput.
+
+        The same figures are written as JSON to ``progress_file`` if set,
+        through a temporary file so that readers never see it half written.
+        """
+        minutes = elapsed.total_seconds() / 60
+        throughput = completed / minutes if minutes else 0.0
+        if not yet_to_run:
+            eta = 0
+        elif remaining_seconds:
+            slots = [
+                n for n in (self.max_running, self.executor.parallelism)
+                if n]
+            eta = remaining_seconds / min(slots) if slots \
+                else remaining_seconds
+        elif throughput:
+            eta = 60 * yet_to_run / throughput
+        else:
+            eta = None
+        msg = (
+            "Yet to run: {0} | "
+            "Succeeded: {1} | "
+            "Started: {2} | "
+            "Failed: {3} | "
+            "Won't run: {4} | "
+            "Throughput: {5:.1f}/min | "
+            "ETA: {6}").format(
+            yet_to_run,
+            succeeded,
+            started,
+            failed,
+            wont_run,
+            throughput,
+            timedelta(seconds=int(eta)) if eta is not None else "unknown")
+        logging.info(msg)
+
+        if not self.progress_file:
+            return
+        now = datetime.now()
+        progress = {
+            'job_id': self.id,
+            'plan_id': plan_id,
+            'dag_id': self.dag_id,
+            'total': total,
+            'yet_to_run': yet_to_run,
+            'succeeded': succeeded,
+            'started': started,
+            'failed': failed,
+            'wont_run': wont_run,
+            'throughput_per_minute': throughput,
+            'eta_seconds': eta,
+            'estimated_end_date': (
+                now + timedelta(seconds=eta) if eta is not None else None),
+            'updated_at': now,
+        }
+        tmp = self.progress_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(progress, f, default=utils.json_ser, indent=4)
+        os.rename(tmp, self.progress_file)
+
+    def refresh_task_instances(self, tis, session):
+        """
+        Refreshes the task instances from the database in bulk, fetching
+        all the task instances of their execution dates in a few queries
+        instead of one per task instance. Task instances missing from the
+        database are left as they are.
+
+        Returns the states of the task instances fetched, which include the
+        previous schedule of the tasks that depend on the past, keyed by
+        ``(task_id, execution_date)`` for ``are_dependencies_met``.
+        """
+        execution_dates = set()
+        for ti in tis:
+            execution_dates.add(ti.execution_date)
+            if ti.task.depends_on_past:
+                execution_dates.add(
+                    ti.execution_date - ti.task.schedule_interval)
+        if not execution_dates:
+            return {}
+        db_tis = {
+            (ti.task_id, ti.execution_date): ti
+            for ti in self.dag.get_task_instances_for_dates(
+                session, execution_dates)}
+        session.expunge_all()
+        session.commit()
+        for ti in tis:
+            db_ti = db_tis.get((ti.task_id, ti.execution_date))
+            if db_ti:
+                ti.state = db_ti.state
+                ti.start_date = db_ti.start_date
+                ti.end_date = db_ti.end_date
+                ti.try_number = db_ti.try_number
+        return {key: ti.state for key, ti in db_tis.items()}
+
+
+class ShardedBackfillJob(BaseJob):
+    """
+    Splits the date range of a backfill into ``shards`` chunks of
+    consecutive schedules and runs an ``airflow backfill`` process for
+    each of them in parallel. The shards share the pools and the
+    ``max_running`` cap of the DAG through the metadata DB, and their
+    progress is reported as a whole.
+
+    As the chunks run independently, DAGs with tasks that depend on the
+    past can't be sharded.
+    """
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'ShardedBackfillJob'
+    }
+
+    def __init__(
+            self,
+            dag, start_date, end_date, shards,
+            subdir=None, task_regex=None, ignore_dependencies=False,
+            mark_success=False, include_adhoc=False, local=False,
+            max_running=None,
+            *args, **kwargs):
+        if any(task.depends_on_past for task in dag.tasks):
+            raise Exception(
+                "Can't shard the backfill of {}, some of its tasks depend "
+                "on the past".format(dag.dag_id))
+        self.dag = dag
+        self.dag_id = dag.dag_id
+        self.bf_start_date = start_date or dag.tasks[0].start_date
+        self.bf_end_date = (
+            end_date or dag.tasks[0].end_date or datetime.now())
+        self.shards = shards
+        self.subdir = subdir
+        self.task_regex = task_regex
+        self.ignore_dependencies = ignore_dependencies
+        self.mark_success = mark_success
+        self.include_adhoc = include_adhoc
+        self.local = local
+        self.max_running = max_running
+        self.processes = []
+        super(ShardedBackfillJob, self).__init__(*args, **kwargs)
+
+    def backfill_command(self, start_date, end_date):
+        """
+        Returns the command backfilling a chunk of the date range
+        """
+        cmd = [
+            'airflow', 'backfill', self.dag_id,
+            '-s', start_date.isoformat(), '-e', end_date.isoformat()]
+        if self.subdir:
+            cmd += ['-sd', self.subdir]
+        if self.task_regex:
+            cmd += ['-t', self.task_regex]
+        if self.ignore_dependencies:
+            cmd.append('-i')
+        if self.mark_success:
+            cmd.append('-m')
+        if self.include_adhoc:
+            cmd.append('-a')
+        if self.local:
+            cmd.append('-l')
+        if self.max_running:
+            cmd += ['--max_running', str(self.max_running)]
+        return cmd
+
+    def log_progress(self, total):
+        TI = models.TaskInstance
+        session = settings.Session()
+        counts = dict(session.query(TI.state, func.count(TI.task_id)).filter(
+            TI.dag_id == self.dag_id,
+            TI.task_id.in_([task.task_id for task in self.dag.tasks]),
+            TI.execution_date >= self.bf_start_date,
+            TI.execution_date <= self.bf_end_date,
+        ).group_by(TI.state))
+        session.commit()
+        session.close()
+        logging.info((
+            "Shards running: {0}/{1} | "
+            "Succeeded: {2}/{3} | "
+            "Running: {4} | "
+            "Up for retry: {5} | "
+            "Failed: {6} ").format(
+            len([p for p in self.processes if p.poll() is None]),
+            len(self.processes),
+            counts.get(State.SUCCESS, 0),
+            total,
+            counts.get(State.RUNNING, 0),
+            counts.get(State.UP_FOR_RETRY, 0),
+            counts.get(State.FAILED, 0)))
+
+    def _execute(self):
+        schedules = utils.ScheduleRange(
+            self.bf_start_date, self.bf_end_date,
+            self.dag.schedule_interval)
+        tasks = [
+            task for task in self.dag.tasks
+            if self.include_adhoc or not task.adhoc]
+        chunk_size = -(-len(schedules) // self.shards)
+        for i in xrange(0, len(schedules), chunk_size):
+            chunk = schedules[i:i + chunk_size]
+            cmd = self.backfill_command(chunk.start_date, chunk.end_date)
+            logging.info("Starting shard: " + " ".join(cmd))
+            self.processes.append(subprocess.Popen(cmd))
+
+        total = len(schedules) * len(tasks)
+        while any(p.poll() is None for p in self.processes):
+            self.heartbeat()
+            self.log_progress(total)
+        self.log_progress(total)
+
+        failed = [p for p in self.processes if p.returncode]
+        if failed:
+            raise Exception("{} out of {} shards failed".format(
+                len(failed), len(self.processes)))
+
+    def on_kill(self):
+        for p in self.processes:
+            if p.poll() is None:
+                p.terminate()
+
+
+class HeartbeatAgent(object):
+    """
+    Heartbeats all the LocalTaskJobs of a host at once. Instead of each of
+    them reading and updating its row of the job table every
+    ``job_heartbeat_sec``, the jobs register with the agent through a file
+    named after their id in ``folder``, holding their pid, and the agent
+    updates the heartbeats of the jobs whose process is alive in a single
+    query per interval. The shutdown requests of all the jobs are looked
+    up in a second query and handed over to them as ``<job_id>.shutdown``
+    files.
+
+    The agent touches an ``agent`` file in the folder as it goes, jobs that
+    find it stale heartbeat on their own.
+    """
+    def __init__(self, folder=None, heartrate=None):
+        self.folder = folder or os.path.join(
+            settings.AIRFLOW_HOME, 'heartbeats')
+        self.heartrate = heartrate or conf.getint(
+            'scheduler', 'JOB_HEARTBEAT_SEC')
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def path(self, name):
+        return os.path.join(self.folder, str(name))
+
+    def register(self, job_id, pid):
+        mkdir_p(self.folder)
+        # Renamed into place so the agent never reads a partial file
+        tmp = self.path('.{}.{}'.format(job_id, os.getpid()))
+        with open(tmp, 'w') as f:
+            f.write(str(pid))
+        os.rename(tmp, self.path(job_id))
+
+    def unregister(self, job_id):
+        for name in (job_id, str(job_id) + '.shutdown'):
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+
+    def is_running(self):
+        try:
+            mtime = os.path.getmtime(self.path('agent'))
+        except OSError:
+            return False
+        return time.time() - mtime < 2 * self.heartrate
+
+    def shutdown_requested(self, job_id):
+        return os.path.exists(self.path(str(job_id) + '.shutdown'))
+
+    def get_jobs(self):
+        """
+        Returns the pids of the jobs registered whose process is alive,
+        keyed by job id, forgetting about the others
+        """
+        jobs = {}
+        for name in os.listdir(self.folder):
+            if not name.isdigit():
+                continue
+            try:
+                with open(self.path(name)) as f:
+                    pid = int(f.read())
+            except (IOError, OSError, ValueError):
+                # Removed or being written, left for the next heartbeat
+                continue
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                # EPERM means the process is alive under another user
+                if e.errno == errno.ESRCH:
+                    self.unregister(name)
+                    continue
+            jobs[int(name)] = pid
+        return jobs
+
+    def heartbeat(self):
+        mkdir_p(self.folder)
+        with open(self.path('agent'), 'w'):
+            pass
+        job_ids = sorted(self.get_jobs())
+        if not job_ids:
+            return
+        session = settings.Session()
+        now = datetime.now()
+        shutdown = []
+        for ids in utils.chunks(job_ids):
+            session.query(BaseJob).filter(BaseJob.id.in_(ids)).update(
+                {BaseJob.latest_heartbeat: now}, synchronize_session=False)
+            shutdown += [
+                job.id for job in session.query(BaseJob.id).filter(
+                    BaseJob.id.in_(ids),
+                    BaseJob.state == State.SHUTDOWN)]
+        session.commit()
+        session.close()
+        for job_id in shutdown:
+            open(self.path(str(job_id) + '.shutdown'), 'w').close()
+        logging.debug(
+            "Heartbeat of {} jobs, {} to shut down".format(
+                len(job_ids), len(shutdown)))
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logging.exception(e)
+            self.stopped.wait(self.heartrate)
+
+    def start(self):
+        """
+        Runs the agent in a daemon thread of the current process
+        """
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
 
 class LocalTaskJob(BaseJob):
 
@@ -572,11 +2150,44 @@ class LocalTaskJob(BaseJob):
             mark_success=self.mark_success,
             job_id=self.id,
         )
-        self.process = subprocess.Popen(['bash', '-c', command])
-        return_code = None
-        while return_code is None:
-            self.heartbeat()
-            return_code = self.process.poll()
+        if conf.getboolean('core', 'fork_server'):
+            self.process = multiprocessing.Process(target=self.run_raw)
+            self.process.start()
+            poll = lambda: self.process.exitcode
+        else:
+            self.process = subprocess.Popen(['bash', '-c', command])
+            poll = self.process.poll
+        agent = None
+        if conf.getboolean('scheduler', 'heartbeat_agent'):
+            agent = HeartbeatAgent()
+            agent.register(self.id, os.getpid())
+        try:
+            return_code = None
+            while return_code is None:
+                if agent and agent.is_running():
+                    if agent.shutdown_requested(self.id):
+                        self.kill()
+                    sleep(self.heartrate)
+                else:
+                    self.heartbeat()
+                return_code = poll()
+        finally:
+            if agent:
+                agent.unregister(self.id)
+
+    def run_raw(self):
+        """
+        Runs the task instance the way ``airflow run --raw`` does, in a
+        process forked from this one
+        """
+        # Not touching the connections of the parent's pool
+        settings.Session.registry.clear()
+        settings.engine.pool = settings.engine.pool.recreate()
+        self.task_instance.run(
+            mark_success=self.mark_success,
+            force=self.force,
+            ignore_dependencies=self.ignore_dependencies,
+            job_id=self.id)
 
     def on_kill(self):
         self.process.terminate()
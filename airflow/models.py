@@ -1,3 +1,4 @@
+from collections import defaultdict
 import copy
 from datetime import datetime, timedelta
 import getpass
@@ -10,11 +11,12 @@ import re
 import signal
 import socket
 import sys
+import threading
 
 from sqlalchemy import (
     Column, Integer, String, DateTime, Text, Boolean, ForeignKey, PickleType,
     Index,)
-from sqlalchemy import func, or_
+from sqlalchemy import and_, bindparam, func, or_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.orm import relationship
@@ -520,13 +522,17 @@ class TaskInstance(Base):
         """
         return (self.dag_id, self.task_id, self.execution_date)
 
-    def is_queueable(self):
+    def is_queueable(self, ti_states=None):
         """
         Returns a boolean on whether the task instance has met all dependencies
         and is ready to run. It considers the task's state, the state
         of its dependencies, depends_on_past and makes sure the execution
         isn't in the future. It doesn't take into
         account whether the pool has a slot for it to run.
+
+        :param ti_states: optional snapshot of task instance states, refer to
+            ``are_dependencies_met``
+        :type ti_states: dict
         """
         if self.execution_date > datetime.now() - self.task.schedule_interval:
             return False
@@ -536,17 +542,23 @@ class TaskInstance(Base):
             return False
         elif (
                 self.state in State.runnable() and
-                self.are_dependencies_met()):
+                self.are_dependencies_met(ti_states=ti_states)):
             return True
         else:
             return False
 
-    def is_runnable(self):
+    def is_runnable(self, ti_states=None, pool_slots=None):
         """
         Returns whether a task is ready to run AND there's room in the
         queue.
+
+        :param pool_slots: optional number of open slots per pool, refer to
+            ``pool_full``
+        :type pool_slots: dict
         """
-        return self.is_queueable() and not self.pool_full()
+        return (
+            self.is_queueable(ti_states=ti_states) and
+            not self.pool_full(pool_slots=pool_slots))
 
     def are_dependents_done(self, main_session=None):
         """
@@ -576,16 +588,43 @@ class TaskInstance(Base):
             session.close()
         return count == len(task._downstream_list)
 
-    def are_dependencies_met(self, main_session=None):
+    def are_dependencies_met(self, main_session=None, ti_states=None):
         """
         Returns a boolean on whether the upstream tasks are in a SUCCESS state
         and considers depends_on_past and the previous run's state.
+
+        :param ti_states: a dictionary of task instance states keyed by
+            ``(task_id, execution_date)``, as returned by
+            ``DAG.get_task_instance_states``. When provided, the
+            dependencies are evaluated against this snapshot in memory
+            instead of querying the database. It needs to cover the
+            upstream tasks for this execution date as well as the previous
+            schedule when depends_on_past is set.
+        :type ti_states: dict
         """
         TI = TaskInstance
+        task = self.task
+
+        if ti_states is not None:
+            if (task.depends_on_past and
+                    not self.execution_date == task.start_date):
+                previous_date = self.execution_date - task.schedule_interval
+                if ti_states.get(
+                        (task.task_id, previous_date)) != State.SUCCESS:
+                    return False
+                # Applying wait_for_downstream
+                if task.wait_for_downstream and not all([
+                        ti_states.get((t.task_id, previous_date)) ==
+                        State.SUCCESS
+                        for t in task._downstream_list]):
+                    return False
+            return all([
+                ti_states.get((t.task_id, self.execution_date)) ==
+                State.SUCCESS
+                for t in task._upstream_list])
 
         # Using the session if passed as param
         session = main_session or settings.Session()
-        task = self.task
 
         # Checking that the depends_on_past is fulfilled
         if (task.depends_on_past and
@@ -639,14 +678,22 @@ class TaskInstance(Base):
             self.end_date + self.task.retry_delay < datetime.now()
 
     @provide_session
-    def pool_full(self, session):
+    def pool_full(self, session, pool_slots=None):
         """
         Returns a boolean as to whether the slot pool has room for this
         task to run
+
+        :param pool_slots: optional number of open slots per pool, as
+            returned by ``Pool.get_open_slots``, to use instead of counting
+            the task instances running in the pool
+        :type pool_slots: dict
         """
         if not self.task.pool:
             return False
 
+        if pool_slots is not None:
+            return pool_slots.get(self.task.pool, 1) <= 0
+
         pool = (
             session
             .query(Pool)
@@ -742,7 +789,12 @@ class TaskInstance(Base):
                         logging.error("Killing subprocess")
                         task_copy.on_kill()
                         raise Exception("Task received SIGTERM signal")
-                    signal.signal(signal.SIGTERM, signal_handler)
+                    # Signal handlers can only be set from the main thread,
+                    # the ThreadExecutor kills its threads on its own
+                    if isinstance(
+                            threading.current_thread(),
+                            threading._MainThread):
+                        signal.signal(signal.SIGTERM, signal_handler)
 
                     self.render_templates()
                     task_copy.execute(context=self.get_template_context())
@@ -896,6 +948,241 @@ class Log(Base):
         self.owner = task_instance.task.owner
 
 
+class BackfillPlan(Base):
+    """
+    The task instances a backfill job planned to run and where each of
+    them stands, recorded as the backfill goes so that a backfill that got
+    interrupted can be resumed without looking again at the task instances
+    it got done.
+
+    Rows are keyed by the id of the backfill job that started the plan,
+    which the jobs resuming it keep writing to.
+    """
+
+    __tablename__ = "backfill_plan"
+
+    WONT_RUN = "wont_run"
+
+    job_id = Column(Integer, primary_key=True)
+    dag_id = Column(String(ID_LEN), primary_key=True)
+    task_id = Column(String(ID_LEN), primary_key=True)
+    execution_date = Column(DateTime, primary_key=True)
+    state = Column(String(20))
+
+    __table_args__ = (
+        Index('bp_job_state', job_id, state),
+    )
+
+    @classmethod
+    def get_states(cls, session, job_id, dag_id, execution_dates):
+        """
+        Returns the states recorded in the plan of a backfill job for a set
+        of execution dates, keyed by task instance key
+        """
+        states = {}
+        for dates in utils.chunks(sorted(set(execution_dates))):
+            for row in session.query(cls).filter(
+                    cls.job_id == job_id,
+                    cls.dag_id == dag_id,
+                    cls.execution_date.in_(dates)):
+                states[(row.dag_id, row.task_id, row.execution_date)] = \
+                    row.state
+        return states
+
+    @classmethod
+    def insert(cls, job_id, states):
+        """
+        Adds task instances to the plan of a backfill job in bulk, from
+        their states keyed by task instance key
+        """
+        rows = [{
+            'job_id': job_id,
+            'dag_id': dag_id,
+            'task_id': task_id,
+            'execution_date': execution_date,
+            'state': state,
+        } for (dag_id, task_id, execution_date), state in states.items()]
+        for chunk in utils.chunks(rows):
+            settings.engine.execute(cls.__table__.insert(), chunk)
+
+    @classmethod
+    def update(cls, job_id, states):
+        """
+        Records the new states of task instances of the plan of a backfill
+        job in bulk, from their states keyed by task instance key
+        """
+        table = cls.__table__
+        rows = [{
+            'b_dag_id': dag_id,
+            'b_task_id': task_id,
+            'b_execution_date': execution_date,
+            'b_state': state,
+        } for (dag_id, task_id, execution_date), state in states.items()]
+        statement = table.update().where(and_(
+            table.c.job_id == job_id,
+            table.c.dag_id == bindparam('b_dag_id'),
+            table.c.task_id == bindparam('b_task_id'),
+            table.c.execution_date == bindparam('b_execution_date'),
+        )).values(state=bindparam('b_state'))
+        for chunk in utils.chunks(rows):
+            settings.engine.execute(statement, chunk)
+
+
+class QueuedCommand(Base):
+    """
+    The work queue of the DatabaseExecutor. The executor inserts the
+    commands it is handed, workers claim them, run them and record how
+    they went, and the executor collects the commands that are done in a
+    single query.
+    """
+
+    __tablename__ = "queued_command"
+
+    id = Column(Integer, primary_key=True)
+    executor_id = Column(String(50))
+    dag_id = Column(String(ID_LEN))
+    task_id = Column(String(ID_LEN))
+    execution_date = Column(DateTime)
+    command = Column(Text)
+    queue = Column(String(50))
+    priority = Column(Integer)
+    state = Column(String(20))
+    hostname = Column(String(500))
+    queued_at = Column(DateTime)
+    start_date = Column(DateTime)
+    end_date = Column(DateTime)
+    latest_heartbeat = Column(DateTime)
+
+    __table_args__ = (
+        Index('qc_queue_state', queue, state, priority),
+        Index('qc_executor_state', executor_id, state),
+    )
+
+    @classmethod
+    def enqueue(cls, executor_id, commands):
+        """
+        Inserts commands in bulk, from (key, command, priority, queue)
+        tuples
+        """
+        now = datetime.now()
+        rows = [{
+            'executor_id': executor_id,
+            'dag_id': dag_id,
+            'task_id': task_id,
+            'execution_date': execution_date,
+            'command': command,
+            'priority': priority,
+            'queue': queue,
+            'state': State.QUEUED,
+            'queued_at': now,
+        } for (dag_id, task_id, execution_date), command, priority, queue
+            in commands]
+        for chunk in utils.chunks(rows):
+            settings.engine.execute(cls.__table__.insert(), chunk)
+
+    @classmethod
+    def claim(cls, queues, limit, hostname):
+        """
+        Marks up to ``limit`` of the commands queued on ``queues`` as
+        running on ``hostname``, highest priority first, and returns their
+        (id, command) tuples. Workers claiming at the same time never get
+        the same command.
+        """
+        session = settings.Session()
+        now = datetime.now()
+        values = {
+            cls.state: State.RUNNING,
+            cls.hostname: hostname,
+            cls.start_date: now,
+            cls.latest_heartbeat: now,
+        }
+        query = session.query(cls.id, cls.command).filter(
+            cls.state == State.QUEUED,
+            cls.queue.in_(queues),
+        ).order_by(cls.priority.desc(), cls.id).limit(limit)
+        if settings.engine.dialect.name in ('postgresql', 'mysql'):
+            # Workers skip the rows the others are claiming
+            claimed = query.with_for_update(skip_locked=True).all()
+            if claimed:
+                session.query(cls).filter(
+                    cls.id.in_([row.id for row in claimed])
+                ).update(values, synchronize_session=False)
+        else:
+            # SQLite has no row locks but serializes the writes, a command
+            # goes to the worker that first flips it out of the queue
+            claimed = [
+                row for row in query.all()
+                if session.query(cls).filter(
+                    cls.id == row.id, cls.state == State.QUEUED
+                ).update(values, synchronize_session=False)]
+        session.commit()
+        session.close()
+        return [(row.id, row.command) for row in claimed]
+
+    @classmethod
+    def heartbeat(cls, ids):
+        """
+        Records that the commands of ``ids`` are still running
+        """
+        session = settings.Session()
+        for chunk in utils.chunks(sorted(ids)):
+            session.query(cls).filter(cls.id.in_(chunk)).update(
+                {cls.latest_heartbeat: datetime.now()},
+                synchronize_session=False)
+        session.commit()
+        session.close()
+
+    @classmethod
+    def finish(cls, states):
+        """
+        Records the final states of commands in bulk, keyed by id
+        """
+        table = cls.__table__
+        now = datetime.now()
+        rows = [
+            {'b_id': id_, 'b_state': state}
+            for id_, state in states.items()]
+        statement = table.update().where(
+            table.c.id == bindparam('b_id')
+        ).values(state=bindparam('b_state'), end_date=now)
+        for chunk in utils.chunks(rows):
+            settings.engine.execute(statement, chunk)
+
+    @classmethod
+    def collect(cls, executor_id, heartbeat_timeout):
+        """
+        Returns the states of the commands of an executor that are done,
+        keyed by task instance key, and deletes them. The commands whose
+        worker stopped heartbeating for ``heartbeat_timeout`` seconds are
+        considered failed.
+        """
+        session = settings.Session()
+        cutoff = datetime.now() - timedelta(seconds=heartbeat_timeout)
+        done = session.query(cls).filter(
+            cls.executor_id == executor_id,
+            or_(
+                cls.state.in_([State.SUCCESS, State.FAILED]),
+                and_(
+                    cls.state == State.RUNNING,
+                    cls.latest_heartbeat < cutoff),
+            )).all()
+        states = {}
+        for row in done:
+            state = row.state
+            if state == State.RUNNING:
+                logging.error(
+                    "The worker running {} on {} stopped heartbeating".format(
+                        row.command, row.hostname))
+                state = State.FAILED
+            states[(row.dag_id, row.task_id, row.execution_date)] = state
+        for chunk in utils.chunks([row.id for row in done]):
+            session.query(cls).filter(cls.id.in_(chunk)).delete(
+                synchronize_session=False)
+        session.commit()
+        session.close()
+        return states
+
+
 class BaseOperator(object):
     """
     Abstract base class for all operators. Since operators create objects that
@@ -961,6 +1248,12 @@ class BaseOperator(object):
     :param pool: the slot pool this task should run in, slot pools are a
         way to limit concurrency for certain tasks
     :type pool: str
+    :param cpus: how many CPU cores the task needs, the LocalExecutor only
+        runs it when that many are left on the host
+    :type cpus: float
+    :param memory_mb: how much memory the task needs, in MB, the
+        LocalExecutor only runs it when that much is left on the host
+    :type memory_mb: int
     """
 
     # For derived classes to define which fields will get jinjaified
@@ -970,6 +1263,8 @@ class BaseOperator(object):
     # Defines the color in the UI
     ui_color = '#fff'
     ui_fgcolor = '#000'
+    # Whether the ThreadExecutor runs the task instances in a thread
+    run_in_thread = False
 
     @apply_defaults
     def __init__(
@@ -993,6 +1288,8 @@ class BaseOperator(object):
             priority_weight=1,
             queue=None,
             pool=None,
+            cpus=None,
+            memory_mb=None,
             *args,
             **kwargs):
 
@@ -1011,6 +1308,8 @@ class BaseOperator(object):
         self.retries = retries
         self.queue = queue
         self.pool = pool
+        self.cpus = cpus
+        self.memory_mb = memory_mb
         if isinstance(retry_delay, timedelta):
             self.retry_delay = retry_delay
         else:
@@ -1210,7 +1509,7 @@ class BaseOperator(object):
         start_date = start_date or self.start_date
         end_date = end_date or self.end_date or datetime.now()
 
-        for dt in utils.date_range(
+        for dt in utils.ScheduleRange(
                 start_date, end_date, self.schedule_interval):
             TaskInstance(self, dt).run(
                 mark_success=mark_success,
@@ -1293,6 +1592,9 @@ class DagModel(Base):
     last_expired = Column(DateTime)
     # Whether (one  of) the scheduler is scheduling this DAG at the moment
     scheduler_lock = Column(Boolean)
+    # Which scheduler holds the lock, and until when
+    scheduler_lock_owner = Column(String(500))
+    scheduler_lock_expiry = Column(DateTime)
     # Foreign key to the latest pickle_id
     pickle_id = Column(Integer)
     # The location of the file containing the DAG object
@@ -1312,6 +1614,54 @@ class DagModel(Base):
         session.close()
         return obj
 
+    @classmethod
+    def acquire_scheduler_lock(
+            cls, dag_id, owner, lease, min_interval, session):
+        """
+        Takes a lease on a DAG for a scheduler in a single conditional
+        UPDATE, which succeeds only if no other scheduler holds an
+        unexpired lease on it and if it wasn't scheduled in the last
+        ``min_interval``. Leases left behind by a scheduler that died
+        simply expire after ``lease``.
+
+        Returns whether the lease was acquired.
+        """
+        now = datetime.now()
+        count = session.query(cls).filter(
+            cls.dag_id == dag_id,
+            or_(
+                cls.scheduler_lock == None,
+                cls.scheduler_lock == False,
+                cls.scheduler_lock_expiry == None,
+                cls.scheduler_lock_expiry < now),
+            or_(
+                cls.last_scheduler_run == None,
+                cls.last_scheduler_run <= now - min_interval),
+        ).update({
+            cls.scheduler_lock: True,
+            cls.scheduler_lock_owner: owner,
+            cls.scheduler_lock_expiry: now + lease,
+            cls.last_scheduler_run: now,
+        }, synchronize_session=False)
+        session.commit()
+        return count == 1
+
+    @classmethod
+    def release_scheduler_lock(cls, dag_id, owner, session):
+        """
+        Releases the lease taken by ``acquire_scheduler_lock``, as long as
+        it still belongs to ``owner``
+        """
+        session.query(cls).filter(
+            cls.dag_id == dag_id,
+            cls.scheduler_lock_owner == owner,
+        ).update({
+            cls.scheduler_lock: False,
+            cls.scheduler_lock_owner: None,
+            cls.scheduler_lock_expiry: None,
+        }, synchronize_session=False)
+        session.commit()
+
 
 class DAG(object):
     """
@@ -1353,6 +1703,12 @@ class DAG(object):
         accessible in templates, namespaced under `params`. These
         params can be overridden at the task level.
     :type params: dict
+    :param max_active_runs: maximum number of execution dates the scheduler
+        will have in flight at once for this DAG, which is also how many
+        schedules it will catch up on in a single pass when the DAG is
+        behind. Backfills work through their date range this many
+        schedules at a time as well.
+    :type max_active_runs: int
     """
 
     def __init__(
@@ -1363,7 +1719,8 @@ class DAG(object):
             template_searchpath=None,
             user_defined_macros=None,
             default_args=None,
-            params=None):
+            params=None,
+            max_active_runs=conf.getint('core', 'MAX_ACTIVE_RUNS_PER_DAG')):
 
         self.user_defined_macros = user_defined_macros
         self.default_args = default_args or {}
@@ -1374,6 +1731,7 @@ class DAG(object):
         self.start_date = start_date
         self.end_date = end_date or datetime.now()
         self.schedule_interval = schedule_interval
+        self.max_active_runs = max_active_runs
         self.full_filepath = full_filepath if full_filepath else ''
         if isinstance(template_searchpath, basestring):
             template_searchpath = [template_searchpath]
@@ -1486,6 +1844,32 @@ class DAG(object):
         ).all()
         return tis
 
+    def get_task_instances_for_dates(self, session, execution_dates):
+        """
+        Returns the task instances of this DAG for a set of execution dates,
+        fetched in a few set-based queries (one per chunk of dates) instead
+        of one query per task instance.
+        """
+        TI = TaskInstance
+        tis = []
+        for dates in utils.chunks(sorted(set(execution_dates))):
+            tis += session.query(TI).filter(
+                TI.dag_id == self.dag_id,
+                TI.execution_date.in_(dates),
+            ).all()
+        return tis
+
+    def get_task_instance_states(self, session, execution_dates):
+        """
+        Returns a dictionary of task instance states keyed by
+        ``(task_id, execution_date)`` for a set of execution dates. Task
+        instances that don't exist in the database are left out.
+        """
+        return {
+            (ti.task_id, ti.execution_date): ti.state
+            for ti in self.get_task_instances_for_dates(
+                session, execution_dates)}
+
     @property
     def roots(self):
         return [t for t in self.tasks if not t.downstream_list]
@@ -1697,7 +2081,8 @@ class DAG(object):
     def run(
             self, start_date=None, end_date=None, mark_success=False,
             include_adhoc=False, local=False, executor=None,
-            donot_pickle=False):
+            donot_pickle=False, max_running=None, resume_job_id=None,
+            progress_file=None):
         from airflow.jobs import BackfillJob
         if not executor and local:
             executor = LocalExecutor()
@@ -1710,7 +2095,10 @@ class DAG(object):
             mark_success=mark_success,
             include_adhoc=include_adhoc,
             executor=executor,
-            donot_pickle=donot_pickle)
+            donot_pickle=donot_pickle,
+            max_running=max_running,
+            resume_job_id=resume_job_id,
+            progress_file=progress_file)
         job.run()
 
 
@@ -1829,3 +2217,36 @@ class Pool(Base):
         """
         used_slots = self.used_slots(session=session)
         return self.slots - used_slots
+
+    @staticmethod
+    def get_usage(session):
+        """
+        Returns the number of running and queued task instances per pool as
+        ``{pool: {state: count}}``, in a single query
+        """
+        qry = (
+            session
+            .query(
+                TaskInstance.pool, TaskInstance.state,
+                func.count(TaskInstance.task_id))
+            .filter(TaskInstance.state.in_((State.RUNNING, State.QUEUED)))
+            .group_by(TaskInstance.pool, TaskInstance.state)
+        )
+        usage = defaultdict(dict)
+        for pool, state, count in qry:
+            usage[pool][state] = count
+        return usage
+
+    @staticmethod
+    def get_open_slots(session, usage=None):
+        """
+        Returns the number of open slots of every pool as ``{pool: slots}``,
+        counting the running task instances of all the pools at once. The
+        usage of the pools can be passed as returned by ``get_usage``.
+        """
+        if usage is None:
+            usage = Pool.get_usage(session)
+        return {
+            pool.pool: pool.slots - usage.get(pool.pool, {}).get(
+                State.RUNNING, 0)
+            for pool in session.query(Pool)}
@@ -26,6 +26,7 @@ class BaseSensorOperator(BaseOperator):
     :type timeout: int
     '''
     ui_color = '#e6f1f2'
+    run_in_thread = True
 
     @apply_defaults
     def __init__(
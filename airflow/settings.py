@@ -33,6 +33,15 @@ engine = create_engine(
 Session = scoped_session(
     sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
+# Setting up a statsd client if needed
+statsd = None
+if conf.getboolean('scheduler', 'statsd_on'):
+    from statsd import StatsClient
+    statsd = StatsClient(
+        host=conf.get('scheduler', 'statsd_host'),
+        port=conf.getint('scheduler', 'statsd_port'),
+        prefix=conf.get('scheduler', 'statsd_prefix'))
+
 # can't move this to configuration due to ConfigParser interpolation
 LOG_FORMAT =  \
     '[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
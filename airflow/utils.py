@@ -10,6 +10,7 @@ import logging
 import os
 import re
 import shutil
+import signal
 import smtplib
 from tempfile import mkdtemp
 
@@ -22,6 +23,10 @@ from airflow.configuration import conf
 from airflow import settings
 
 
+class AirflowTimeout(Exception):
+    pass
+
+
 class State(object):
     """
     Static class with task instance states constants and color method to
@@ -67,6 +72,25 @@ def pessimistic_connection_handling():
         cursor.close()
 
 
+class QueryCounter(object):
+    """
+    Counts the statements run against a SQLAlchemy engine, for
+    instrumentation purposes.
+
+    >>> counter = QueryCounter(settings.engine)
+    >>> before = counter.count
+    >>> n = settings.engine.execute("SELECT 1").scalar()
+    >>> counter.count - before
+    1
+    """
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.increment)
+
+    def increment(self, *args, **kwargs):
+        self.count += 1
+
+
 def initdb():
     from airflow import models
     logging.info("Creating all tables")
@@ -180,15 +204,117 @@ def validate_key(k, max_length=250):
         return True
 
 
-def date_range(start_date, end_date=datetime.now(), delta=timedelta(1)):
-    l = []
-    if end_date >= start_date:
-        while start_date <= end_date:
-            l.append(start_date)
-            start_date += delta
-    else:
-        raise Exception("start_date can't be after end_date")
-    return l
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+class ScheduleRange(object):
+    """
+    Lazy, constant memory sequence of the schedules from ``start_date`` to
+    ``end_date`` included, ``delta`` apart. It iterates like the list
+    ``date_range`` returns, while its length, indexing, slicing and
+    membership tests are worked out by arithmetic.
+
+    >>> r = ScheduleRange(
+    ...     datetime(2015, 1, 1), datetime(2015, 1, 10), timedelta(days=3))
+    >>> len(r)
+    4
+    >>> r[-1]
+    datetime.datetime(2015, 1, 10, 0, 0)
+    >>> list(r[1:3])
+    [datetime.datetime(2015, 1, 4, 0, 0), datetime.datetime(2015, 1, 7, 0, 0)]
+    >>> datetime(2015, 1, 7) in r, datetime(2015, 1, 8) in r
+    (True, False)
+    """
+    def __init__(self, start_date, end_date=None, delta=timedelta(1)):
+        end_date = end_date or datetime.now()
+        if end_date < start_date:
+            raise Exception("start_date can't be after end_date")
+        if delta <= timedelta(0):
+            raise Exception("delta has to be positive")
+        self.start_date = start_date
+        self.delta = delta
+        self._len = (
+            _microseconds(end_date - start_date) // _microseconds(delta) + 1)
+
+    @classmethod
+    def _from_length(cls, start_date, delta, length):
+        r = cls.__new__(cls)
+        r.start_date = start_date
+        r.delta = delta
+        r._len = length
+        return r
+
+    @property
+    def end_date(self):
+        """
+        The last schedule of the range
+        """
+        return self.start_date + (self._len - 1) * self.delta
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        dttm = self.start_date
+        for i in xrange(self._len):
+            yield dttm
+            dttm += self.delta
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._len)
+            if step < 0:
+                return [self[i] for i in xrange(start, stop, step)]
+            length = max(0, (stop - start + step - 1) // step)
+            return ScheduleRange._from_length(
+                self.start_date + start * self.delta,
+                self.delta * step,
+                length)
+        if item < 0:
+            item += self._len
+        if not 0 <= item < self._len:
+            raise IndexError("ScheduleRange index out of range")
+        return self.start_date + item * self.delta
+
+    def index(self, dttm):
+        """
+        Returns the position of a schedule in the range
+        """
+        offset = _microseconds(dttm - self.start_date)
+        i, remainder = divmod(offset, _microseconds(self.delta))
+        if remainder or not 0 <= i < self._len:
+            raise ValueError("{} is not in the range".format(dttm))
+        return i
+
+    def __contains__(self, dttm):
+        try:
+            self.index(dttm)
+        except ValueError:
+            return False
+        return True
+
+    def __repr__(self):
+        return "ScheduleRange({!r}, {!r}, {!r})".format(
+            self.start_date, self.end_date, self.delta)
+
+
+def date_range(start_date, end_date=None, delta=timedelta(1)):
+    """
+    Returns the list of the schedules from ``start_date`` to ``end_date``
+    included, ``delta`` apart. ``end_date`` defaults to now. Use
+    ``ScheduleRange`` to iterate over long ranges without building a list.
+    """
+    return list(ScheduleRange(start_date, end_date, delta))
+
+
+def chunks(items, chunk_size=500):
+    """
+    Yields successive chunks of a list, used to split large ``IN`` clauses
+    into multiple queries
+    """
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
 
 
 def json_ser(obj):
@@ -404,3 +530,22 @@ def TemporaryDirectory(suffix='', prefix=None, dir=None):
                 # ENOENT - no such file or directory
                 if e.errno != errno.ENOENT:
                     raise e
+
+
+@contextmanager
+def timeout(seconds, error_message='Timeout'):
+    """
+    Raises AirflowTimeout if the block takes longer than ``seconds`` to
+    complete. This relies on SIGALRM, so it only works in the main thread
+    of a process.
+    """
+    def handle_timeout(signum, frame):
+        raise AirflowTimeout(error_message)
+
+    previous_handler = signal.signal(signal.SIGALRM, handle_timeout)
+    signal.alarm(seconds)
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous_handler)
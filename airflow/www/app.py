@@ -195,6 +195,8 @@ class DagModelView(SuperUserMixin, ModelView):
         'last_expired': {'disabled': True},
         'pickle_size': {'disabled': True},
         'scheduler_lock': {'disabled': True},
+        'scheduler_lock_owner': {'disabled': True},
+        'scheduler_lock_expiry': {'disabled': True},
         'owners': {'disabled': True},
     }
     column_formatters = dict(
@@ -974,7 +976,7 @@ class Airflow(BaseView):
         from_date = (base_date-(num_runs * dag.schedule_interval)).date()
         from_date = datetime.combine(from_date, from_time)
 
-        dates = utils.date_range(
+        dates = utils.ScheduleRange(
             from_date, base_date, dag.schedule_interval)
         task_instances = {}
         for ti in dag.get_task_instances(session, from_date):
@@ -0,0 +1,323 @@
+"""
+Benchmarks the scheduler against a folder of synthetic DAGs, with some
+task instance history pre-populated in the metadata database. For
+instance, to measure 5 runs of the scheduler over 100 daily DAGs of 20
+tasks with a month of history and the last 2 schedules left to run:
+
+    python -m benchmarks.scheduler_benchmark --dags 100 --tasks 20 \\
+        --history 30 --catch_up 2 --loops 5 --output results.json
+
+The metadata database is the one ``sql_alchemy_conn`` points to in the
+airflow configuration, SQLite or a local Postgres typically. Use a
+throwaway one: the benchmark replaces the rows of the synthetic DAGs and
+the scheduler marks the DAGs it doesn't know about as inactive.
+
+The task instances the scheduler queues are marked as successful right
+away without running anything, so the figures reported are the time
+spent in the scheduler's runs (minus the executor's heartbeat), the
+number of queries they run and the task instances queued per second.
+Passing ``--baseline`` with the output of a previous run prints how the
+figures moved.
+"""
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import logging
+import shutil
+import sys
+import tempfile
+
+from sqlalchemy import and_, bindparam
+
+from airflow import jobs
+from airflow import models
+from airflow import settings
+from airflow import utils
+from airflow.executors.base_executor import BaseExecutor
+from airflow.utils import State
+
+from benchmarks.synthetic_dags import DAG_ID_PREFIX, generate_dag_folder
+
+
+class InstantExecutor(BaseExecutor):
+    """
+    Marks the task instances it is handed as successful in the metadata
+    database without running anything, so that the benchmark measures the
+    scheduler alone.
+    """
+    def __init__(self, parallelism=0):
+        super(InstantExecutor, self).__init__(parallelism=parallelism)
+        self.to_succeed = []
+        self.dispatched = 0
+
+    def execute_async(self, key, command, queue=None):
+        self.to_succeed.append(key)
+        self.dispatched += 1
+
+    def sync(self):
+        if not self.to_succeed:
+            return
+        table = models.TaskInstance.__table__
+        now = datetime.now()
+        settings.engine.execute(
+            table.delete().where(and_(
+                table.c.dag_id == bindparam('b_dag_id'),
+                table.c.task_id == bindparam('b_task_id'),
+                table.c.execution_date == bindparam('b_execution_date'))),
+            [{
+                'b_dag_id': dag_id,
+                'b_task_id': task_id,
+                'b_execution_date': execution_date,
+            } for dag_id, task_id, execution_date in self.to_succeed])
+        settings.engine.execute(table.insert(), [{
+            'dag_id': dag_id,
+            'task_id': task_id,
+            'execution_date': execution_date,
+            'state': State.SUCCESS,
+            'start_date': now,
+            'end_date': now,
+            'duration': 0,
+            'try_number': 1,
+        } for dag_id, task_id, execution_date in self.to_succeed])
+        for key in self.to_succeed:
+            self.success(key)
+        self.to_succeed = []
+
+    def end(self):
+        self.heartbeat()
+
+
+class BenchmarkSchedulerJob(jobs.SchedulerJob):
+    """
+    Scheduler that only looks at the synthetic DAGs, doesn't wait between
+    its runs and records how long each of them took, how many queries they
+    ran and how many task instances they queued.
+    """
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'BenchmarkSchedulerJob'
+    }
+
+    def __init__(self, dag_folder, *args, **kwargs):
+        super(BenchmarkSchedulerJob, self).__init__(
+            subdir=dag_folder, *args, **kwargs)
+        self.heartrate = 0
+        self.runs = []
+        self.phases = defaultdict(list)
+        self.start_run()
+
+    def start_run(self):
+        self.run_start = datetime.now()
+        self.run_queries = jobs.query_counter.count
+        self.run_dispatched = self.executor.dispatched
+        self.executor_seconds = 0
+        self.executor_queries = 0
+
+    def get_dagbag(self):
+        return models.DagBag(
+            self.subdir, executor=self.executor, include_examples=False,
+            sync_to_db=True)
+
+    @contextmanager
+    def phase(self, name):
+        if name == 'prioritize_queued':
+            # First phase of a run
+            self.start_run()
+        start = datetime.now()
+        queries = jobs.query_counter.count
+        with super(BenchmarkSchedulerJob, self).phase(name):
+            yield
+        seconds = (datetime.now() - start).total_seconds()
+        queries = jobs.query_counter.count - queries
+        if name == 'executor_heartbeat':
+            self.executor_seconds += seconds
+            self.executor_queries += queries
+        elif not name.startswith('process_dag.'):
+            self.phases[name].append(seconds)
+
+    def heartbeat(self):
+        self.runs.append({
+            'seconds': (
+                (datetime.now() - self.run_start).total_seconds() -
+                self.executor_seconds),
+            'queries': (
+                jobs.query_counter.count - self.run_queries -
+                self.executor_queries),
+            'queued': self.executor.dispatched - self.run_dispatched,
+        })
+
+
+def clean_up():
+    """
+    Deletes what previous benchmarks left behind in the metadata database
+    """
+    session = settings.Session()
+    for model in (models.TaskInstance, models.DagModel):
+        session.query(model).filter(
+            model.dag_id.like(DAG_ID_PREFIX + '%')
+        ).delete(synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+def populate_history(dagbag, start_date, interval, history):
+    """
+    Inserts ``history`` schedules of successful task instances for all
+    the DAGs of ``dagbag``, starting on ``start_date``
+    """
+    execution_dates = [start_date + i * interval for i in range(history)]
+    rows = [{
+        'dag_id': dag.dag_id,
+        'task_id': task.task_id,
+        'execution_date': execution_date,
+        'state': State.SUCCESS,
+        'start_date': execution_date + interval,
+        'end_date': execution_date + interval,
+        'duration': 0,
+        'try_number': 1,
+    } for dag in dagbag.dags.values()
+        for task in dag.tasks
+        for execution_date in execution_dates]
+    table = models.TaskInstance.__table__
+    for chunk in utils.chunks(rows, 1000):
+        settings.engine.execute(table.insert(), chunk)
+    return len(rows)
+
+
+def summarize(job, dag_parsing_seconds):
+    runs = job.runs
+    seconds = sum(run['seconds'] for run in runs)
+    queued = sum(run['queued'] for run in runs)
+    results = {
+        'runs': len(runs),
+        'dag_parsing_seconds': dag_parsing_seconds,
+        'loop_seconds_mean': seconds / len(runs),
+        'loop_seconds_max': max(run['seconds'] for run in runs),
+        'queries_per_loop': (
+            float(sum(run['queries'] for run in runs)) / len(runs)),
+        'queued': queued,
+        'queued_per_second': queued / seconds if seconds else 0,
+    }
+    for name, durations in job.phases.items():
+        results[name + '_seconds_mean'] = sum(durations) / len(durations)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Returns the lines describing how the figures moved since the baseline
+    """
+    lines = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        before, after = baseline[key], results[key]
+        if before:
+            change = "{:+.1f}%".format(100.0 * (after - before) / before)
+        else:
+            change = "n/a"
+        lines.append("{:<40} {:>12.4f} -> {:>12.4f} {:>9}".format(
+            key, before, after, change))
+    return lines
+
+
+def run_benchmark(args):
+    interval = timedelta(seconds=args.interval)
+    # Leaving the last catch_up schedules that are due to the scheduler
+    epoch = datetime(2000, 1, 1)
+    elapsed = (datetime.now() - epoch).total_seconds() - args.interval
+    last_due = epoch + timedelta(
+        seconds=int(elapsed) - int(elapsed) % args.interval)
+    start_date = last_due - (args.history + args.catch_up - 1) * interval
+
+    dag_folder = args.dag_folder or tempfile.mkdtemp()
+    try:
+        generate_dag_folder(
+            dag_folder, args.dags, args.tasks, depth=args.depth,
+            fan_in=args.fan_in, fan_out=args.fan_out, interval=interval,
+            start_date=start_date)
+        utils.initdb()
+        clean_up()
+        start = datetime.now()
+        dagbag = models.DagBag(dag_folder, include_examples=False)
+        dag_parsing_seconds = (datetime.now() - start).total_seconds()
+        rows = populate_history(dagbag, start_date, interval, args.history)
+        print("Generated {} DAGs with {} task instances of history".format(
+            len(dagbag.dags), rows))
+
+        job = BenchmarkSchedulerJob(
+            dag_folder, executor=InstantExecutor(), num_runs=args.loops)
+        job.run()
+    finally:
+        if not args.dag_folder:
+            shutil.rmtree(dag_folder)
+    return summarize(job, dag_parsing_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the scheduler against synthetic DAGs")
+    parser.add_argument(
+        "--dags", type=int, default=10, help="Number of DAGs")
+    parser.add_argument(
+        "--tasks", type=int, default=10, help="Number of tasks per DAG")
+    parser.add_argument(
+        "--depth", type=int, default=3,
+        help="Number of layers the tasks of a DAG are spread over")
+    parser.add_argument(
+        "--fan_in", type=int, default=1,
+        help="Number of upstream tasks of each task in the previous layer")
+    parser.add_argument(
+        "--fan_out", type=int, default=1,
+        help="Number of downstream tasks of each task in the next layer")
+    parser.add_argument(
+        "--interval", type=int, default=24 * 60 * 60,
+        help="Schedule interval of the DAGs, in seconds")
+    parser.add_argument(
+        "--history", type=int, default=10,
+        help="Number of successful schedules to pre-populate")
+    parser.add_argument(
+        "--catch_up", type=int, default=1,
+        help="Number of due schedules left for the scheduler to run")
+    parser.add_argument(
+        "--loops", type=int, default=3,
+        help="Number of scheduler runs to measure")
+    parser.add_argument(
+        "--dag_folder",
+        help="Where to generate the DAGs, a temporary folder by default")
+    parser.add_argument(
+        "--output", help="Writes the results as JSON to this file")
+    parser.add_argument(
+        "--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument(
+        "--max_regression", type=float,
+        help=(
+            "Exits with an error if the mean loop time regressed by more "
+            "than this percentage compared to the baseline"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    results = run_benchmark(args)
+
+    print(json.dumps(results, indent=4, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\n".join(compare(results, baseline)))
+        before = baseline.get('loop_seconds_mean')
+        if args.max_regression is not None and before and (
+                results['loop_seconds_mean'] > before * (
+                    1 + args.max_regression / 100.0)):
+            print("Mean loop time regressed by more than {}%".format(
+                args.max_regression))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Generates folders of synthetic DAGs of a configurable shape, made of
+DummyOperators, for benchmarking the scheduler.
+"""
+from datetime import datetime, timedelta
+import os
+
+DAG_ID_PREFIX = 'benchmark_'
+
+DAG_TEMPLATE = """\
+import datetime
+
+from airflow import DAG
+from airflow.operators import DummyOperator
+
+dag = DAG(
+    {dag_id!r},
+    schedule_interval=datetime.timedelta(seconds={interval}),
+    start_date={start_date!r})
+
+tasks = {{}}
+for task_id in {task_ids!r}:
+    tasks[task_id] = DummyOperator(
+        task_id=task_id, owner='benchmark', dag=dag)
+for upstream, downstream in {edges!r}:
+    tasks[downstream].set_upstream(tasks[upstream])
+"""
+
+
+def dag_shape(num_tasks, depth=3, fan_in=1, fan_out=1):
+    """
+    Spreads ``num_tasks`` tasks over ``depth`` layers and wires each layer
+    to the previous one. Each task depends on ``fan_in`` tasks of the
+    previous layer and feeds ``fan_out`` tasks of the next one, as far as
+    the widths of the layers allow.
+
+    Returns the list of task_ids and the list of (upstream, downstream)
+    edges.
+
+    >>> task_ids, edges = dag_shape(4, depth=2, fan_in=2)
+    >>> task_ids
+    ['task_0_0', 'task_0_1', 'task_1_0', 'task_1_1']
+    >>> len(edges)
+    4
+    """
+    depth = max(1, min(depth, num_tasks))
+    layers = []
+    for k in range(depth):
+        width = num_tasks // depth + (1 if k < num_tasks % depth else 0)
+        layers.append(['task_{}_{}'.format(k, i) for i in range(width)])
+
+    edges = set()
+    for prev, cur in zip(layers, layers[1:]):
+        for i, task_id in enumerate(cur):
+            for j in range(min(fan_in, len(prev))):
+                edges.add((prev[(i + j) % len(prev)], task_id))
+        for i, task_id in enumerate(prev):
+            for j in range(min(fan_out, len(cur))):
+                edges.add((task_id, cur[(i * fan_out + j) % len(cur)]))
+    return [t for layer in layers for t in layer], sorted(edges)
+
+
+def generate_dag_folder(
+        folder, num_dags, num_tasks, depth=3, fan_in=1, fan_out=1,
+        interval=timedelta(days=1), start_date=None):
+    """
+    Writes ``num_dags`` DAG files of the same shape in ``folder`` and
+    returns their dag_ids. The DAGs start on ``start_date``, an hour ago
+    aligned on ``interval`` by default.
+    """
+    interval_seconds = int(interval.total_seconds())
+    if not start_date:
+        epoch = datetime(2000, 1, 1)
+        elapsed = int((datetime.now() - epoch).total_seconds()) - 3600
+        start_date = epoch + timedelta(
+            seconds=elapsed - elapsed % interval_seconds)
+    task_ids, edges = dag_shape(num_tasks, depth, fan_in, fan_out)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    dag_ids = []
+    for i in range(num_dags):
+        dag_id = '{}{}'.format(DAG_ID_PREFIX, i)
+        with open(os.path.join(folder, dag_id + '.py'), 'w') as f:
+            f.write(DAG_TEMPLATE.format(
+                dag_id=dag_id,
+                interval=interval_seconds,
+                start_date=start_date,
+                task_ids=task_ids,
+                edges=edges))
+        dag_ids.append(dag_id)
+    return dag_ids
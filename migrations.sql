@@ -3,3 +3,38 @@ alter table task_instance add column queue varchar(50) NULL;
 alter table task_instance add column pool varchar(50) NULL;
 alter table task_instance add column priority_weight INT NULL;
 create index ti_pool on task_instance (pool, state) using btree;
+
+// To 1.1
+alter table dag add column scheduler_lock_owner varchar(500) NULL;
+alter table dag add column scheduler_lock_expiry datetime NULL;
+create table backfill_plan (
+    job_id INT NOT NULL,
+    dag_id varchar(250) NOT NULL,
+    task_id varchar(250) NOT NULL,
+    execution_date datetime NOT NULL,
+    state varchar(20) NULL,
+    primary key (job_id, dag_id, task_id, execution_date)
+);
+create index bp_job_state on backfill_plan (job_id, state) using btree;
+alter table job add column bf_start_date datetime NULL;
+alter table job add column bf_end_date datetime NULL;
+alter table job add column bf_plan_id INT NULL;
+create table queued_command (
+    id INT NOT NULL AUTO_INCREMENT,
+    executor_id varchar(50) NULL,
+    dag_id varchar(250) NULL,
+    task_id varchar(250) NULL,
+    execution_date datetime NULL,
+    command text NULL,
+    queue varchar(50) NULL,
+    priority INT NULL,
+    state varchar(20) NULL,
+    hostname varchar(500) NULL,
+    queued_at datetime NULL,
+    start_date datetime NULL,
+    end_date datetime NULL,
+    latest_heartbeat datetime NULL,
+    primary key (id)
+);
+create index qc_queue_state on queued_command (queue, state, priority) using btree;
+create index qc_executor_state on queued_command (executor_id, state) using btree;
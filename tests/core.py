@@ -1,8 +1,14 @@
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
+import getpass
+import json
+import os
+import shutil
+import subprocess
+from tempfile import mkdtemp
 import unittest
 from airflow import configuration
 configuration.test_mode()
-from airflow import jobs, models, DAG, executors, utils, operators
+from airflow import jobs, models, DAG, executors, utils, operators, settings
 from airflow.www.app import app
 
 NUM_EXAMPLE_DAGS = 3
@@ -168,10 +174,590 @@ class CoreTest(unittest.TestCase):
         job = jobs.LocalTaskJob(task_instance=ti, force=True)
         job.run()
 
+    def test_schedule_range(self):
+        schedules = utils.ScheduleRange(
+            DEFAULT_DATE, datetime(2020, 1, 1), timedelta(minutes=1))
+        self.assertEqual(len(schedules), 5 * 365 * 24 * 60 + 24 * 60 + 1)
+        self.assertEqual(schedules[-1], datetime(2020, 1, 1))
+        self.assertEqual(
+            list(schedules[1:3]),
+            [DEFAULT_DATE + timedelta(minutes=i) for i in (1, 2)])
+        assert DEFAULT_DATE + timedelta(hours=1) in schedules
+        assert DEFAULT_DATE + timedelta(seconds=1) not in schedules
+        self.assertEqual(
+            utils.date_range(DEFAULT_DATE, DEFAULT_DATE + timedelta(2)),
+            list(utils.ScheduleRange(
+                DEFAULT_DATE, DEFAULT_DATE + timedelta(2))))
+
     def test_scheduler_job(self):
         job = jobs.SchedulerJob(dag_id='example_bash_operator', test_mode=True)
         job.run()
 
+    def test_dependencies_met_from_states(self):
+        TI = models.TaskInstance
+        run_after_loop = self.dag_bash.get_task('run_after_loop')
+        ti = TI(task=run_after_loop, execution_date=DEFAULT_DATE)
+        ti_states = {
+            ('runme_0', DEFAULT_DATE): utils.State.SUCCESS,
+            ('runme_1', DEFAULT_DATE): utils.State.SUCCESS,
+        }
+        assert not ti.are_dependencies_met(ti_states=ti_states)
+        ti_states[('runme_2', DEFAULT_DATE)] = utils.State.SUCCESS
+        assert ti.are_dependencies_met(ti_states=ti_states)
+
+    def test_scheduler_job_dag_processors(self):
+        job = jobs.SchedulerJob(
+            dag_id='example_bash_operator', test_mode=True, dag_processors=2)
+        job.run()
+
+    def test_scheduler_catch_up(self):
+        start_date = datetime.now().replace(
+            minute=0, second=0, microsecond=0) - timedelta(hours=5)
+        for max_active_runs, expected in ((16, 5), (3, 3)):
+            dag_id = 'catch_up_test_{}'.format(max_active_runs)
+            dag = DAG(
+                dag_id, schedule_interval=timedelta(hours=1),
+                start_date=start_date, max_active_runs=max_active_runs)
+            operators.DummyOperator(
+                task_id='dummy', owner='airflow', dag=dag)
+            session = settings.Session()
+            session.merge(models.DagModel(
+                dag_id=dag_id, last_scheduler_run=None,
+                scheduler_lock=False))
+            session.commit()
+            session.close()
+            executor = executors.SequentialExecutor()
+            jobs.SchedulerJob().process_dag(dag, executor)
+            self.assertEqual(len(executor.queued_tasks), expected)
+
+    def test_scheduler_next_due(self):
+        start_date = datetime.now().replace(
+            minute=0, second=0, microsecond=0) + timedelta(days=1)
+        dag = DAG(
+            'next_due_test', schedule_interval=timedelta(hours=1),
+            start_date=start_date)
+        operators.DummyOperator(task_id='dummy', owner='airflow', dag=dag)
+        session = settings.Session()
+        session.merge(models.DagModel(
+            dag_id=dag.dag_id, last_scheduler_run=None, scheduler_lock=False))
+        session.commit()
+        session.close()
+        job = jobs.SchedulerJob()
+        self.assertEqual(job.get_due_task_ids(dag), {'dummy'})
+        job.process_dag(dag, executors.SequentialExecutor())
+        self.assertEqual(
+            job.next_due[(dag.dag_id, 'dummy')],
+            start_date + timedelta(hours=1))
+        job.pop_due_tasks()
+        self.assertEqual(job.get_due_task_ids(dag), set())
+
+    def test_scheduler_lock(self):
+        DM = models.DagModel
+        dag_id = 'scheduler_lock_test'
+        lease = timedelta(hours=1)
+        session = settings.Session()
+        session.merge(DM(
+            dag_id=dag_id, last_scheduler_run=None, scheduler_lock=False))
+        session.commit()
+        self.assertTrue(DM.acquire_scheduler_lock(
+            dag_id, 'a', lease, timedelta(0), session))
+        # Held by another scheduler, which can't release it either
+        self.assertFalse(DM.acquire_scheduler_lock(
+            dag_id, 'b', lease, timedelta(0), session))
+        DM.release_scheduler_lock(dag_id, 'b', session)
+        self.assertFalse(DM.acquire_scheduler_lock(
+            dag_id, 'b', lease, timedelta(0), session))
+        # An expired lease gets taken over
+        session.query(DM).filter(DM.dag_id == dag_id).update({
+            DM.scheduler_lock_expiry: datetime.now() - timedelta(seconds=1)})
+        session.commit()
+        self.assertTrue(DM.acquire_scheduler_lock(
+            dag_id, 'b', lease, timedelta(0), session))
+        self.assertEqual(
+            session.query(DM.scheduler_lock_owner).filter(
+                DM.dag_id == dag_id).scalar(), 'b')
+        DM.release_scheduler_lock(dag_id, 'b', session)
+        # Released, but scheduled too recently
+        self.assertFalse(DM.acquire_scheduler_lock(
+            dag_id, 'a', lease, timedelta(hours=1), session))
+        self.assertTrue(DM.acquire_scheduler_lock(
+            dag_id, 'a', lease, timedelta(0), session))
+        DM.release_scheduler_lock(dag_id, 'a', session)
+        session.close()
+
+    def test_scheduler_shards(self):
+        session = settings.Session()
+        schedulers = [jobs.SchedulerJob(), jobs.SchedulerJob()]
+        for job in schedulers:
+            job.state = utils.State.RUNNING
+            job.latest_heartbeat = datetime.now()
+            session.add(job)
+        session.commit()
+        for job in schedulers:
+            session.refresh(job)
+        session.expunge_all()
+        for job in schedulers:
+            job.refresh_shard()
+        first, second = schedulers
+        count = first.shard[1]
+        self.assertEqual(second.shard[1], count)
+        self.assertNotEqual(first.shard[0], second.shard[0])
+        dag_ids = ['shard_test_{}'.format(i) for i in range(20)]
+        for dag_id in dag_ids:
+            self.assertFalse(
+                first.in_shard(dag_id) and second.in_shard(dag_id))
+
+        # Queued task instances are only handed over within the shard,
+        # pool slots going to the ones actually handed over
+        in_shard = [d for d in dag_ids if first.in_shard(d)][0]
+        out_of_shard = [d for d in dag_ids if not first.in_shard(d)][0]
+        pool = 'shard_test_pool'
+        session.query(models.Pool).filter_by(pool=pool).delete()
+        session.add(models.Pool(pool=pool, slots=1))
+        dags = {}
+        for dag_id, priority in ((out_of_shard, 10), (in_shard, 1)):
+            dag = DAG(dag_id, start_date=DEFAULT_DATE)
+            task = operators.DummyOperator(
+                task_id='dummy', owner='airflow', pool=pool, dag=dag)
+            dags[dag_id] = dag
+            ti = models.TaskInstance(
+                task, DEFAULT_DATE, state=utils.State.QUEUED)
+            ti.priority_weight = priority
+            session.merge(ti)
+        session.commit()
+        dagbag = models.DagBag(dag_folder=DEV_NULL, include_examples=False)
+        dagbag.dags = dags
+        executor = executors.SequentialExecutor()
+        try:
+            first.prioritize_queued(executor=executor, dagbag=dagbag)
+        finally:
+            session.query(models.TaskInstance).filter(
+                models.TaskInstance.pool == pool).delete()
+            session.commit()
+        self.assertEqual(
+            list(executor.queued_tasks), [(in_shard, 'dummy', DEFAULT_DATE)])
+
+        # The second scheduler dies, the first one takes over its share
+        second.latest_heartbeat = datetime(2000, 1, 1)
+        session.merge(second)
+        session.commit()
+        first.refresh_shard()
+        self.assertEqual(first.shard[1], count - 1)
+        for job in schedulers:
+            job.state = utils.State.SUCCESS
+            session.merge(job)
+        session.commit()
+        session.close()
+
+    def test_query_counter(self):
+        counter = utils.QueryCounter(settings.engine)
+        session = settings.Session()
+        session.query(models.DagModel).all()
+        session.query(models.TaskInstance).first()
+        session.close()
+        self.assertEqual(counter.count, 2)
+
+    def test_synthetic_dags(self):
+        from benchmarks.synthetic_dags import generate_dag_folder
+        dag_folder = mkdtemp()
+        try:
+            dag_ids = generate_dag_folder(
+                dag_folder, num_dags=2, num_tasks=7, depth=3, fan_in=2)
+            dagbag = models.DagBag(dag_folder, include_examples=False)
+        finally:
+            shutil.rmtree(dag_folder)
+        self.assertEqual(sorted(dagbag.dags), sorted(dag_ids))
+        dag = dagbag.dags[dag_ids[0]]
+        self.assertEqual(len(dag.tasks), 7)
+        self.assertEqual(
+            len([t for t in dag.tasks if not t.upstream_list]), 3)
+        self.assertEqual(
+            len(dag.get_task('task_2_0').upstream_list), 2)
+
+    def test_scheduler_pool_slots(self):
+        session = settings.Session()
+        if not session.query(models.Pool).filter(
+                models.Pool.pool == 'test_pool').first():
+            session.add(models.Pool(pool='test_pool', slots=1))
+            session.commit()
+        dag = DAG('pool_test', start_date=DEFAULT_DATE)
+        tasks = [
+            operators.DummyOperator(
+                task_id='dummy_{}'.format(i), owner='airflow',
+                pool='test_pool', dag=dag)
+            for i in range(2)]
+        dag.clear(start_date=DEFAULT_DATE, end_date=DEFAULT_DATE)
+        job = jobs.SchedulerJob()
+        ready = job.get_ready_task_instances(
+            dag, [(task, DEFAULT_DATE, True) for task in tasks], session)
+        self.assertEqual(len(ready), 1)
+        self.assertEqual(job.pool_slots['test_pool'], 0)
+
+        # Queued task instances of pools that don't exist aren't limited
+        task = operators.DummyOperator(
+            task_id='dummy_no_pool', owner='airflow', pool='missing_pool',
+            dag=dag)
+        session.merge(models.TaskInstance(
+            task, DEFAULT_DATE, state=utils.State.QUEUED))
+        session.commit()
+        session.close()
+        self.dagbag.dags[dag.dag_id] = dag
+        executor = executors.SequentialExecutor()
+        job.prioritize_queued(executor=executor, dagbag=self.dagbag)
+        assert (
+            (dag.dag_id, 'dummy_no_pool', DEFAULT_DATE) in
+            executor.queued_tasks)
+        dag.clear(start_date=DEFAULT_DATE, end_date=DEFAULT_DATE)
+
+    def test_scheduler_process_events(self):
+        dag = self.dag_bash
+        dag.clear(start_date=DEFAULT_DATE, end_date=DEFAULT_DATE)
+        session = settings.Session()
+        for task_id in ('runme_0', 'runme_1', 'runme_2'):
+            session.merge(models.TaskInstance(
+                dag.get_task(task_id), DEFAULT_DATE,
+                state=utils.State.SUCCESS))
+        session.commit()
+        session.close()
+        executor = executors.SequentialExecutor()
+        job = jobs.SchedulerJob(dag_id=dag.dag_id, event_driven=True)
+        events = {(dag.dag_id, 'runme_0', DEFAULT_DATE): utils.State.SUCCESS}
+        job.process_events(events, self.dagbag, executor, [])
+        assert (
+            (dag.dag_id, 'run_after_loop', DEFAULT_DATE) in
+            executor.queued_tasks)
+
+    def test_executor_lanes(self):
+        class RecordingExecutor(executors.base_executor.BaseExecutor):
+            def execute_async(self, key, command, queue=None):
+                self.launched.append(key)
+        executor = RecordingExecutor(parallelism=4, queue_slots={'small': 1})
+        executor.launched = []
+        for i in range(5):
+            executor.queue_command(('big', i), 'cmd', priority=i, queue='big')
+        executor.queue_command(('small', 0), 'cmd', priority=0, queue='small')
+        executor.queue_command(
+            ('small', 1), 'cmd', priority=10, queue='small')
+        executor.heartbeat()
+        # The small queue only has a slot, the rest goes by priority
+        self.assertEqual(
+            sorted(executor.launched),
+            [('big', 2), ('big', 3), ('big', 4), ('small', 1)])
+        self.assertTrue(('big', 0) in executor.queued_tasks)
+        executor.launched = []
+        executor.success(('small', 1))
+        executor.heartbeat()
+        # Lanes take turns
+        self.assertEqual(executor.launched, [('small', 0)])
+
+    def test_local_executor_resources(self):
+        class PackingExecutor(executors.LocalExecutor):
+            def execute_async(self, key, command, queue=None):
+                self.launched.append(key[1])
+
+            def sync(self):
+                pass
+        executor = PackingExecutor(
+            parallelism=10, host_cpus=4, host_memory_mb=1000)
+        executor.launched = []
+        dag = DAG('test_resources', default_args={
+            'owner': 'airflow', 'start_date': DEFAULT_DATE})
+        tasks = [
+            operators.DummyOperator(
+                task_id='heavy_0', memory_mb=800, priority_weight=10,
+                dag=dag),
+            operators.DummyOperator(
+                task_id='heavy_1', memory_mb=800, priority_weight=9,
+                dag=dag),
+            operators.DummyOperator(
+                task_id='light', cpus=2, memory_mb=100, dag=dag),
+            operators.DummyOperator(task_id='undeclared', dag=dag),
+        ]
+        for task in tasks:
+            executor.queue_task_instance(
+                models.TaskInstance(task, DEFAULT_DATE))
+        executor.heartbeat()
+        # The second heavy task waits, what fits goes ahead of it
+        self.assertEqual(
+            sorted(executor.launched), ['heavy_0', 'light', 'undeclared'])
+        self.assertEqual(
+            (executor.used_cpus, executor.used_memory_mb), (2, 900))
+        executor.launched = []
+        executor.success(('test_resources', 'heavy_0', DEFAULT_DATE))
+        executor.heartbeat()
+        self.assertEqual(executor.launched, ['heavy_1'])
+        self.assertEqual(
+            (executor.used_cpus, executor.used_memory_mb), (2, 900))
+
+    def test_executor_metrics(self):
+        import socket
+        import urllib2
+        from airflow.executors import metrics
+
+        class MeteredExecutor(executors.base_executor.BaseExecutor):
+            def execute_async(self, key, command, queue=None):
+                pass
+        executor = MeteredExecutor(parallelism=2, queue_slots={'small': 1})
+        for i in range(2):
+            executor.queue_command(('big', i), 'cmd', queue='big')
+            executor.queue_command(('small', i), 'cmd', queue='small')
+        executor.heartbeat()
+        executor.success(('big', 0))
+        executor.success(('small', 0))
+        stats = executor.metrics.as_dict()
+        timings = dict(
+            ((timing['name'], timing['queue']), timing['count'])
+            for timing in stats['timings'])
+        self.assertEqual(timings[('queue_wait', None)], 2)
+        self.assertEqual(timings[('queue_wait', 'small')], 1)
+        self.assertEqual(timings[('run_time', 'big')], 1)
+        gauges = dict(
+            ((gauge['name'], gauge['queue']), gauge['value'])
+            for gauge in stats['gauges'])
+        self.assertEqual(gauges[('open_slots', None)], 0)
+        self.assertEqual(gauges[('open_slots', 'small')], 0)
+        self.assertEqual(gauges[('queued', 'big')], 1)
+        self.assertEqual(gauges[('running', None)], 2)
+
+        sock = socket.socket()
+        sock.bind(('', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        metrics.serve(port)
+        url = 'http://localhost:{}/metrics'.format(port)
+        text = urllib2.urlopen(url).read()
+        assert (
+            'airflow_executor_queue_wait_seconds_count'
+            '{executor="MeteredExecutor",queue="small"} 1') in text
+        assert 'airflow_executor_queued{executor="MeteredExecutor"} 2' in text
+        served = json.loads(urllib2.urlopen(url + '.json').read())
+        assert 'MeteredExecutor' in [stats['executor'] for stats in served]
+
+    def test_executor_batches(self):
+        import shlex
+        from airflow.bin import cli
+
+        class RecordingExecutor(executors.base_executor.BaseExecutor):
+            def execute_async(self, key, command, queue=None):
+                self.launched.append((key, command))
+        executor = RecordingExecutor(parallelism=1, batch_size=3)
+        executor.launched = []
+        TI = models.TaskInstance
+        tis = [
+            TI(self.dag_bash.get_task(task_id), DEFAULT_DATE)
+            for task_id in ('runme_0', 'runme_1', 'runme_2')]
+        tis.append(TI(self.runme_0, DEFAULT_DATE + timedelta(1)))
+        for ti in tis:
+            executor.queue_task_instance(ti, force=True)
+        executor.queue_task_instance(
+            TI(self.dag_bash.get_task('also_run_this'), DEFAULT_DATE),
+            pickle_id=1)
+        executor.heartbeat()
+        # The batch takes the only slot and gets topped up with the task
+        # instances of the same DAG queued
+        self.assertEqual(len(executor.launched), 1)
+        key, batch = executor.launched[0]
+        self.assertEqual(key, tis[0].key)
+        assert batch.startswith(
+            'airflow run_batch example_bash_operator '
+            'runme_0@2015-01-01T00:00:00 runme_1@2015-01-01T00:00:00 '
+            'runme_2@2015-01-01T00:00:00 ')
+        self.assertEqual(len(executor.running), 3)
+        self.assertEqual(len(executor.queued_tasks), 2)
+        self.assertEqual(executor.open_slots(), 0)
+        # The state of a batch goes to all of its task instances
+        executor.success(tis[0].key)
+        self.assertEqual(len(executor.running), 0)
+        self.assertEqual(
+            sorted(executor.get_event_buffer()),
+            sorted(ti.key for ti in tis[:3]))
+
+        cli.run_batch(cli.get_parser().parse_args(shlex.split(batch)[1:]))
+        for ti in tis[:3]:
+            ti.refresh_from_db()
+            self.assertEqual(ti.state, utils.State.SUCCESS)
+
+        # Each task instance of a batch counts against the slots of its
+        # queue
+        queue = self.runme_0.queue
+        executor = RecordingExecutor(
+            parallelism=4, batch_size=3, queue_slots={queue: 2})
+        executor.launched = []
+        for ti in tis:
+            executor.queue_task_instance(ti, force=True)
+        executor.heartbeat()
+        self.assertEqual(len(executor.launched), 1)
+        self.assertEqual(len(executor.running), 2)
+        self.assertEqual(executor.running_by_queue[queue], 2)
+        executor.success(tis[0].key)
+        self.assertEqual(executor.running_by_queue[queue], 0)
+
+    def test_thread_executor(self):
+        from time import sleep
+        from airflow.executors.thread_executor import ThreadExecutor
+
+        def wait():
+            while True:
+                sleep(0.1)
+        dag = DAG('test_thread_executor', default_args={
+            'owner': 'airflow', 'start_date': DEFAULT_DATE})
+        tasks = [
+            operators.PythonOperator(
+                task_id='wait', python_callable=wait, queue='io', dag=dag),
+            operators.PythonOperator(
+                task_id='noop', python_callable=lambda: None, queue='io',
+                dag=dag),
+        ]
+        executor = ThreadExecutor(
+            parallelism=1, threads=4, thread_queues=['io'])
+        executor.start()
+        try:
+            for task in tasks:
+                executor.queue_task_instance(
+                    models.TaskInstance(task, DEFAULT_DATE), force=True)
+            executor.heartbeat()
+            # Threads don't take the slots of the parallelism
+            self.assertEqual(len(executor.running), 2)
+            self.assertEqual(executor.open_slots(), 1)
+            for i in range(100):
+                ti, job_id, thread_id = executor.threaded[
+                    ('test_thread_executor', 'wait', DEFAULT_DATE)]
+                if job_id:
+                    break
+                sleep(0.1)
+            session = settings.Session()
+            job = session.query(jobs.BaseJob).filter_by(id=job_id).one()
+            job.state = utils.State.SHUTDOWN
+            session.commit()
+            session.close()
+            executor.last_job_heartbeat = None
+            executor.heartbeat()
+        finally:
+            executor.end()
+        self.assertEqual(executor.get_event_buffer(), {
+            ('test_thread_executor', 'wait', DEFAULT_DATE): utils.State.FAILED,
+            ('test_thread_executor', 'noop', DEFAULT_DATE): utils.State.SUCCESS,
+        })
+        session = settings.Session()
+        states = dict(session.query(
+            models.TaskInstance.task_id, models.TaskInstance.state).filter_by(
+            dag_id='test_thread_executor'))
+        session.close()
+        self.assertEqual(
+            states, {'wait': utils.State.FAILED, 'noop': utils.State.SUCCESS})
+
+    def test_thread_executor_setup_failure(self):
+        from airflow.executors import thread_executor
+
+        def task_log_handler(ti):
+            raise IOError("No space left on device")
+        dag = DAG('test_thread_executor_setup', default_args={
+            'owner': 'airflow', 'start_date': DEFAULT_DATE})
+        task = operators.DummyOperator(task_id='noop', queue='io', dag=dag)
+        executor = thread_executor.ThreadExecutor(
+            parallelism=1, threads=1, thread_queues=['io'])
+        executor.start()
+        thread_executor.task_log_handler, original = (
+            task_log_handler, thread_executor.task_log_handler)
+        try:
+            executor.queue_task_instance(
+                models.TaskInstance(task, DEFAULT_DATE), force=True)
+            executor.heartbeat()
+            executor.end()
+        finally:
+            thread_executor.task_log_handler = original
+        self.assertEqual(executor.get_event_buffer(), {
+            (dag.dag_id, 'noop', DEFAULT_DATE): utils.State.FAILED})
+
+    def test_database_executor(self):
+        from time import sleep
+        from airflow.executors.database_executor import (
+            DatabaseExecutor, DatabaseWorker)
+        executor = DatabaseExecutor(parallelism=4)
+        executor.start()
+        commands = ['true', 'false', 'true', 'sleep 60']
+        keys = [('dag', 'task', DEFAULT_DATE + timedelta(i)) for i in range(4)]
+        for key, command in zip(keys, commands):
+            executor.queue_command(key, command, queue='db_test')
+        executor.heartbeat()
+        workers = [
+            DatabaseWorker(['db_test'], concurrency=2, poll_interval=0)
+            for i in range(2)]
+        # Each command goes to a single worker
+        self.assertEqual(sum(worker.heartbeat() for worker in workers), 4)
+        self.assertEqual(sum(worker.heartbeat() for worker in workers), 0)
+        # The worker running the last command goes away
+        session = settings.Session()
+        session.query(models.QueuedCommand).filter_by(
+            command='sleep 60').update({
+                models.QueuedCommand.latest_heartbeat: datetime(2000, 1, 1)})
+        session.commit()
+        session.close()
+        for worker in workers:
+            for process in worker.processes.values():
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+
+        # The commands done are kept until their state gets recorded
+        worker = [worker for worker in workers if worker.processes][0]
+        running = len(worker.processes)
+
+        def locked(cls, states):
+            raise Exception("database is locked")
+        finish = models.QueuedCommand.__dict__['finish']
+        models.QueuedCommand.finish = classmethod(locked)
+        try:
+            self.assertRaises(Exception, worker.heartbeat)
+        finally:
+            models.QueuedCommand.finish = finish
+        self.assertEqual(len(worker.processes), running)
+        for i in range(100):
+            for worker in workers:
+                worker.heartbeat()
+            executor.heartbeat()
+            if not executor.running:
+                break
+            sleep(0.1)
+        self.assertEqual(
+            executor.get_event_buffer(),
+            dict(zip(keys, [
+                utils.State.SUCCESS, utils.State.FAILED,
+                utils.State.SUCCESS, utils.State.FAILED])))
+        session = settings.Session()
+        self.assertFalse(session.query(models.QueuedCommand).filter_by(
+            executor_id=executor.executor_id).count())
+        session.close()
+
+    def test_celery_executor_sync(self):
+        from celery.backends.database import DatabaseBackend
+        from celery.result import AsyncResult
+        from airflow.executors import celery_executor
+        app = celery_executor.app
+        tmp_dir = mkdtemp()
+        backend = DatabaseBackend(
+            url='sqlite:///' + os.path.join(tmp_dir, 'celery.db'), app=app)
+        app.__dict__['backend'] = backend
+        try:
+            executor = celery_executor.CeleryExecutor()
+            executor.start()
+            for i in range(3):
+                key = ('dag', 'task', i)
+                executor.running[key] = 'cmd'
+                executor.tasks[key] = AsyncResult(str(i), app=app)
+                executor.last_state[key] = 'PENDING'
+                executor.keys_by_id[str(i)] = key
+            backend.mark_as_done('0', None)
+            backend.mark_as_failure('1', Exception())
+            executor.sync()
+        finally:
+            del app.__dict__['backend']
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(executor.get_event_buffer(), {
+            ('dag', 'task', 0): utils.State.SUCCESS,
+            ('dag', 'task', 1): utils.State.FAILED})
+        self.assertEqual(list(executor.tasks), [('dag', 'task', 2)])
+
     def test_local_backfill_job(self):
         self.dag_bash.clear(
             start_date=DEFAULT_DATE,
@@ -182,6 +768,319 @@ class CoreTest(unittest.TestCase):
             end_date=DEFAULT_DATE)
         job.run()
 
+    def test_backfill_mark_success(self):
+        dag = self.dag_bash
+        end_date = DEFAULT_DATE + timedelta(days=1)
+        dag.clear(start_date=DEFAULT_DATE, end_date=end_date)
+        session = settings.Session()
+        ti = models.TaskInstance(
+            self.runme_0, DEFAULT_DATE, state=utils.State.FAILED)
+        ti.unixname = 'someone_else'
+        ti.pool = 'stale_pool'
+        ti.queue = 'stale_queue'
+        ti.priority_weight = -1
+        session.merge(ti)
+        session.commit()
+        job = jobs.BackfillJob(
+            dag=dag, start_date=DEFAULT_DATE, end_date=end_date,
+            mark_success=True)
+        job.run()
+        tis = dag.get_task_instances_for_dates(
+            session, [DEFAULT_DATE, end_date])
+        self.assertEqual(len(tis), 2 * len(dag.tasks))
+        self.assertEqual(
+            set(ti.state for ti in tis), set([utils.State.SUCCESS]))
+        self.assertEqual(set(ti.job_id for ti in tis), set([job.id]))
+        # Updated the way TaskInstance.run would
+        ti = [
+            ti for ti in tis
+            if ti.task_id == 'runme_0' and ti.execution_date == DEFAULT_DATE
+        ][0]
+        self.assertEqual(
+            (ti.unixname, ti.pool, ti.queue, ti.priority_weight),
+            (getpass.getuser(), self.runme_0.pool, self.runme_0.queue,
+             self.runme_0.priority_weight_total))
+        logs = session.query(models.Log).filter(
+            models.Log.dag_id == dag.dag_id,
+            models.Log.event == utils.State.SUCCESS,
+            models.Log.execution_date.in_([DEFAULT_DATE, end_date]),
+            models.Log.dttm >= job.start_date,
+        ).count()
+        session.close()
+        self.assertEqual(logs, 2 * len(dag.tasks))
+
+    def test_backfill_mark_success_not_due(self):
+        start_date = datetime.now().replace(
+            minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        dag = DAG(
+            'mark_success_not_due_test', start_date=start_date,
+            schedule_interval=timedelta(hours=1))
+        operators.DummyOperator(task_id='dummy', owner='airflow', dag=dag)
+        dag.clear(start_date=start_date)
+        # Ends within the current, still open, schedule
+        job = jobs.BackfillJob(
+            dag=dag, start_date=start_date, end_date=datetime.now(),
+            mark_success=True)
+        job.run()
+        session = settings.Session()
+        marked = sorted(
+            ti.execution_date for ti in
+            session.query(models.TaskInstance).filter(
+                models.TaskInstance.dag_id == dag.dag_id))
+        session.close()
+        self.assertEqual(
+            marked, [start_date, start_date + timedelta(hours=1)])
+
+    def test_backfill_refresh_task_instances(self):
+        dag = self.dag_bash
+        dag.clear(start_date=DEFAULT_DATE, end_date=DEFAULT_DATE)
+        session = settings.Session()
+        session.merge(models.TaskInstance(
+            self.runme_0, DEFAULT_DATE, state=utils.State.SUCCESS))
+        session.commit()
+        job = jobs.BackfillJob(
+            dag=dag, start_date=DEFAULT_DATE, end_date=DEFAULT_DATE)
+        tis = [
+            models.TaskInstance(dag.get_task(task_id), DEFAULT_DATE)
+            for task_id in ('runme_0', 'runme_1')]
+        tis[1].state = utils.State.RUNNING
+        ti_states = job.refresh_task_instances(tis, session)
+        session.close()
+        self.assertEqual(tis[0].state, utils.State.SUCCESS)
+        # Not in the database yet
+        self.assertEqual(tis[1].state, utils.State.RUNNING)
+        self.assertEqual(
+            ti_states, {('runme_0', DEFAULT_DATE): utils.State.SUCCESS})
+
+    def test_backfill_resume(self):
+        dag = self.dag_bash
+        dag.clear(start_date=DEFAULT_DATE, end_date=DEFAULT_DATE)
+        plan_id = 1000000
+        session = settings.Session()
+        session.query(models.BackfillPlan).filter_by(
+            job_id=plan_id).delete()
+        session.commit()
+        models.BackfillPlan.insert(plan_id, {
+            (dag.dag_id, task.task_id, DEFAULT_DATE): utils.State.SUCCESS
+            for task in dag.tasks})
+        tmp_dir = mkdtemp()
+        try:
+            progress_file = os.path.join(tmp_dir, 'progress.json')
+            job = jobs.BackfillJob(
+                dag=dag, start_date=DEFAULT_DATE, end_date=DEFAULT_DATE,
+                resume_job_id=plan_id, progress_file=progress_file)
+            job.run()
+            with open(progress_file) as f:
+                progress = json.load(f)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(progress['plan_id'], plan_id)
+        self.assertEqual(progress['succeeded'], len(dag.tasks))
+        self.assertEqual(progress['yet_to_run'], 0)
+        # Nothing ran again
+        self.assertEqual(
+            dag.get_task_instances_for_dates(session, [DEFAULT_DATE]), [])
+        session.close()
+
+    def test_backfill_resume_date_range(self):
+        from airflow.bin import cli
+        end_date = DEFAULT_DATE + timedelta(days=30)
+        job = jobs.BackfillJob(
+            dag=self.dag_bash, start_date=DEFAULT_DATE, end_date=end_date)
+        session = settings.Session()
+        session.add(job)
+        session.commit()
+        job_id = job.id
+        session.close()
+        self.assertEqual(
+            cli.resumed_date_range(job_id, self.dag_bash.dag_id),
+            (DEFAULT_DATE, end_date))
+        self.assertRaises(
+            Exception, cli.resumed_date_range, job_id + 1000000,
+            self.dag_bash.dag_id)
+
+        # Resumed over a narrower range and interrupted again, the plan
+        # and the range are still those of the first job
+        session = settings.Session()
+        resumed = []
+        for i in range(2):
+            job = jobs.BackfillJob(
+                dag=self.dag_bash, start_date=end_date, end_date=end_date,
+                resume_job_id=resumed[-1].id if resumed else job_id)
+            session.add(job)
+            session.commit()
+            self.assertEqual(job.get_plan_id(session), job_id)
+            resumed.append(job)
+        resumed_id = resumed[-1].id
+        session.close()
+        self.assertEqual(
+            cli.resumed_date_range(resumed_id, self.dag_bash.dag_id),
+            (DEFAULT_DATE, end_date))
+
+    def test_backfill_estimate(self):
+        dag = DAG(
+            'backfill_estimate_test', start_date=DEFAULT_DATE,
+            schedule_interval=timedelta(days=1))
+        t1 = operators.DummyOperator(task_id='t1', owner='airflow', dag=dag)
+        t2 = operators.DummyOperator(
+            task_id='t2', owner='airflow', depends_on_past=True, dag=dag)
+        t2.set_upstream(t1)
+        t3 = operators.DummyOperator(task_id='t3', owner='airflow', dag=dag)
+        d1, d2 = DEFAULT_DATE, DEFAULT_DATE + timedelta(days=1)
+        session = settings.Session()
+        session.query(models.TaskInstance).filter_by(
+            dag_id=dag.dag_id).delete()
+        # History to base the durations on, and a schedule of t3 done
+        for task, seconds in ((t1, 10), (t2, 20), (t3, 5)):
+            ti = models.TaskInstance(
+                task, d1 - timedelta(days=10), state=utils.State.SUCCESS)
+            ti.duration = seconds
+            session.merge(ti)
+        session.merge(
+            models.TaskInstance(t3, d1, state=utils.State.SUCCESS))
+        session.commit()
+        session.close()
+
+        job = jobs.BackfillJob(
+            dag=dag, start_date=d1, end_date=d2, max_running=1)
+        estimate = job.estimate()
+        self.assertEqual(estimate['task_instances'], 5)
+        self.assertEqual(estimate['succeeded'], 1)
+        self.assertEqual(estimate['estimated_seconds'], 65)
+        self.assertEqual(estimate['critical_path_seconds'], 50)
+        self.assertEqual(
+            [key[1:] for key, _ in estimate['critical_path']],
+            [('t1', d1), ('t2', d1), ('t2', d2)])
+
+    def test_backfill_graph(self):
+        dag = DAG(
+            'backfill_graph_test', start_date=DEFAULT_DATE,
+            schedule_interval=timedelta(days=1))
+        t1 = operators.DummyOperator(task_id='t1', owner='airflow', dag=dag)
+        t2 = operators.DummyOperator(
+            task_id='t2', owner='airflow', depends_on_past=True, dag=dag)
+        t2.set_upstream(t1)
+        d1, d2 = DEFAULT_DATE, DEFAULT_DATE + timedelta(days=1)
+        graph = jobs.BackfillGraph(dag, dag.tasks)
+        graph.add_schedule(d1, {})
+        done = graph.add_schedule(d2, {('t1', d2): utils.State.SUCCESS})
+        self.assertEqual(done, [(dag.dag_id, 't1', d2)])
+        self.assertEqual(graph.pop_ready(), [(dag.dag_id, 't1', d1)])
+        graph.mark_succeeded((dag.dag_id, 't1', d1))
+        self.assertEqual(graph.pop_ready(), [(dag.dag_id, 't2', d1)])
+        self.assertEqual(
+            graph.mark_failed((dag.dag_id, 't2', d1)),
+            [(dag.dag_id, 't2', d2)])
+        self.assertEqual(len(graph), 0)
+        self.assertEqual(len(graph.outstanding), 0)
+        self.assertEqual(graph.pop_blocked(), [])
+        # Depending on the past, of a schedule that failed in the graph
+        d3 = d2 + timedelta(days=1)
+        graph.add_schedule(d3, {})
+        self.assertEqual(
+            graph.pop_blocked(),
+            [((dag.dag_id, 't2', d3), (dag.dag_id, 't2', d2))])
+
+        # or before the backfill started
+        graph = jobs.BackfillGraph(dag, dag.tasks)
+        graph.add_schedule(d2, {('t2', d1): utils.State.FAILED})
+        self.assertEqual(
+            graph.pop_blocked(),
+            [((dag.dag_id, 't2', d2), (dag.dag_id, 't2', d1))])
+        self.assertEqual(graph.pop_ready(), [(dag.dag_id, 't1', d2)])
+
+    def test_sharded_backfill_job(self):
+        end_date = DEFAULT_DATE + timedelta(days=9)
+        job = jobs.ShardedBackfillJob(
+            self.dag_bash, start_date=DEFAULT_DATE, end_date=end_date,
+            shards=3, mark_success=True, max_running=4)
+        self.assertEqual(
+            job.backfill_command(DEFAULT_DATE, end_date),
+            [
+                'airflow', 'backfill', 'example_bash_operator',
+                '-s', DEFAULT_DATE.isoformat(), '-e', end_date.isoformat(),
+                '-m', '--max_running', '4'])
+        dag = DAG('sharded_backfill_test', start_date=DEFAULT_DATE)
+        operators.DummyOperator(
+            task_id='dummy', owner='airflow', depends_on_past=True, dag=dag)
+        self.assertRaises(
+            Exception, jobs.ShardedBackfillJob,
+            dag, DEFAULT_DATE, end_date, shards=3)
+
+    def test_heartbeat_agent(self):
+        session = settings.Session()
+        running = jobs.LocalTaskJob(task_instance=None)
+        running.state = utils.State.RUNNING
+        shutdown = jobs.LocalTaskJob(task_instance=None)
+        shutdown.state = utils.State.SHUTDOWN
+        session.add_all([running, shutdown])
+        session.commit()
+        running_id, shutdown_id = running.id, shutdown.id
+        latest_heartbeat = running.latest_heartbeat
+        session.close()
+        # The process of a job that is gone
+        process = subprocess.Popen(['true'])
+        process.wait()
+        folder = mkdtemp()
+        try:
+            agent = jobs.HeartbeatAgent(folder=folder, heartrate=5)
+            self.assertFalse(agent.is_running())
+            agent.register(running_id, os.getpid())
+            agent.register(shutdown_id, os.getpid())
+            agent.register(running_id + 1000000, process.pid)
+            agent.heartbeat()
+            self.assertTrue(agent.is_running())
+            self.assertEqual(
+                sorted(os.listdir(folder)),
+                sorted([
+                    'agent', str(running_id), str(shutdown_id),
+                    str(shutdown_id) + '.shutdown']))
+            self.assertTrue(agent.shutdown_requested(shutdown_id))
+            self.assertFalse(agent.shutdown_requested(running_id))
+        finally:
+            shutil.rmtree(folder)
+        session = settings.Session()
+        job = session.query(jobs.BaseJob).filter_by(id=running_id).one()
+        self.assertTrue(job.latest_heartbeat > latest_heartbeat)
+        session.close()
+
+    def test_heartbeat_agent_registering(self):
+        folder = mkdtemp()
+        try:
+            agent = jobs.HeartbeatAgent(folder=folder, heartrate=0.001)
+            agent.start()
+            try:
+                for job_id in range(1000000, 1000200):
+                    agent.register(job_id, os.getpid())
+            finally:
+                agent.stop()
+            self.assertEqual(
+                sorted(agent.get_jobs()), range(1000000, 1000200))
+            # A file caught while being written is left alone
+            open(os.path.join(folder, '2000000'), 'w').close()
+            self.assertNotIn(2000000, agent.get_jobs())
+            self.assertTrue(os.path.exists(os.path.join(folder, '2000000')))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_fork_server(self):
+        from airflow.executors.fork_server import ForkServer
+        server = ForkServer()
+        pool = settings.engine.pool
+        self.assertEqual(server.run('true'), 0)
+        self.assertEqual(server.run('false'), 1)
+        dag = server.get_dag(None, 'example_bash_operator')
+        self.assertEqual(dag.dag_id, 'example_bash_operator')
+        # Not parsed again as long as the file doesn't change
+        self.assertIs(server.get_dag(None, 'example_bash_operator'), dag)
+        dag.clear(start_date=DEFAULT_DATE, end_date=DEFAULT_DATE)
+        ti = models.TaskInstance(self.runme_0, DEFAULT_DATE)
+        self.assertEqual(server.run(ti.command(raw=True, force=True)), 0)
+        ti.refresh_from_db()
+        self.assertEqual(ti.state, utils.State.SUCCESS)
+        # The child got its own connections, the parent's pool is untouched
+        self.assertIs(settings.engine.pool, pool)
+
     def test_raw_job(self):
         TI = models.TaskInstance
         ti = TI(